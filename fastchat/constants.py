@@ -46,6 +46,8 @@ WORKER_API_TIMEOUT = int(os.getenv("FASTCHAT_WORKER_API_TIMEOUT", 100))
 WORKER_API_EMBEDDING_BATCH_SIZE = int(
     os.getenv("FASTCHAT_WORKER_API_EMBEDDING_BATCH_SIZE", 4)
 )
+# Media type of the binary embedding payload sent from workers to the API server
+EMBEDDING_MEDIA_TYPE = "application/x-fastchat-embedding"
 
 
 class ErrorCode(IntEnum):
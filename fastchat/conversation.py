@@ -6,8 +6,10 @@ If you have any changes in mind, please contribute back so the community can ben
 """
 
 import base64
+import bisect
 import dataclasses
 from enum import auto, IntEnum
+import functools
 from io import BytesIO
 import os
 from typing import List, Any, Dict, Union, Tuple
@@ -73,266 +75,159 @@ class Conversation:
     # The maximum image size in megabytes that this model takes in. None means we do not resize the image.
     max_image_size_mb: int = None
 
+    def __post_init__(self):
+        # Rendering of the system prompt and all but the last message, reused
+        # by `get_prompt` as long as these messages do not change.
+        self._prompt_prefix = None
+        self._prompt_system_message = None
+        self._prompt_parts_key = None
+        # The (role, message) pairs covered by the prefix and the length of
+        # the prefix after the system prompt and after each of them.
+        self._prompt_messages = []
+        self._prompt_offsets = []
+        # The last result of `encode`, reused while the prompt and the
+        # tokenizer do not change.
+        self._encoding_tokenizer = None
+        self._encoding_prompt = None
+        self._encoding = None
+
     def get_prompt(self) -> str:
-        """Get the prompt for generation."""
-        system_prompt = self.system_template.format(system_message=self.system_message)
-        if self.sep_style == SeparatorStyle.ADD_COLON_SINGLE:
-            ret = system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + message + self.sep
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.ADD_COLON_TWO:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt + seps[0]
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
-                    ret += role + ": " + message + seps[i % 2]
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.ADD_COLON_SPACE_SINGLE:
-            ret = system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + message + self.sep
-                else:
-                    ret += role + ": "  # must be end with a space
-            return ret
-        elif self.sep_style == SeparatorStyle.ADD_NEW_LINE_SINGLE:
-            ret = "" if system_prompt == "" else system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + "\n" + message + self.sep
-                else:
-                    ret += role + "\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.NO_COLON_SINGLE:
-            ret = system_prompt
-            for role, message in self.messages:
-                if message:
-                    ret += role + message + self.sep
-                else:
-                    ret += role
-            return ret
-        elif self.sep_style == SeparatorStyle.NO_COLON_TWO:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += role + message + seps[i % 2]
-                else:
-                    ret += role
-            return ret
-        elif self.sep_style == SeparatorStyle.RWKV:
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += (
-                        role
-                        + ": "
-                        + message.replace("\r\n", "\n").replace("\n\n", "\n")
-                    )
-                    ret += "\n\n"
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.LLAMA2:
-            seps = [self.sep, self.sep2]
-            if self.system_message:
-                ret = system_prompt
-            else:
-                ret = "[INST] "
-            for i, (role, message) in enumerate(self.messages):
-                tag = self.roles[i % 2]
-                if message:
-                    if i == 0:
-                        ret += message + " "
-                    else:
-                        ret += tag + " " + message + seps[i % 2]
-                else:
-                    ret += tag
-            return ret
-        elif self.sep_style == SeparatorStyle.LLAMA3:
-            ret = "<|begin_of_text|>"
-            if self.system_message:
-                ret += system_prompt
-            else:
-                ret += ""
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += f"<|start_header_id|>{role}<|end_header_id|>\n\n"
-                    ret += f"{message.strip()}<|eot_id|>"
-                else:
-                    ret += f"<|start_header_id|>{role}<|end_header_id|>\n\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.CHATGLM:
-            # source: https://huggingface.co/THUDM/chatglm-6b/blob/1d240ba371910e9282298d4592532d7f0f3e9f3e/modeling_chatglm.py#L1302-L1308
-            # source2: https://huggingface.co/THUDM/chatglm2-6b/blob/e186c891cf64310ac66ef10a87e6635fa6c2a579/modeling_chatglm.py#L926
-            round_add_n = 1 if self.name == "chatglm2" else 0
-            if system_prompt:
-                ret = system_prompt + self.sep
-            else:
-                ret = ""
+        """Get the prompt for generation.
 
-            for i, (role, message) in enumerate(self.messages):
-                if i % 2 == 0:
-                    ret += f"[Round {i//2 + round_add_n}]{self.sep}"
+        Only messages added or changed since the last call are rendered, so
+        the cost of a turn does not grow with the length of the history.
+        """
+        head, turns, tail, last_two_only = self._get_prompt_parts()
+        messages = self.messages
+        if last_two_only:
+            parts = [head(self.system_message)]
+            turns(parts, messages[-2:], 0)
+        else:
+            last = len(messages) - 1
+            parts = [self._get_prompt_prefix(head, turns, max(last, 0))]
+            turns(parts, messages[last:], last)
+        prompt = "".join(parts)
+        if tail is not None:
+            prompt = tail(prompt)
+        return prompt
+
+    def _get_parts_key(self):
+        return (
+            self.name,
+            self.system_template,
+            tuple(self.roles),
+            self.sep_style,
+            self.sep,
+            self.sep2,
+        )
 
-                if message:
-                    ret += f"{role}：{message}{self.sep}"
-                else:
-                    ret += f"{role}："
-            return ret
-        elif self.sep_style == SeparatorStyle.CHATML:
-            ret = "" if system_prompt == "" else system_prompt + self.sep + "\n"
-            for role, message in self.messages:
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
-                    ret += role + "\n" + message + self.sep + "\n"
-                else:
-                    ret += role + "\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.CHATGLM3:
-            ret = ""
-            if self.system_message:
-                ret += system_prompt
-            for role, message in self.messages:
-                if message:
-                    ret += role + "\n" + message
-                else:
-                    ret += role
-            return ret
-        elif self.sep_style == SeparatorStyle.CHATINTERN:
-            # source: https://huggingface.co/internlm/internlm-chat-7b-8k/blob/bd546fa984b4b0b86958f56bf37f94aa75ab8831/modeling_internlm.py#L771
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if i % 2 == 0:
-                    ret += "<s>"
-                if message:
-                    ret += role + ":" + message + seps[i % 2] + "\n"
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.DOLLY:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += role + ":\n" + message + seps[i % 2]
-                    if i % 2 == 1:
-                        ret += "\n\n"
-                else:
-                    ret += role + ":\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.PHOENIX:
-            ret = system_prompt
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + "<s>" + message + "</s>"
-                else:
-                    ret += role + ": " + "<s>"
-            return ret
-        elif self.sep_style == SeparatorStyle.ROBIN:
-            ret = system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ":\n" + message + self.sep
-                else:
-                    ret += role + ":\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.FALCON_CHAT:
-            ret = ""
-            if self.system_message:
-                ret += system_prompt + self.sep
-            for role, message in self.messages:
-                if message:
-                    ret += role + ": " + message + self.sep
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.METAMATH:
-            ret = "" if system_prompt == "" else system_prompt + self.sep
-            for i, (role, message) in enumerate(self.messages):
-                # For MetaMath, sep2 is used to prefix the message.
-                starting_sep = ":\n" if i % 2 == 0 else ": " + self.sep2
-                ending_sep = self.sep if i % 2 == 0 else ""
-                if message:
-                    ret += role + starting_sep + message + ending_sep
-                else:
-                    ret += role + starting_sep
-            return ret
-        elif self.sep_style == SeparatorStyle.DEEPSEEK_CHAT:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt
-            for i, (role, message) in enumerate(self.messages):
-                if message:
-                    ret += role + ": " + message + seps[i % 2]
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.YUAN2:
-            seps = [self.sep, self.sep2]
-            ret = ""
-            if self.system_message:
-                ret += system_prompt + seps[1]
-            for _, message in self.messages:
-                if message:
-                    ret += message + "<n>"
-                else:
-                    ret += ""
-            ret = ret.rstrip("<n>") + seps[0]
-            return ret
-        elif self.sep_style == SeparatorStyle.GEMMA:
-            ret = "<bos>"
-            for role, message in self.messages:
-                if message:
-                    ret += "<start_of_turn>" + role + "\n" + message + self.sep
-                else:
-                    ret += "<start_of_turn>" + role + "\n"
-            return ret
-        elif self.sep_style == SeparatorStyle.CLLM:
-            seps = [self.sep, self.sep2]
-            ret = system_prompt + seps[0]
-            for i, (role, message) in enumerate(self.messages[-2:]):
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
-                    ret += role + ": " + message + seps[i % 2]
-                else:
-                    ret += role + ":"
-            return ret
-        elif self.sep_style == SeparatorStyle.DEFAULT:
-            ret = system_prompt + "\n"
-            for role, message in self.messages:
-                if message:
-                    if type(message) is tuple:
-                        message, images = message
-                    ret += role + ": " + message + "\n"
-                else:
-                    ret += role + ":"
-            return ret
+    def _get_prompt_parts(self):
+        return _compile_prompt_parts(*self._get_parts_key())
+
+    def _get_prompt_prefix(self, head, turns, end: int) -> str:
+        """Render the system prompt and `self.messages[:end]`, reusing the cache."""
+        parts_key = self._get_parts_key()
+        if (
+            self._prompt_prefix is None
+            or self._prompt_parts_key != parts_key
+            or self._prompt_system_message != self.system_message
+        ):
+            self._prompt_parts_key = parts_key
+            self._prompt_system_message = self.system_message
+            self._prompt_prefix = head(self.system_message)
+            self._prompt_messages = []
+            self._prompt_offsets = [len(self._prompt_prefix)]
+
+        # Keep the longest still unchanged run of cached messages.
+        cached = self._prompt_messages
+        num_valid = _count_unchanged(self.messages[:end], cached)
+        if num_valid < len(cached):
+            del cached[num_valid:]
+            del self._prompt_offsets[num_valid + 1 :]
+
+        offsets = self._prompt_offsets
+        prefix = self._prompt_prefix[: offsets[-1]]
+        if num_valid < end:
+            parts = [prefix]
+            for i in range(num_valid, end):
+                num_parts = len(parts)
+                turns(parts, self.messages[i : i + 1], i)
+                offsets.append(offsets[-1] + sum(map(len, parts[num_parts:])))
+                cached.append(tuple(self.messages[i]))
+            prefix = "".join(parts)
+        self._prompt_prefix = prefix
+        return prefix
+
+    def encode(self, tokenizer) -> "ConversationEncoding":
+        """Tokenize the prompt for generation and locate every message in it.
+
+        The ids are exactly `tokenizer(self.get_prompt()).input_ids`: turns are
+        not tokenized separately, as that changes the ids at turn boundaries
+        (e.g. SentencePiece adds a "▁" to the start of every text). With a
+        fast tokenizer, the character spans of `get_prompt_with_spans` are
+        mapped to token spans through the offset mapping; every token belongs
+        to the span it ends in. Slow tokenizers and templates that rewrite the
+        joined prompt (e.g. YUAN2 and CLLM) come without spans.
+        """
+        _, _, tail, last_two_only = self._get_prompt_parts()
+        if (
+            tail is not None
+            or last_two_only
+            or not getattr(tokenizer, "is_fast", False)
+        ):
+            prompt, char_spans = self.get_prompt(), None
         else:
-            raise ValueError(f"Invalid style: {self.sep_style}")
+            prompt, char_spans = self.get_prompt_with_spans()
+        if self._encoding_tokenizer is tokenizer and self._encoding_prompt == prompt:
+            return self._encoding
 
-    def get_images(self):
-        images = []
-        for i, (role, msg) in enumerate(self.messages[self.offset :]):
-            if i % 2 == 0:
-                if type(msg) is tuple:
-                    for image in msg[1]:
-                        images.append(image.base64_str)
+        if char_spans is None:
+            encoding = ConversationEncoding(tokenizer(prompt).input_ids, [], [])
+        else:
+            tokens = tokenizer(prompt, return_offsets_mapping=True)
+            # Where every token ends. Special tokens cover no characters and
+            # stay with the token before them.
+            ends = []
+            for start, end in tokens.offset_mapping:
+                ends.append(end if end > start else (ends[-1] if ends else 0))
+            spans = [
+                tuple(bisect.bisect_right(ends, x) for x in span) for span in char_spans
+            ]
+            roles = [role for role, _ in self.messages]
+            encoding = ConversationEncoding(list(tokens.input_ids), spans, roles)
+
+        self._encoding_tokenizer = tokenizer
+        self._encoding_prompt = prompt
+        self._encoding = encoding
+        return encoding
+
+    def get_prompt_with_spans(self) -> Tuple[str, List[Tuple[int, int, int]]]:
+        """Get the prompt and the character offsets of every message in it.
 
-        return images
+        For every message, the span is (start, content_start, end): the message
+        renders to prompt[start:end], of which prompt[start:content_start] is
+        its role header. Templates that rewrite the joined prompt (e.g. YUAN2
+        and CLLM) are not supported.
+        """
+        head, turns, tail, last_two_only = self._get_prompt_parts()
+        if tail is not None or last_two_only:
+            raise ValueError(f"Message spans are not supported by {self.name}")
+
+        parts = [head(self.system_message)]
+        start = len(parts[0])
+        spans = []
+        for i, (role, message) in enumerate(self.messages):
+            text = _render_turn(turns, role, message, i)
+            # The header is what the message renders to while it is still empty.
+            header = _render_turn(turns, role, None, i) if message else text
+            content_start = start + len(header) if text.startswith(header) else start
+            parts.append(text)
+            spans.append((start, content_start, start + len(text)))
+            start += len(text)
+        return "".join(parts), spans
+
+    def get_images(self):
+        return _collect_images(self.messages, self.offset)
 
     def set_system_message(self, system_message: str):
         """Set the system message."""
@@ -624,6 +519,10 @@ class Conversation:
             max_image_size_mb=self.max_image_size_mb,
         )
 
+    def compile(self) -> "PromptRenderer":
+        """Compile the template of this conversation into a `PromptRenderer`."""
+        return PromptRenderer(self)
+
     def dict(self):
         return {
             "template_name": self.name,
@@ -634,6 +533,366 @@ class Conversation:
         }
 
 
+@dataclasses.dataclass
+class ConversationEncoding:
+    """Token ids of a conversation prompt, as returned by `Conversation.encode`."""
+
+    # Token ids of the whole prompt
+    input_ids: List[int]
+    # For every message, the token offsets (start, content_start, end).
+    # input_ids[start:end] are the tokens that end inside the message, of
+    # which input_ids[start:content_start] end inside its role header.
+    spans: List[Tuple[int, int, int]]
+    # The role of every message
+    roles: List[str]
+
+    def get_labels(self, role: str, ignore_index: int = -100) -> List[int]:
+        """Labels for training on the messages of `role` only."""
+        labels = [ignore_index] * len(self.input_ids)
+        for msg_role, (_, content_start, end) in zip(self.roles, self.spans):
+            if msg_role == role:
+                labels[content_start:end] = self.input_ids[content_start:end]
+        return labels
+
+
+def _count_unchanged(messages, cached):
+    """The number of leading messages that are still the cached objects."""
+    num_valid = 0
+    for (role, message), (cached_role, cached_message) in zip(messages, cached):
+        if role is not cached_role or message is not cached_message:
+            break
+        num_valid += 1
+    return num_valid
+
+
+def _render_turn(turns, role, message, index) -> str:
+    parts = []
+    turns(parts, [(role, message)], index)
+    return "".join(parts)
+
+
+def _collect_images(messages, offset):
+    images = []
+    for i, (role, msg) in enumerate(messages[offset:]):
+        if i % 2 == 0:
+            if type(msg) is tuple:
+                for image in msg[1]:
+                    images.append(image.base64_str)
+
+    return images
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_prompt_parts(name, system_template, roles, sep_style, sep, sep2):
+    """Specialize the prompt format of a template for fast rendering.
+
+    Returns `(head, turns, tail, last_two_only)`:
+    - `head(system_message)` renders everything before the first message,
+    - `turns(parts, messages, start)` appends the pieces of `messages` to `parts`,
+      where `start` is the index of `messages[0]` in the conversation,
+    - `tail(prompt)` post-processes the joined prompt (or is None),
+    - `last_two_only` tells whether only the last two messages are rendered.
+    """
+    style = sep_style
+    seps = [sep, sep2]
+
+    def system_prompt(system_message):
+        return system_template.format(system_message=system_message)
+
+    head = system_prompt
+    tail = None
+    last_two_only = False
+    if style == SeparatorStyle.ADD_COLON_SINGLE:
+        head = lambda m: system_prompt(m) + sep
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    parts += (role, ": ", message, sep)
+                else:
+                    parts += (role, ":")
+
+    elif style in (SeparatorStyle.ADD_COLON_TWO, SeparatorStyle.CLLM):
+        head = lambda m: system_prompt(m) + sep
+        last_two_only = style == SeparatorStyle.CLLM
+
+        def turns(parts, messages, start):
+            for i, (role, message) in enumerate(messages, start):
+                if message:
+                    if type(message) is tuple:
+                        message, images = message
+                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
+                    parts += (role, ": ", message, seps[i % 2])
+                else:
+                    parts += (role, ":")
+
+    elif style == SeparatorStyle.ADD_COLON_SPACE_SINGLE:
+        head = lambda m: system_prompt(m) + sep
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    parts += (role, ": ", message, sep)
+                else:
+                    parts += (role, ": ")  # must be end with a space
+
+    elif style == SeparatorStyle.ADD_NEW_LINE_SINGLE:
+
+        def head(m):
+            prompt = system_prompt(m)
+            return "" if prompt == "" else prompt + sep
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    parts += (role, "\n", message, sep)
+                else:
+                    parts += (role, "\n")
+
+    elif style == SeparatorStyle.NO_COLON_SINGLE:
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    parts += (role, message, sep)
+                else:
+                    parts.append(role)
+
+    elif style == SeparatorStyle.NO_COLON_TWO:
+
+        def turns(parts, messages, start):
+            for i, (role, message) in enumerate(messages, start):
+                if message:
+                    parts += (role, message, seps[i % 2])
+                else:
+                    parts.append(role)
+
+    elif style == SeparatorStyle.RWKV:
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    message = message.replace("\r\n", "\n").replace("\n\n", "\n")
+                    parts += (role, ": ", message, "\n\n")
+                else:
+                    parts += (role, ":")
+
+    elif style == SeparatorStyle.LLAMA2:
+        head = lambda m: system_prompt(m) if m else "[INST] "
+
+        def turns(parts, messages, start):
+            for i, (role, message) in enumerate(messages, start):
+                tag = roles[i % 2]
+                if message:
+                    if i == 0:
+                        parts += (message, " ")
+                    else:
+                        parts += (tag, " ", message, seps[i % 2])
+                else:
+                    parts.append(tag)
+
+    elif style == SeparatorStyle.LLAMA3:
+        head = lambda m: "<|begin_of_text|>" + (system_prompt(m) if m else "")
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                parts += ("<|start_header_id|>", role, "<|end_header_id|>\n\n")
+                if message:
+                    parts += (message.strip(), "<|eot_id|>")
+
+    elif style == SeparatorStyle.CHATGLM:
+        round_add_n = 1 if name == "chatglm2" else 0
+
+        def head(m):
+            prompt = system_prompt(m)
+            return prompt + sep if prompt else ""
+
+        def turns(parts, messages, start):
+            for i, (role, message) in enumerate(messages, start):
+                if i % 2 == 0:
+                    parts.append(f"[Round {i//2 + round_add_n}]{sep}")
+                if message:
+                    parts += (role, "：", message, sep)
+                else:
+                    parts += (role, "：")
+
+    elif style == SeparatorStyle.CHATML:
+
+        def head(m):
+            prompt = system_prompt(m)
+            return "" if prompt == "" else prompt + sep + "\n"
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    if type(message) is tuple:
+                        message, images = message
+                        message = IMAGE_PLACEHOLDER_STR * len(images) + message
+                    parts += (role, "\n", message, sep, "\n")
+                else:
+                    parts += (role, "\n")
+
+    elif style == SeparatorStyle.CHATGLM3:
+        head = lambda m: system_prompt(m) if m else ""
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    parts += (role, "\n", message)
+                else:
+                    parts.append(role)
+
+    elif style == SeparatorStyle.CHATINTERN:
+
+        def turns(parts, messages, start):
+            for i, (role, message) in enumerate(messages, start):
+                if i % 2 == 0:
+                    parts.append("<s>")
+                if message:
+                    parts += (role, ":", message, seps[i % 2], "\n")
+                else:
+                    parts += (role, ":")
+
+    elif style == SeparatorStyle.DOLLY:
+
+        def turns(parts, messages, start):
+            for i, (role, message) in enumerate(messages, start):
+                if message:
+                    parts += (role, ":\n", message, seps[i % 2])
+                    if i % 2 == 1:
+                        parts.append("\n\n")
+                else:
+                    parts += (role, ":\n")
+
+    elif style == SeparatorStyle.PHOENIX:
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    parts += (role, ": <s>", message, "</s>")
+                else:
+                    parts += (role, ": <s>")
+
+    elif style == SeparatorStyle.ROBIN:
+        head = lambda m: system_prompt(m) + sep
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    parts += (role, ":\n", message, sep)
+                else:
+                    parts += (role, ":\n")
+
+    elif style == SeparatorStyle.FALCON_CHAT:
+        head = lambda m: system_prompt(m) + sep if m else ""
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    parts += (role, ": ", message, sep)
+                else:
+                    parts += (role, ":")
+
+    elif style == SeparatorStyle.METAMATH:
+
+        def head(m):
+            prompt = system_prompt(m)
+            return "" if prompt == "" else prompt + sep
+
+        def turns(parts, messages, start):
+            for i, (role, message) in enumerate(messages, start):
+                # For MetaMath, sep2 is used to prefix the message.
+                starting_sep = ":\n" if i % 2 == 0 else ": " + sep2
+                ending_sep = sep if i % 2 == 0 else ""
+                if message:
+                    parts += (role, starting_sep, message, ending_sep)
+                else:
+                    parts += (role, starting_sep)
+
+    elif style == SeparatorStyle.DEEPSEEK_CHAT:
+
+        def turns(parts, messages, start):
+            for i, (role, message) in enumerate(messages, start):
+                if message:
+                    parts += (role, ": ", message, seps[i % 2])
+                else:
+                    parts += (role, ":")
+
+    elif style == SeparatorStyle.YUAN2:
+        head = lambda m: system_prompt(m) + sep2 if m else ""
+        tail = lambda prompt: prompt.rstrip("<n>") + sep
+
+        def turns(parts, messages, start):
+            for _, message in messages:
+                if message:
+                    parts += (message, "<n>")
+
+    elif style == SeparatorStyle.GEMMA:
+        head = lambda m: "<bos>"
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    parts += ("<start_of_turn>", role, "\n", message, sep)
+                else:
+                    parts += ("<start_of_turn>", role, "\n")
+
+    elif style == SeparatorStyle.DEFAULT:
+        head = lambda m: system_prompt(m) + "\n"
+
+        def turns(parts, messages, start):
+            for role, message in messages:
+                if message:
+                    if type(message) is tuple:
+                        message, images = message
+                    parts += (role, ": ", message, "\n")
+                else:
+                    parts += (role, ":")
+
+    else:
+        raise ValueError(f"Invalid style: {style}")
+
+    return head, turns, tail, last_two_only
+
+
+class PromptRenderer:
+    """A conversation template compiled into a prompt builder.
+
+    Produces exactly the same string as `Conversation.get_prompt`, but the
+    separator style is resolved once and the prompt is built with a single
+    join instead of repeated concatenation.
+    """
+
+    def __init__(self, conv: Conversation):
+        self.name = conv.name
+        self.system_message = conv.system_message
+        self.roles = conv.roles
+        self.messages = [[x, y] for x, y in conv.messages]
+        self.offset = conv.offset
+        self.stop_str = conv.stop_str
+        self.stop_token_ids = conv.stop_token_ids
+        (
+            self._head,
+            self._turns,
+            self._tail,
+            self._last_two_only,
+        ) = conv._get_prompt_parts()
+
+    def render(self, system_message: str, messages: List[List[str]]) -> str:
+        """Render the prompt for `messages`, which include the template's own messages."""
+        if self._last_two_only:
+            messages = messages[-2:]
+        parts = [self._head(system_message)]
+        self._turns(parts, messages, 0)
+        prompt = "".join(parts)
+        if self._tail is not None:
+            prompt = self._tail(prompt)
+        return prompt
+
+    def get_images(self, messages: List[List[str]]) -> List[str]:
+        return _collect_images(messages, self.offset)
+
+
 # A global registry for all conversation templates
 conv_templates: Dict[str, Conversation] = {}
 
@@ -4,9 +4,12 @@
 
 Usage:
 python3 -m fastchat.data.clean_sharegpt --in sharegpt_html.json --out sharegpt_clean.json
+
+Both files can be .json or .jsonl. They are streamed, so the memory used does
+not depend on their size.
 """
 import argparse
-from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import json
 import logging
 import re
@@ -16,6 +19,7 @@ import bs4
 import markdownify  # == 0.11.6
 from tqdm import tqdm
 
+from fastchat.data.streaming import RecordWriter, iter_records, map_chunks
 
 div_pattern = re.compile("<div.*?>")
 span_pattern = re.compile("<span.*?>")
@@ -138,10 +142,21 @@ def clean_html_one_sample(sample):
     return (sample, 0)
 
 
+def clean_html_chunk(samples):
+    return [clean_html_one_sample(sample) for sample in samples]
+
+
 def clean_html_all(content, begin, end):
     """
     Clean the source html files.
     """
+    return list(clean_html_stream(content[begin:end]))
+
+
+def clean_html_stream(samples):
+    """
+    Clean a stream of source html samples, yielding the ones to keep.
+    """
     cnt_skip = 0
     cnt_blocked_words = 0
     cnt_wrong_format = 0
@@ -152,17 +167,18 @@ def clean_html_all(content, begin, end):
     cnt_plugin = 0
     cnt_tag = 0
 
-    content = content[begin:end]
-    processed = []
-    with ProcessPoolExecutor() as executor:
-        for result in tqdm(
-            executor.map(clean_html_one_sample, content), total=len(content)
-        ):
-            processed.append(result)
+    cnt_total = 0
+    cnt_new = 0
 
+    # Only hashes of the first turns are kept to find value duplications.
     visited = {}
-    new_content = []
+    processed = (
+        result
+        for chunk in tqdm(map_chunks(clean_html_chunk, samples))
+        for result in chunk
+    )
     for sample, error_code in processed:
+        cnt_total += 1
         cid = sample["id"]
         skipped = True
 
@@ -188,10 +204,14 @@ def clean_html_all(content, begin, end):
             print(f"id {cid} contains plugin")
             cnt_plugin += 1
         else:
-            key = (
-                sample["conversations"][0]["value"],
-                sample["conversations"][1]["value"],
-            )
+            key = hashlib.sha1(
+                json.dumps(
+                    [
+                        sample["conversations"][0]["value"],
+                        sample["conversations"][1]["value"],
+                    ]
+                ).encode()
+            ).digest()
             if key in visited:
                 print(f"id {cid} is a value duplication of {visited[key]}")
                 cnt_value_duplication += 1
@@ -200,25 +220,25 @@ def clean_html_all(content, begin, end):
                 skipped = False
 
         if not skipped:
-            new_content.append(sample)
+            cnt_new += 1
+            yield sample
         else:
             cnt_skip += 1
 
     print(
-        f"total: {len(content)}, skip: {cnt_skip}, new: {len(new_content)}, "
+        f"total: {cnt_total}, skip: {cnt_skip}, new: {cnt_new}, "
         f"cnt_blocked_words: {cnt_blocked_words}, cnt_parser_error: {cnt_parser_error}, "
         f"cnt_wrong_format: {cnt_wrong_format}, "
         f"cnt_too_short: {cnt_too_short}, cnt_id_duplication: {cnt_id_duplication}, "
         f"cnt_value_duplication: {cnt_value_duplication}, cnt_plugin: {cnt_plugin}"
     )
 
-    return new_content
-
 
 def main(args):
-    content = json.load(open(args["in_file"], "r"))
-    content = clean_html_all(content, args["begin"], args["end"])
-    json.dump(content, open(args["out_file"], "w"), indent=2, ensure_ascii=False)
+    samples = iter_records(args["in_file"], args["begin"], args["end"])
+    with RecordWriter(args["out_file"]) as writer:
+        for sample in clean_html_stream(samples):
+            writer.write(sample)
 
 
 if __name__ == "__main__":
@@ -5,15 +5,20 @@ Usage: python3 -m fastchat.data.split_long_conversation \
     --in sharegpt_clean.json \
     --out sharegpt_split.json \
     --model-name-or-path $<model-name>
+
+Both files can be .json or .jsonl. They are streamed, so the memory used does
+not depend on their size.
 """
 import argparse
 from concurrent.futures import ProcessPoolExecutor
-import json
+import itertools
 from typing import Dict, Sequence, Optional
 
 import transformers
 from tqdm import tqdm
 
+from fastchat.data.streaming import RecordWriter, iter_records, map_chunks
+
 
 def make_sample(sample, start_idx, end_idx):
     assert (end_idx - start_idx) % 2 == 0
@@ -83,38 +88,41 @@ def split_all(content, begin, end, tokenizer_, max_length_):
     return new_content
 
 
-def filter_invalid_roles(content):
-    new_content = []
-    for i, c in enumerate(content):
-        roles = ["human", "gpt"]
-        if len(c["conversations"]) <= 0:
-            continue
+def has_valid_roles(c):
+    roles = ["human", "gpt"]
+    if len(c["conversations"]) <= 0:
+        return False
 
-        valid = True
-        for j, s in enumerate(c["conversations"]):
-            if s["from"] != roles[j % 2]:
-                valid = False
-                break
+    for j, s in enumerate(c["conversations"]):
+        if s["from"] != roles[j % 2]:
+            return False
+    return True
 
-        if valid:
-            new_content.append(c)
 
-    return new_content
+def filter_invalid_roles(content):
+    return [c for c in content if has_valid_roles(c)]
 
 
 def main(args):
-    content = json.load(open(args.in_file, "r"))
+    global tokenizer, max_length
     tokenizer = transformers.AutoTokenizer.from_pretrained(
         args.model_name_or_path,
         model_max_length=args.max_length,
         padding_side="right",
         use_fast=False,
     )
-    new_content = split_all(content, args.begin, args.end, tokenizer, args.max_length)
-    new_content = filter_invalid_roles(new_content)
-
-    print(f"#in: {len(content)}, #out: {len(new_content)}")
-    json.dump(new_content, open(args.out_file, "w"), indent=2, ensure_ascii=False)
+    max_length = args.max_length
+
+    counter = itertools.count()
+    samples = iter_records(args.in_file, args.begin, args.end)
+    samples = (s for s, _ in zip(samples, counter))
+    with RecordWriter(args.out_file) as writer:
+        for result in tqdm(map_chunks(worker, samples)):
+            for sample in result:
+                if has_valid_roles(sample):
+                    writer.write(sample)
+
+    print(f"#in: {next(counter)}, #out: {writer.count}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+"""
+Stream conversation records from and to JSON / JSONL files.
+
+Records are read and written one at a time, so memory does not grow with the
+size of the file. `.jsonl` files hold one record per line; `.json` files hold
+one array of records, which is decoded incrementally.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import os
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_json_array(f, chunk_size: int = 1 << 20) -> Iterator[Dict]:
+    """Decode a JSON array of objects one element at a time."""
+    decoder = json.JSONDecoder()
+    buf, pos = "", 0
+    expect = "["
+    while True:
+        # Skip whitespace and separators, reading more text as needed.
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buf):
+            more = f.read(chunk_size)
+            if not more:
+                raise ValueError(f"Unterminated JSON array in {f.name}")
+            buf, pos = buf[pos:] + more, 0
+            continue
+        if expect:
+            if buf[pos] != expect:
+                raise ValueError(f"{f.name} does not contain a JSON array")
+            pos += 1
+            expect = None
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # The record continues beyond the text read so far.
+            more = f.read(chunk_size)
+            if not more:
+                raise
+            buf, pos = buf[pos:] + more, 0
+            continue
+        yield record
+        pos = end
+
+
+def iter_records(
+    path: str, begin: Optional[int] = None, end: Optional[int] = None
+) -> Iterator[Dict]:
+    """Stream the records of a .json or .jsonl file, optionally [begin:end]."""
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            records = _iter_json_array(f)
+        yield from itertools.islice(records, begin, end)
+
+
+def iter_jsonl_range(path: str, start: int, end: int) -> Iterator[Dict]:
+    """Stream the records of a .jsonl file whose lines start in [start, end).
+
+    Splitting a file into byte ranges lets readers share it without reading
+    the parts of each other.
+    """
+    with open(path, "rb") as f:
+        if start > 0:
+            # Skip the line that started before this range.
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_shard_range(path: str, shard: int, num_shards: int):
+    size = os.path.getsize(path)
+    return size * shard // num_shards, size * (shard + 1) // num_shards
+
+
+class RecordWriter:
+    """Write records one at a time to a .jsonl file or as a .json array."""
+
+    def __init__(self, path: str):
+        self.jsonl = path.endswith(".jsonl")
+        self.file = open(path, "w", encoding="utf-8")
+        self.count = 0
+        if not self.jsonl:
+            self.file.write("[")
+
+    def write(self, record: Dict):
+        line = json.dumps(record, ensure_ascii=False)
+        if self.jsonl:
+            self.file.write(line + "\n")
+        else:
+            self.file.write(("," if self.count else "") + "\n" + line)
+        self.count += 1
+
+    def close(self):
+        if not self.jsonl:
+            self.file.write("\n]\n")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def map_chunks(
+    fn: Callable[[List], object],
+    records: Iterable,
+    chunk_size: int = 1000,
+    max_workers: Optional[int] = None,
+) -> Iterator:
+    """Apply `fn` to chunks of `records` in worker processes.
+
+    Results are yielded in order. Only a few chunks per worker are in flight,
+    so the records are read as fast as they are processed, not all at once.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers) as executor:
+        pending = deque()
+        for chunk in chunked(records, chunk_size):
+            pending.append(executor.submit(fn, chunk))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
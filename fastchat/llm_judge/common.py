@@ -11,9 +11,6 @@ import re
 import time
 from typing import Optional
 
-import openai
-import anthropic
-
 from fastchat.model.model_adapter import (
     get_conversation_template,
     ANTHROPIC_MODEL_LIST,
@@ -405,6 +402,8 @@ def play_a_match_pair(match: MatchPair, output_file: str):
 
 
 def chat_completion_openai(model, conv, temperature, max_tokens, api_dict=None):
+    import openai
+
     if api_dict is not None:
         openai.api_base = api_dict["api_base"]
         openai.api_key = api_dict["api_key"]
@@ -429,6 +428,8 @@ def chat_completion_openai(model, conv, temperature, max_tokens, api_dict=None):
 
 
 def chat_completion_openai_azure(model, conv, temperature, max_tokens, api_dict=None):
+    import openai
+
     openai.api_type = "azure"
     openai.api_version = "2023-07-01-preview"
     if api_dict is not None:
@@ -468,6 +469,8 @@ def chat_completion_openai_azure(model, conv, temperature, max_tokens, api_dict=
 
 
 def chat_completion_anthropic(model, conv, temperature, max_tokens, api_dict=None):
+    import anthropic
+
     if api_dict is not None and "api_key" in api_dict:
         api_key = api_dict["api_key"]
     else:
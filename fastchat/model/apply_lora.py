@@ -8,13 +8,21 @@ Dependency:
 pip3 install git+https://github.com/huggingface/peft.git@2822398fbe896f25d4dac5e468624dc5fd65a51b
 """
 import argparse
+import json
+import math
+import os
+import re
 
+from huggingface_hub import snapshot_download
 import torch
-from peft import PeftModel
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
+
+from fastchat.model.checkpoint_shards import CheckpointReader, map_shards
 
 
 def apply_lora(base_model_path, target_model_path, lora_path):
+    from peft import PeftModel
+
     print(f"Loading the base model from {base_model_path}")
     base = AutoModelForCausalLM.from_pretrained(
         base_model_path, torch_dtype=torch.float16, low_cpu_mem_usage=True
@@ -37,12 +45,124 @@ def apply_lora(base_model_path, target_model_path, lora_path):
     base_tokenizer.save_pretrained(target_model_path)
 
 
+def load_lora_weights(lora_path):
+    """Map the base weight names to their LoRA update and replaced weights.
+
+    Returns `{name: (lora_A, lora_B, scaling, transpose)}` and the full
+    weights saved with the adapter, which replace those of the base model.
+    """
+    if not os.path.exists(lora_path):
+        lora_path = snapshot_download(repo_id=lora_path)
+    with open(os.path.join(lora_path, "adapter_config.json")) as f:
+        config = json.load(f)
+    safetensors_path = os.path.join(lora_path, "adapter_model.safetensors")
+    if os.path.exists(safetensors_path):
+        from safetensors.torch import load_file
+
+        state_dict = load_file(safetensors_path)
+    else:
+        state_dict = torch.load(
+            os.path.join(lora_path, "adapter_model.bin"),
+            map_location="cpu",
+            weights_only=True,
+        )
+
+    if config.get("use_dora"):
+        raise ValueError("DoRA adapters are not supported with --low-cpu-mem")
+
+    def get_pattern_value(patterns, module, default):
+        # The same matching as peft: a pattern matches a suffix of the module name.
+        for key, value in patterns.items():
+            if re.match(rf"(.*\.)?{key}$", module):
+                return value
+        return default
+
+    def get_scaling(module):
+        r = get_pattern_value(config.get("rank_pattern") or {}, module, config["r"])
+        alpha = get_pattern_value(
+            config.get("alpha_pattern") or {}, module, config["lora_alpha"]
+        )
+        return alpha / (math.sqrt(r) if config.get("use_rslora") else r)
+
+    pattern = re.compile(r"(.*)\.lora_(embedding_)?([AB])(?:\.weight)?$")
+    lora, replaced = {}, {}
+    for key, tensor in state_dict.items():
+        key = key[len("base_model.model.") :]
+        match = pattern.match(key)
+        if match is None:
+            # Saved modules_to_save, or the base layer of a LoRA embedding.
+            replaced[key.replace(".base_layer.", ".")] = tensor
+            continue
+        module, embedding, which = match.groups()
+        # Embeddings and fan_in_fan_out (Conv1D) layers store the transpose.
+        transpose = bool(embedding) or config.get("fan_in_fan_out", False)
+        entry = lora.setdefault(
+            module + ".weight", [None, None, get_scaling(module), transpose]
+        )
+        entry[0 if which == "A" else 1] = tensor
+    return {name: tuple(entry) for name, entry in lora.items()}, replaced
+
+
+def apply_lora_low_cpu_mem(
+    base_model_path, target_model_path, lora_path, num_workers=None
+):
+    base_tokenizer = AutoTokenizer.from_pretrained(base_model_path, use_fast=False)
+    base_config = AutoConfig.from_pretrained(base_model_path)
+
+    print(f"Loading the LoRA adapter from {lora_path}")
+    lora, replaced = load_lora_weights(lora_path)
+    base = CheckpointReader(base_model_path)
+    missing = [name for name in list(lora) + list(replaced) if name not in base]
+    assert not missing, f"The adapter weights {missing} are not in the base model"
+
+    def merge(name, param):
+        if name in replaced:
+            param = replaced[name]
+        if param.is_floating_point():
+            param = param.to(torch.float16)
+        if name not in lora:
+            return param
+        lora_A, lora_B, scaling, transpose = lora[name]
+        delta = (lora_B.float() @ lora_A.float()) * scaling
+        if transpose:
+            delta = delta.T
+        return (param.float() + delta).to(param.dtype)
+
+    print("Applying the LoRA")
+    map_shards(base, merge, target_model_path, num_workers, desc="Applying LoRA")
+
+    print(f"Saving the target model to {target_model_path}")
+    base_tokenizer.save_pretrained(target_model_path)
+    base_config.save_pretrained(target_model_path)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--base-model-path", type=str, required=True)
     parser.add_argument("--target-model-path", type=str, required=True)
     parser.add_argument("--lora-path", type=str, required=True)
+    parser.add_argument(
+        "--low-cpu-mem",
+        action="store_true",
+        help="Lower the cpu memory usage. This will merge the LoRA weights one "
+        "shard at a time from memory maps and write safetensors shards, using "
+        "about one shard of memory per worker.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help="The number of shards processed in parallel with --low-cpu-mem.",
+    )
 
     args = parser.parse_args()
 
-    apply_lora(args.base_model_path, args.target_model_path, args.lora_path)
+    if args.low_cpu_mem:
+        apply_lora_low_cpu_mem(
+            args.base_model_path,
+            args.target_model_path,
+            args.lora_path,
+            args.num_workers,
+        )
+    else:
+        apply_lora(args.base_model_path, args.target_model_path, args.lora_path)
@@ -0,0 +1,153 @@
+"""
+Read and rewrite sharded checkpoints one tensor at a time.
+
+CheckpointReader indexes the tensor names of a checkpoint from its safetensors
+headers (or the pickles of `.bin` shards) and reads single tensors through
+memory maps, so only the tensors in use are paged in. map_shards writes a new
+safetensors checkpoint with one output shard per input shard, processing
+several shards in parallel. Peak memory is about one shard per worker, so it
+is bounded by the largest shard times the number of workers.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import glob
+import json
+import mmap
+import os
+from typing import Callable, Dict, List, Optional
+
+from huggingface_hub import snapshot_download
+from safetensors.torch import save_file
+import torch
+from tqdm import tqdm
+
+from fastchat.model.safetensors_loader import SafetensorsFile
+
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+
+
+def _get_shard_files(model_path: str, index_name: str, pattern: str) -> List[str]:
+    index_path = os.path.join(model_path, index_name)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [
+            os.path.join(model_path, name) for name in sorted(set(weight_map.values()))
+        ]
+    return sorted(glob.glob(os.path.join(model_path, pattern)))
+
+
+class CheckpointReader:
+    """Lazy, thread-safe access to the tensors of a local or hub checkpoint."""
+
+    def __init__(self, model_path: str):
+        if not os.path.exists(model_path):
+            model_path = snapshot_download(repo_id=model_path)
+        self.model_path = model_path
+
+        self.shards = _get_shard_files(
+            model_path, SAFE_WEIGHTS_INDEX_NAME, "*.safetensors"
+        )
+        if self.shards:
+            self.files = {path: SafetensorsFile(path) for path in self.shards}
+        else:
+            self.shards = _get_shard_files(
+                model_path, "pytorch_model.bin.index.json", "pytorch_model*.bin"
+            )
+            if not self.shards:
+                raise FileNotFoundError(f"No model weights found in {model_path}")
+            self.files = {
+                path: torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+                for path in self.shards
+            }
+
+        self.weight_map = {}
+        for path, shard in self.files.items():
+            for name in shard.keys():
+                self.weight_map[name] = path
+
+    def keys(self, shard: Optional[str] = None) -> List[str]:
+        if shard is None:
+            return list(self.weight_map)
+        return list(self.files[shard].keys())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.weight_map
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        """A CPU tensor that aliases the mapped file; copy it before writing."""
+        shard = self.files[self.weight_map[name]]
+        if isinstance(shard, SafetensorsFile):
+            return shard.get_tensor(name)
+        return shard[name]
+
+    def release(self, shard: str):
+        """Drop the pages of a processed shard from the memory of the process.
+
+        They are read again from the file if the shard is used later.
+        """
+        file = self.files[shard]
+        if isinstance(file, SafetensorsFile) and hasattr(mmap, "MADV_DONTNEED"):
+            file.mmap.madvise(mmap.MADV_DONTNEED)
+
+
+def map_shards(
+    reader: CheckpointReader,
+    fn: Callable[[str, torch.Tensor], torch.Tensor],
+    output_dir: str,
+    num_workers: Optional[int] = None,
+    desc: Optional[str] = None,
+) -> Dict[str, str]:
+    """Write `fn(name, tensor)` for every tensor of `reader` to `output_dir`.
+
+    Each input shard becomes one safetensors shard, and an index is written
+    alongside them. By default up to 4 shards are processed at a time, which
+    is enough to keep a disk busy. Returns the weight map of the output.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    num_shards = len(reader.shards)
+    if num_workers is None:
+        num_workers = min(num_shards, 4, os.cpu_count() or 1)
+
+    def process(i: int):
+        shard = reader.shards[i]
+        state_dict = {}
+        for name in reader.keys(shard):
+            state_dict[name] = fn(name, reader.get_tensor(name)).contiguous()
+        file_name = f"model-{i + 1:05d}-of-{num_shards:05d}.safetensors"
+        save_file(
+            _untie(state_dict),
+            os.path.join(output_dir, file_name),
+            metadata={"format": "pt"},
+        )
+        size = sum(t.numel() * t.element_size() for t in state_dict.values())
+        reader.release(shard)
+        return file_name, list(state_dict), size
+
+    weight_map = {}
+    total_size = 0
+    with ThreadPoolExecutor(max(1, num_workers)) as executor:
+        futures = [executor.submit(process, i) for i in range(num_shards)]
+        for future in tqdm(as_completed(futures), total=num_shards, desc=desc):
+            file_name, names, size = future.result()
+            weight_map.update(dict.fromkeys(names, file_name))
+            total_size += size
+
+    weight_map = dict(sorted(weight_map.items()))
+    with open(os.path.join(output_dir, SAFE_WEIGHTS_INDEX_NAME), "w") as f:
+        json.dump(
+            {"metadata": {"total_size": total_size}, "weight_map": weight_map},
+            f,
+            indent=2,
+        )
+    return weight_map
+
+
+def _untie(state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """Copy tensors that share memory, which safetensors refuses to save."""
+    seen = set()
+    for name, tensor in state_dict.items():
+        ptr = tensor.data_ptr()
+        if tensor.numel() and ptr in seen:
+            state_dict[name] = tensor.clone()
+        seen.add(ptr)
+    return state_dict
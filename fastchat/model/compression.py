@@ -1,6 +1,8 @@
+import argparse
 import dataclasses
 import gc
 import glob
+import json
 import os
 
 from accelerate import init_empty_weights
@@ -35,6 +37,14 @@ default_compression_config = CompressionConfig(
     num_bits=8, group_size=256, group_dim=1, symmetric=True, enabled=True
 )
 
+# Pre-quantized weights written by `export_compressed_model`
+COMPRESSED_WEIGHTS_NAME = "compressed_model.safetensors"
+COMPRESSED_FORMAT_VERSION = 1
+
+# Number of weight elements dequantized at once by `dequantize_linear`. A tile
+# of this size stays in the CPU cache between dequantization and the matmul.
+DEQUANT_TILE_SIZE = 2**18
+
 
 class CLinear(nn.Module):
     """Compressed Linear Layer."""
@@ -50,6 +60,12 @@ class CLinear(nn.Module):
         self.bias = bias
 
     def forward(self, input: Tensor) -> Tensor:
+        if input.device.type == "cpu" and can_dequantize_linear(
+            self.weight, default_compression_config
+        ):
+            return dequantize_linear(
+                input, self.weight, self.bias, default_compression_config
+            )
         weight = decompress(self.weight, default_compression_config)
         if self.bias is None:
             return F.linear(input.to(weight.dtype), weight)
@@ -107,6 +123,37 @@ def apply_compressed_weight(module, compressed_state_dict, target_device, prefix
 
 
 def load_compress_model(model_path, device, torch_dtype, use_fast, revision="main"):
+    tokenizer, model, linear_weights = init_compress_model(
+        model_path, torch_dtype, use_fast, revision
+    )
+    compressed_file = os.path.join(model_path, COMPRESSED_WEIGHTS_NAME)
+    if os.path.isfile(compressed_file):
+        # Exported by `python3 -m fastchat.model.compression`. Skip quantization.
+        compressed_state_dict = load_compressed_file(
+            compressed_file, device, torch_dtype
+        )
+    else:
+        compressed_state_dict = load_and_compress_weights(
+            model_path, linear_weights, device, torch_dtype, revision
+        )
+
+    for name in model.state_dict():
+        if name not in linear_weights:
+            set_module_tensor_to_device(
+                model, name, device, value=compressed_state_dict[name]
+            )
+    apply_compressed_weight(model, compressed_state_dict, device)
+
+    if torch_dtype == torch.float16:
+        model.half()
+    model.to(device)
+    model.eval()
+
+    return model, tokenizer
+
+
+def init_compress_model(model_path, torch_dtype, use_fast, revision="main"):
+    """Load the tokenizer and create the model without allocating its weights."""
     # partially load model
     # `use_fast=True`` is not supported for some models.
     try:
@@ -138,7 +185,14 @@ def load_compress_model(model_path, device, torch_dtype, use_fast, revision="mai
                 model = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
         except NameError:
             model = AutoModel.from_config(config, trust_remote_code=True)
-        linear_weights = get_compressed_list(model)
+        linear_weights = set(get_compressed_list(model))
+    return tokenizer, model, linear_weights
+
+
+def load_and_compress_weights(
+    model_path, linear_weights, device, torch_dtype, revision="main"
+):
+    """Read the original checkpoint and quantize its linear weights."""
     if os.path.exists(model_path):
         # `model_path` is a local folder
         base_pattern = os.path.join(model_path, "pytorch_model*.bin")
@@ -171,7 +225,11 @@ def load_compress_model(model_path, device, torch_dtype, use_fast, revision="mai
     use_safetensors = False
     if len(files) == 0:
         base_pattern = os.path.join(model_path, "*.safetensors")
-        files = glob.glob(base_pattern)
+        files = [
+            f
+            for f in glob.glob(base_pattern)
+            if os.path.basename(f) != COMPRESSED_WEIGHTS_NAME
+        ]
         use_safetensors = True
     if len(files) == 0:
         raise ValueError(
@@ -179,16 +237,106 @@ def load_compress_model(model_path, device, torch_dtype, use_fast, revision="mai
             f"Please check your (cached) weight path: {model_path}"
         )
 
-    compressed_state_dict = {}
     if use_safetensors:
-        from safetensors.torch import load_file
-    for filename in tqdm(files):
-        if use_safetensors:
-            tmp_state_dict = load_file(filename)
+        from fastchat.model.safetensors_loader import load_safetensors
+
+        def compress_linear_weight(name, tensor):
+            if name in linear_weights:
+                return compress(tensor, default_compression_config)
+            return tensor
+
+        # Shards are memory-mapped and quantized concurrently. Only the
+        # compressed weights are kept, so there is no per-tensor cleanup.
+        compressed_state_dict = load_safetensors(
+            files, device, torch_dtype, transform=compress_linear_weight
+        )
+    else:
+        compressed_state_dict = load_pytorch_bin_files(
+            files, linear_weights, device, torch_dtype
+        )
+    return compressed_state_dict
+
+
+def export_compressed_model(
+    model_path, output_path, device="cpu", torch_dtype=torch.float16, revision="main"
+):
+    """Quantize a model once and save it to `output_path` for `load_compress_model`.
+
+    The output directory holds the config, the tokenizer and a single
+    safetensors file with the quantized linear weights, their scales and all
+    other weights in `torch_dtype`.
+    """
+    from safetensors.torch import save_file
+
+    tokenizer, model, linear_weights = init_compress_model(
+        model_path, torch_dtype, use_fast=True, revision=revision
+    )
+    compressed_state_dict = load_and_compress_weights(
+        model_path, linear_weights, device, torch_dtype, revision
+    )
+
+    config = dataclasses.asdict(default_compression_config)
+    tensors, shapes = {}, {}
+    for name, value in compressed_state_dict.items():
+        if name in linear_weights:
+            if config["symmetric"]:
+                data, scale, original_shape = value
+                tensors[f"{name}.scale"] = scale.contiguous().cpu()
+            else:
+                data, mn, scale, original_shape = value
+                tensors[f"{name}.mn"] = mn.contiguous().cpu()
+                tensors[f"{name}.scale"] = scale.contiguous().cpu()
+            tensors[f"{name}.qdata"] = data.contiguous().cpu()
+            shapes[name] = list(original_shape)
         else:
-            tmp_state_dict = torch.load(
-                filename, map_location=lambda storage, loc: storage
-            )
+            tensors[name] = value.contiguous().cpu()
+
+    os.makedirs(output_path, exist_ok=True)
+    metadata = {
+        "format": "pt",
+        "fastchat_compression": json.dumps(
+            {"version": COMPRESSED_FORMAT_VERSION, "config": config, "shapes": shapes}
+        ),
+    }
+    save_file(tensors, os.path.join(output_path, COMPRESSED_WEIGHTS_NAME), metadata)
+    model.config.save_pretrained(output_path)
+    tokenizer.save_pretrained(output_path)
+
+
+def load_compressed_file(filename, device, torch_dtype):
+    """Map a file written by `export_compressed_model` into a compressed state dict."""
+    from fastchat.model.safetensors_loader import SafetensorsFile, load_safetensors
+
+    info = json.loads(SafetensorsFile(filename).metadata["fastchat_compression"])
+    if info["version"] != COMPRESSED_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported compressed model version {info['version']} in {filename}"
+        )
+    config = dataclasses.asdict(default_compression_config)
+    if info["config"] != config:
+        raise ValueError(
+            f"{filename} was compressed with {info['config']}, "
+            f"but this version of FastChat uses {config}. Please export it again."
+        )
+
+    tensors = load_safetensors([filename], device, torch_dtype)
+    compressed_state_dict = {}
+    for name, shape in info["shapes"].items():
+        data = tensors.pop(f"{name}.qdata")
+        scale = tensors.pop(f"{name}.scale")
+        if config["symmetric"]:
+            compressed_state_dict[name] = (data, scale, torch.Size(shape))
+        else:
+            mn = tensors.pop(f"{name}.mn")
+            compressed_state_dict[name] = (data, mn, scale, torch.Size(shape))
+    compressed_state_dict.update(tensors)
+    return compressed_state_dict
+
+
+def load_pytorch_bin_files(files, linear_weights, device, torch_dtype):
+    compressed_state_dict = {}
+    for filename in tqdm(files):
+        tmp_state_dict = torch.load(filename, map_location=lambda storage, loc: storage)
         for name in tmp_state_dict:
             if name in linear_weights:
                 tensor = tmp_state_dict[name].to(device, dtype=torch_dtype)
@@ -207,24 +355,15 @@ def load_compress_model(model_path, device, torch_dtype, use_fast, revision="mai
                 torch.xpu.empty_cache()
             if device == "npu":
                 torch.npu.empty_cache()
-
-    for name in model.state_dict():
-        if name not in linear_weights:
-            set_module_tensor_to_device(
-                model, name, device, value=compressed_state_dict[name]
-            )
-    apply_compressed_weight(model, compressed_state_dict, device)
-
-    if torch_dtype == torch.float16:
-        model.half()
-    model.to(device)
-    model.eval()
-
-    return model, tokenizer
+    return compressed_state_dict
 
 
 def compress(tensor, config):
-    """Simulate group-wise quantization."""
+    """Group-wise quantization.
+
+    Values are stored as int8 (symmetric) or uint8 (asymmetric). With
+    `num_bits <= 4`, `8 // num_bits` values are packed into every byte.
+    """
     if not config.enabled:
         return tensor
 
@@ -262,6 +401,8 @@ def compress(tensor, config):
         scale = B / torch.max(data.abs(), dim=group_dim + 1, keepdim=True)[0]
         data = data * scale
         data = data.clamp_(-B, B).round_().to(torch.int8)
+        if num_bits <= 4:
+            data = pack_bits((data + (B + 1)).to(torch.uint8), num_bits, group_dim)
         return data, scale, original_shape
     else:
         B = 2**num_bits - 1
@@ -273,29 +414,21 @@ def compress(tensor, config):
         data.mul_(scale)
 
         data = data.clamp_(0, B).round_().to(torch.uint8)
+        if num_bits <= 4:
+            data = pack_bits(data, num_bits, group_dim)
         return data, mn, scale, original_shape
 
 
 def decompress(packed_data, config):
-    """Simulate group-wise dequantization."""
+    """Group-wise dequantization."""
     if not config.enabled:
         return packed_data
 
-    group_size, num_bits, group_dim, symmetric = (
-        config.group_size,
-        config.num_bits,
-        config.group_dim,
-        config.symmetric,
-    )
+    group_size, group_dim = config.group_size, config.group_dim
 
     # Dequantize
-    if symmetric:
-        data, scale, original_shape = packed_data
-        data = data / scale
-    else:
-        data, mn, scale, original_shape = packed_data
-        data = data / scale
-        data.add_(mn)
+    data = dequantize_groups(packed_data, config)
+    original_shape = packed_data[-1]
 
     # Unpad
     pad_len = (group_size - original_shape[group_dim] % group_size) % group_size
@@ -307,6 +440,116 @@ def decompress(packed_data, config):
         )
         data = data.reshape(padded_original_shape)
         indices = [slice(0, x) for x in original_shape]
-        return data[indices].contiguous()
+        return data[tuple(indices)].contiguous()
     else:
         return data.view(original_shape)
+
+
+def dequantize_groups(packed_data, config, out=None):
+    """Dequantize the groups of `compress` without unpadding them."""
+    if config.symmetric:
+        data, scale, _ = packed_data
+        if config.num_bits <= 4:
+            B = 2 ** (config.num_bits - 1) - 1
+            data = unpack_bits(data, config.num_bits, config.group_dim).to(
+                torch.int8
+            ) - (B + 1)
+        return torch.div(data, scale, out=out)
+    else:
+        data, mn, scale, _ = packed_data
+        if config.num_bits <= 4:
+            data = unpack_bits(data, config.num_bits, config.group_dim)
+        data = torch.div(data, scale, out=out)
+        return data.add_(mn)
+
+
+def pack_bits(data, num_bits, group_dim):
+    """Pack `8 // num_bits` unsigned values of each group into every byte."""
+    per_byte = 8 // num_bits
+    data = data.movedim(group_dim + 1, -1)
+    assert data.shape[-1] % per_byte == 0, "group_size must fill whole bytes"
+    data = data.reshape(data.shape[:-1] + (-1, per_byte))
+    packed = data[..., 0].clone()
+    for i in range(1, per_byte):
+        packed |= data[..., i] << (num_bits * i)
+    return packed.movedim(-1, group_dim + 1).contiguous()
+
+
+def unpack_bits(packed, num_bits, group_dim):
+    """Inverse of `pack_bits`."""
+    per_byte = 8 // num_bits
+    shifts = torch.arange(per_byte, dtype=torch.uint8, device=packed.device)
+    packed = packed.movedim(group_dim + 1, -1).unsqueeze(-1)
+    data = (packed >> (shifts * num_bits)) & (2**num_bits - 1)
+    return data.flatten(-2).movedim(-1, group_dim + 1)
+
+
+def can_dequantize_linear(packed_data, config):
+    return (
+        config.enabled
+        and config.group_dim == 1
+        and isinstance(packed_data, tuple)
+        and len(packed_data[-1]) == 2
+    )
+
+
+def dequantize_linear(input, packed_data, bias, config):
+    """`F.linear` with a compressed weight, dequantized tile by tile.
+
+    Rows of the weight are dequantized into a small reused buffer right before
+    they are multiplied, so the full precision weight is never materialized.
+    """
+    data, scale = packed_data[0], packed_data[-2]
+    out_features, in_features = packed_data[-1]
+    num_groups = data.shape[1]
+    padded_in_features = num_groups * config.group_size
+
+    x = input.to(scale.dtype)
+    if padded_in_features != in_features:
+        # The padding of the weight is zero, so pad the input instead of
+        # unpadding every tile.
+        x = F.pad(x, (0, padded_in_features - in_features))
+
+    rows = max(1, DEQUANT_TILE_SIZE // padded_in_features)
+    buffer = torch.empty(
+        (min(rows, out_features), num_groups, config.group_size),
+        dtype=scale.dtype,
+        device=scale.device,
+    )
+    outputs = []
+    for start in range(0, out_features, rows):
+        tile = tuple(t[start : start + rows] for t in packed_data[:-1])
+        weight = dequantize_groups(
+            tile + (None,), config, out=buffer[: tile[0].shape[0]]
+        )
+        outputs.append(F.linear(x, weight.view(-1, padded_in_features)))
+    output = torch.cat(outputs, dim=-1)
+    if bias is not None:
+        output += bias.to(output.dtype)
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Quantize a model for --load-8bit once and save the result."
+    )
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--output-path", type=str, required=True)
+    parser.add_argument("--device", type=str, choices=["cpu", "cuda"], default="cpu")
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        choices=["float32", "float16", "bfloat16"],
+        default="float16",
+        help="The dtype of the scales and of the weights that are not quantized.",
+    )
+    parser.add_argument("--revision", type=str, default="main")
+    args = parser.parse_args()
+
+    export_compressed_model(
+        args.model_path,
+        args.output_path,
+        device=args.device,
+        torch_dtype=getattr(torch, args.dtype),
+        revision=args.revision,
+    )
@@ -4,9 +4,11 @@ python3 -m fastchat.model.convert_fp16 --in in-folder --out out-folder
 """
 import argparse
 
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
 import torch
 
+from fastchat.model.checkpoint_shards import CheckpointReader, map_shards
+
 
 def convert_fp16(in_checkpoint, out_checkpoint):
     tokenizer = AutoTokenizer.from_pretrained(in_checkpoint, use_fast=False)
@@ -17,10 +19,42 @@ def convert_fp16(in_checkpoint, out_checkpoint):
     tokenizer.save_pretrained(out_checkpoint)
 
 
+def convert_fp16_low_cpu_mem(in_checkpoint, out_checkpoint, num_workers=None):
+    tokenizer = AutoTokenizer.from_pretrained(in_checkpoint, use_fast=False)
+    config = AutoConfig.from_pretrained(in_checkpoint)
+
+    def to_fp16(name, param):
+        return param.to(torch.float16) if param.is_floating_point() else param
+
+    reader = CheckpointReader(in_checkpoint)
+    map_shards(reader, to_fp16, out_checkpoint, num_workers, desc="Converting")
+    config.torch_dtype = torch.float16
+    config.save_pretrained(out_checkpoint)
+    tokenizer.save_pretrained(out_checkpoint)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--in-checkpoint", type=str, help="Path to the model")
     parser.add_argument("--out-checkpoint", type=str, help="Path to the output model")
+    parser.add_argument(
+        "--low-cpu-mem",
+        action="store_true",
+        help="Lower the cpu memory usage. This will convert the weights one shard "
+        "at a time from memory maps and write safetensors shards, using about one "
+        "shard of memory per worker.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help="The number of shards processed in parallel with --low-cpu-mem.",
+    )
     args = parser.parse_args()
 
-    convert_fp16(args.in_checkpoint, args.out_checkpoint)
+    if args.low_cpu_mem:
+        convert_fp16_low_cpu_mem(
+            args.in_checkpoint, args.out_checkpoint, args.num_workers
+        )
+    else:
+        convert_fp16(args.in_checkpoint, args.out_checkpoint)
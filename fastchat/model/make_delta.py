@@ -8,7 +8,9 @@ import argparse
 
 import torch
 from tqdm import tqdm
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM
+
+from fastchat.model.checkpoint_shards import CheckpointReader, map_shards
 
 
 def make_delta(base_model_path, target_model_path, delta_path):
@@ -37,12 +39,61 @@ def make_delta(base_model_path, target_model_path, delta_path):
     target_tokenizer.save_pretrained(delta_path, **kwargs)
 
 
+def make_delta_low_cpu_mem(
+    base_model_path, target_model_path, delta_path, hub_repo_id=None, num_workers=None
+):
+    target_tokenizer = AutoTokenizer.from_pretrained(target_model_path, use_fast=False)
+    target_config = AutoConfig.from_pretrained(target_model_path)
+
+    base = CheckpointReader(base_model_path)
+    target = CheckpointReader(target_model_path)
+
+    def subtract_base(name, param):
+        assert name in base, f"{name} is missing from the base weights"
+        return param.to(torch.float16) - base.get_tensor(name).to(torch.float16)
+
+    print("Calculating the delta")
+    map_shards(target, subtract_base, delta_path, num_workers, desc="Calculating delta")
+
+    print(f"Saving the delta to {delta_path}")
+    target_tokenizer.save_pretrained(delta_path)
+    target_config.save_pretrained(delta_path)
+    if hub_repo_id:
+        from huggingface_hub import HfApi
+
+        api = HfApi()
+        api.create_repo(hub_repo_id, exist_ok=True)
+        api.upload_folder(folder_path=delta_path, repo_id=hub_repo_id)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--base-model-path", type=str, required=True)
     parser.add_argument("--target-model-path", type=str, required=True)
     parser.add_argument("--delta-path", type=str, required=True)
     parser.add_argument("--hub-repo-id", type=str)
+    parser.add_argument(
+        "--low-cpu-mem",
+        action="store_true",
+        help="Lower the cpu memory usage. This will read the weights one shard "
+        "at a time from memory maps and write safetensors shards, using about one "
+        "shard of memory per worker.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help="The number of shards processed in parallel with --low-cpu-mem.",
+    )
     args = parser.parse_args()
 
-    make_delta(args.base_model_path, args.target_model_path, args.delta_path)
+    if args.low_cpu_mem:
+        make_delta_low_cpu_mem(
+            args.base_model_path,
+            args.target_model_path,
+            args.delta_path,
+            args.hub_repo_id,
+            args.num_workers,
+        )
+    else:
+        make_delta(args.base_model_path, args.target_model_path, args.delta_path)
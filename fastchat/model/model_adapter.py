@@ -4,7 +4,7 @@ import math
 import os
 import re
 import sys
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, TYPE_CHECKING
 import warnings
 
 if sys.version_info >= (3, 9):
@@ -12,39 +12,17 @@ if sys.version_info >= (3, 9):
 else:
     from functools import lru_cache as cache
 
-import psutil
-import torch
-from transformers import (
-    AutoConfig,
-    AutoModel,
-    AutoModelForCausalLM,
-    AutoModelForSeq2SeqLM,
-    AutoTokenizer,
-    LlamaTokenizer,
-    LlamaForCausalLM,
-    T5Tokenizer,
-)
-
-from fastchat.constants import CPU_ISA
 from fastchat.conversation import Conversation, get_conv_template
-from fastchat.model.compression import load_compress_model
-from fastchat.model.llama_condense_monkey_patch import replace_llama_with_condense
-from fastchat.model.model_chatglm import generate_stream_chatglm
-from fastchat.model.model_codet5p import generate_stream_codet5p
-from fastchat.model.model_falcon import generate_stream_falcon
-from fastchat.model.model_yuan2 import generate_stream_yuan2
-from fastchat.model.model_exllama import generate_stream_exllama
-from fastchat.model.model_xfastertransformer import generate_stream_xft
-from fastchat.model.model_cllm import generate_stream_cllm
-
-from fastchat.model.monkey_patch_non_inplace import (
-    replace_llama_attn_with_non_inplace_operations,
-)
-from fastchat.modules.awq import AWQConfig, load_awq_quantized
-from fastchat.modules.exllama import ExllamaConfig, load_exllama_model
-from fastchat.modules.xfastertransformer import load_xft_model, XftConfig
-from fastchat.modules.gptq import GptqConfig, load_gptq_quantized
-from fastchat.utils import get_gpu_memory
+
+# Heavy dependencies are imported where they are used, so that looking up a
+# conversation template does not load torch or transformers.
+if TYPE_CHECKING:
+    import torch
+
+    from fastchat.modules.awq import AWQConfig
+    from fastchat.modules.exllama import ExllamaConfig
+    from fastchat.modules.xfastertransformer import XftConfig
+    from fastchat.modules.gptq import GptqConfig
 
 # Check an environment variable to check if we should be sharing Peft model
 # weights.  When false we treat all Peft models as separate.
@@ -97,6 +75,8 @@ class BaseModelAdapter:
         return True
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         try:
             tokenizer = AutoTokenizer.from_pretrained(
@@ -126,6 +106,8 @@ class BaseModelAdapter:
         return model, tokenizer
 
     def load_compress_model(self, model_path, device, torch_dtype, revision="main"):
+        from fastchat.model.compression import load_compress_model
+
         return load_compress_model(
             model_path,
             device,
@@ -197,22 +179,38 @@ def load_model(
     device: str = "cuda",
     num_gpus: int = 1,
     max_gpu_memory: Optional[str] = None,
-    dtype: Optional[torch.dtype] = None,
+    dtype: Optional["torch.dtype"] = None,
     load_8bit: bool = False,
     cpu_offloading: bool = False,
-    gptq_config: Optional[GptqConfig] = None,
-    awq_config: Optional[AWQConfig] = None,
-    exllama_config: Optional[ExllamaConfig] = None,
-    xft_config: Optional[XftConfig] = None,
+    gptq_config: Optional["GptqConfig"] = None,
+    awq_config: Optional["AWQConfig"] = None,
+    exllama_config: Optional["ExllamaConfig"] = None,
+    xft_config: Optional["XftConfig"] = None,
     revision: str = "main",
     debug: bool = False,
 ):
     """Load a model from Hugging Face."""
+    import psutil
+    import torch
+    from fastchat.constants import CPU_ISA
+    from fastchat.model.compression import COMPRESSED_WEIGHTS_NAME
+    from fastchat.model.monkey_patch_non_inplace import (
+        replace_llama_attn_with_non_inplace_operations,
+    )
+    from fastchat.modules.awq import load_awq_quantized
+    from fastchat.modules.exllama import load_exllama_model
+    from fastchat.modules.xfastertransformer import load_xft_model
+    from fastchat.modules.gptq import load_gptq_quantized
+    from fastchat.utils import get_gpu_memory
     import accelerate
 
     # get model adapter
     adapter = get_model_adapter(model_path)
 
+    # A model exported by `python3 -m fastchat.model.compression` is already quantized
+    if os.path.isfile(os.path.join(model_path, COMPRESSED_WEIGHTS_NAME)):
+        load_8bit = True
+
     # Handle device mapping
     cpu_offloading = raise_warning_for_incompatible_cpu_offloading_configuration(
         device, load_8bit, cpu_offloading
@@ -395,8 +393,16 @@ def get_conversation_template(model_path: str) -> Conversation:
     return adapter.get_default_conv_template(model_path)
 
 
-def get_generate_stream_function(model: torch.nn.Module, model_path: str):
+def get_generate_stream_function(model: "torch.nn.Module", model_path: str):
     """Get the generate_stream function for inference."""
+    import torch
+    from fastchat.model.model_chatglm import generate_stream_chatglm
+    from fastchat.model.model_codet5p import generate_stream_codet5p
+    from fastchat.model.model_falcon import generate_stream_falcon
+    from fastchat.model.model_yuan2 import generate_stream_yuan2
+    from fastchat.model.model_exllama import generate_stream_exllama
+    from fastchat.model.model_xfastertransformer import generate_stream_xft
+    from fastchat.model.model_cllm import generate_stream_cllm
     from fastchat.serve.inference import generate_stream
 
     model_type = str(type(model)).lower()
@@ -702,6 +708,8 @@ class VicunaAdapter(BaseModelAdapter):
         return "vicuna" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, use_fast=self.use_fast_tokenizer, revision=revision
@@ -720,6 +728,8 @@ class VicunaAdapter(BaseModelAdapter):
         return get_conv_template("vicuna_v1.1")
 
     def raise_warning_for_old_weights(self, model):
+        from transformers import LlamaForCausalLM
+
         if isinstance(model, LlamaForCausalLM) and model.model.vocab_size > 32000:
             warnings.warn(
                 "\nYou are probably using the old Vicuna-v0 model, "
@@ -747,6 +757,8 @@ class AiroborosAdapter(BaseModelAdapter):
         return get_conv_template("airoboros_v1")
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         if "mpt" not in model_path.lower():
             return super().load_model(model_path, from_pretrained_kwargs)
         model = AutoModelForCausalLM.from_pretrained(
@@ -771,6 +783,11 @@ class LongChatAdapter(BaseModelAdapter):
         return "longchat" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+        from fastchat.model.llama_condense_monkey_patch import (
+            replace_llama_with_condense,
+        )
+
         revision = from_pretrained_kwargs.get("revision", "main")
 
         # Apply monkey patch, TODO(Dacheng): Add flash attention support
@@ -801,6 +818,8 @@ class GoogleT5Adapter(BaseModelAdapter):
         )
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForSeq2SeqLM, T5Tokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = T5Tokenizer.from_pretrained(model_path, revision=revision)
         model = AutoModelForSeq2SeqLM.from_pretrained(
@@ -843,6 +862,8 @@ class ChatGLMAdapter(BaseModelAdapter):
         return "chatglm" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         if "chatglm3" in model_path.lower():
             tokenizer = AutoTokenizer.from_pretrained(
@@ -876,6 +897,8 @@ class CodeGeexAdapter(BaseModelAdapter):
         return "codegeex" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, trust_remote_code=True, revision=revision
@@ -896,6 +919,8 @@ class DollyV2Adapter(BaseModelAdapter):
         return "dolly-v2" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(model_path, revision=revision)
         model = AutoModelForCausalLM.from_pretrained(
@@ -1000,6 +1025,8 @@ class MPTAdapter(BaseModelAdapter):
         return "mpt" in model_path and not "airoboros" in model_path
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
@@ -1050,6 +1077,8 @@ class RwkvAdapter(BaseModelAdapter):
         return "rwkv-4" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoTokenizer
+
         from fastchat.model.rwkv_model import RwkvModel
 
         model = RwkvModel(model_path)
@@ -1092,6 +1121,8 @@ class ReaLMAdapter(BaseModelAdapter):
         return "ReaLM" in model_path
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
         model = AutoModelForCausalLM.from_pretrained(
             model_path, low_cpu_mem_usage=True, **from_pretrained_kwargs
@@ -1242,6 +1273,8 @@ class RedPajamaINCITEAdapter(BaseModelAdapter):
         return "redpajama-incite" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(model_path, revision=revision)
         model = AutoModelForCausalLM.from_pretrained(
@@ -1331,6 +1364,8 @@ class GuanacoAdapter(BaseModelAdapter):
         return "guanaco" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, use_fast=self.use_fast_tokenizer, revision=revision
@@ -1388,6 +1423,8 @@ class FalconAdapter(BaseModelAdapter):
         return "falcon" in model_path.lower() and "chat" not in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         # Strongly suggest using bf16, which is recommended by the author of Falcon
         tokenizer = AutoTokenizer.from_pretrained(model_path, revision=revision)
@@ -1421,6 +1458,8 @@ class TigerBotAdapter(BaseModelAdapter):
         return "tigerbot" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -1446,6 +1485,8 @@ class BaichuanAdapter(BaseModelAdapter):
         return "baichuan" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, trust_remote_code=True, revision=revision
@@ -1474,6 +1515,8 @@ class XGenAdapter(BaseModelAdapter):
         return "xgen" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
@@ -1510,6 +1553,8 @@ class InternLMChatAdapter(BaseModelAdapter):
         return "internlm" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
@@ -1594,6 +1639,8 @@ class CuteGPTAdapter(BaseModelAdapter):
         return "cutegpt" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, LlamaTokenizer
+
         tokenizer = LlamaTokenizer.from_pretrained(model_path)
         model = AutoModelForCausalLM.from_pretrained(
             model_path, low_cpu_mem_usage=True, **from_pretrained_kwargs
@@ -1626,6 +1673,8 @@ class OpenOrcaAdapter(BaseModelAdapter):
         )
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, use_fast=self.use_fast_tokenizer, revision=revision
@@ -1665,6 +1714,8 @@ class Hermes2Adapter(BaseModelAdapter):
         )
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path, use_fast=self.use_fast_tokenizer, revision=revision
@@ -1746,6 +1797,7 @@ class QwenChatAdapter(BaseModelAdapter):
             print("Invalid option. Please choose one from 'bf16', 'fp16' and 'fp32'.")
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
         from transformers.generation import GenerationConfig
 
         revision = from_pretrained_kwargs.get("revision", "main")
@@ -1803,6 +1855,8 @@ class BGEAdapter(BaseModelAdapter):
         return "bge" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModel.from_pretrained(
             model_path,
@@ -1834,6 +1888,8 @@ class E5Adapter(BaseModelAdapter):
         return "e5-" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModel, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModel.from_pretrained(
             model_path,
@@ -1867,6 +1923,8 @@ class AquilaChatAdapter(BaseModelAdapter):
         return "aquila" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         model = AutoModelForCausalLM.from_pretrained(
             model_path,
@@ -1901,6 +1959,8 @@ class Lamma2ChineseAdapter(BaseModelAdapter):
         return "llama2-chinese" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -1926,6 +1986,8 @@ class Lamma2ChineseAlpacaAdapter(BaseModelAdapter):
         return "chinese-alpaca" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -1953,6 +2015,8 @@ class VigogneAdapter(BaseModelAdapter):
         return bool(re.search(r"vigogne|vigostral", model_path, re.I))
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -1987,6 +2051,8 @@ class OpenLLaMaOpenInstructAdapter(BaseModelAdapter):
         )
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         tokenizer = AutoTokenizer.from_pretrained(
             model_path,
@@ -2212,6 +2278,8 @@ class Yuan2Adapter(BaseModelAdapter):
         return "yuan2" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        from transformers import AutoModelForCausalLM, LlamaTokenizer
+
         revision = from_pretrained_kwargs.get("revision", "main")
         # from_pretrained_kwargs["torch_dtype"] = torch.bfloat16
         tokenizer = LlamaTokenizer.from_pretrained(
@@ -2385,6 +2453,9 @@ class CllmAdapter(BaseModelAdapter):
         return "consistency-llm" in model_path.lower()
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
+        import torch
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
         config = AutoConfig.from_pretrained(
             model_path,
         )
@@ -72,6 +72,8 @@ def generate_stream_chatglm(
     stream_interval=2,
     judge_sent_end=False,
 ):
+    if params.get("input_ids") is not None:
+        raise ValueError("This model only accepts text prompts, not input_ids.")
     prompt = params["prompt"]
     temperature = float(params.get("temperature", 1.0))
     repetition_penalty = float(params.get("repetition_penalty", 1.0))
@@ -116,6 +116,8 @@ def generate_stream_cllm(
     judge_sent_end=False,
 ):
     # converge_step = []
+    if params.get("input_ids") is not None:
+        raise ValueError("This model only accepts text prompts, not input_ids.")
     prompt = params["prompt"]
     inputs = tokenizer(prompt, return_tensors="pt").to(device)
     max_new_tokens = int(params.get("n_token_seq_length", 32))
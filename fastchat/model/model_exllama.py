@@ -20,6 +20,8 @@ def generate_stream_exllama(
         print(f"Error: Failed to load Exllamav2. {e}")
         sys.exit(-1)
 
+    if params.get("input_ids") is not None:
+        raise ValueError("This model only accepts text prompts, not input_ids.")
     prompt = params["prompt"]
 
     generator = ExLlamaV2StreamingGenerator(model.model, model.cache, tokenizer)
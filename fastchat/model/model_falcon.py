@@ -19,6 +19,8 @@ def generate_stream_falcon(
     stream_interval=2,
     judge_sent_end=False,
 ):
+    if params.get("input_ids") is not None:
+        raise ValueError("This model only accepts text prompts, not input_ids.")
     prompt = params["prompt"]
     len_prompt = len(prompt)
     temperature = float(params.get("temperature", 1.0))
@@ -15,6 +15,8 @@ def generate_stream_xft(
     stream_interval=2,
     judge_sent_end=False,
 ):
+    if params.get("input_ids") is not None:
+        raise ValueError("This model only accepts text prompts, not input_ids.")
     prompt = params["prompt"]
     repetition_penalty = float(params.get("repetition_penalty", 1.0))
 
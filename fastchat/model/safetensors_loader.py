@@ -0,0 +1,103 @@
+"""
+Load safetensors checkpoints through memory maps.
+
+Each shard is mapped copy-on-write and its tensors are created as views of the
+mapping, so no bytes are read until a tensor is used and unchanged CPU tensors
+keep sharing the page cache with every other process that maps the same file.
+Shards are materialized on their target device and dtype concurrently by a
+thread pool; torch releases the GIL during copies and conversions.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import mmap
+import os
+import struct
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class SafetensorsFile:
+    """A read-only view of a safetensors file backed by a memory map."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            # ACCESS_COPY gives writable buffers without ever writing to the file.
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        (header_len,) = struct.unpack("<Q", self.mmap[:8])
+        header = json.loads(self.mmap[8 : 8 + header_len])
+        self.metadata = header.pop("__metadata__", None) or {}
+        self.entries = header
+        self.data_start = 8 + header_len
+
+    def keys(self) -> List[str]:
+        return list(self.entries)
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        """Return a tensor that aliases the mapped file without copying it."""
+        info = self.entries[name]
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+        if dtype is None:
+            raise ValueError(f"Unsupported dtype {info['dtype']} of {name}")
+        start, end = info["data_offsets"]
+        shape = info["shape"]
+        if start == end:
+            return torch.empty(shape, dtype=dtype)
+        return torch.frombuffer(
+            self.mmap,
+            dtype=dtype,
+            count=(end - start) // dtype.itemsize,
+            offset=self.data_start + start,
+        ).view(shape)
+
+
+def load_safetensors(
+    files: List[str],
+    device: str = "cpu",
+    dtype: Optional[torch.dtype] = None,
+    transform: Optional[Callable[[str, torch.Tensor], object]] = None,
+    num_threads: Optional[int] = None,
+) -> Dict[str, object]:
+    """Load safetensors shards concurrently into one state dict.
+
+    Floating point tensors are converted to `dtype` (if given) with a single
+    copy onto `device`; tensors already on the right device and dtype stay
+    views of the mapped file. `transform(name, tensor)`, if given, runs in the
+    loading thread and its result is stored instead of the tensor.
+    """
+
+    def load_shard(filename):
+        shard = SafetensorsFile(filename)
+        state_dict = {}
+        for name in shard.keys():
+            tensor = shard.get_tensor(name)
+            if dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(device=device, dtype=dtype)
+            else:
+                tensor = tensor.to(device=device)
+            if transform is not None:
+                tensor = transform(name, tensor)
+            state_dict[name] = tensor
+        return state_dict
+
+    if num_threads is None:
+        num_threads = min(len(files), os.cpu_count() or 1)
+    state_dict = {}
+    with ThreadPoolExecutor(max(1, num_threads)) as executor:
+        for shard_state_dict in executor.map(load_shard, files):
+            state_dict.update(shard_state_dict)
+    return state_dict
@@ -1,11 +1,23 @@
 from typing import Literal, Optional, List, Dict, Any, Union
 
+import json
 import time
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import shortuuid
 from pydantic import BaseModel, Field
 
 
+def json_dumps_bytes(obj: Any) -> bytes:
+    """Serialize a plain python object to compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
 class ErrorResponse(BaseModel):
     object: str = "error"
     message: str
@@ -197,3 +209,100 @@ class CompletionStreamResponse(BaseModel):
     created: int = Field(default_factory=lambda: int(time.time()))
     model: str
     choices: List[CompletionResponseStreamChoice]
+
+
+class StreamChunkEncoder:
+    """Encode server-sent events for one streaming response.
+
+    Building a pydantic response object for every generated token is expensive.
+    The JSON around the delta text never changes within a stream, so it is
+    rendered once into byte prefixes and suffixes and only the escaped text is
+    spliced in. The output is byte-for-byte identical to
+    `model_dump_json(exclude_unset=True)` of the corresponding stream response.
+    """
+
+    DONE = b"data: [DONE]\n\n"
+
+    def __init__(self, id: str, model: str, object: Optional[str] = None):
+        self.id = id
+        self.model = model
+        head = {"id": id}
+        if object is not None:
+            head["object"] = object
+        head["model"] = model
+        # Drop the closing brace so that the choices can be appended.
+        self._head = b"data: " + json_dumps_bytes(head)[:-1] + b',"choices":[{"index":'
+        self._prefixes = {}
+        self._suffixes = {}
+
+    def _prefix(self, index: int, field: bytes) -> bytes:
+        key = (index, field)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            prefix = self._head + str(index).encode() + field
+            self._prefixes[key] = prefix
+        return prefix
+
+    def _suffix(self, finish_reason: Optional[str], field: bytes) -> bytes:
+        key = (finish_reason, field)
+        suffix = self._suffixes.get(key)
+        if suffix is None:
+            suffix = field + json_dumps_bytes(finish_reason) + b"}]}\n\n"
+            self._suffixes[key] = suffix
+        return suffix
+
+    def chat_delta(
+        self, index: int, content: str, finish_reason: Optional[str] = None
+    ) -> bytes:
+        """Encode a `ChatCompletionStreamResponse` chunk carrying `content`."""
+        return b"".join(
+            (
+                self._prefix(index, b',"delta":{"content":'),
+                json_dumps_bytes(content),
+                self._suffix(finish_reason, b'},"finish_reason":'),
+            )
+        )
+
+    def completion_delta(
+        self,
+        index: int,
+        text: str,
+        logprobs: Optional[Dict[str, Any]] = None,
+        finish_reason: Optional[str] = None,
+    ) -> bytes:
+        """Encode a `CompletionStreamResponse` chunk carrying `text`."""
+        if logprobs is not None:
+            # Rare path: serialize like the nested model in `model_dump_json`.
+            logprobs_bytes = (
+                LogProbs(**logprobs).model_dump_json(exclude_unset=True).encode()
+            )
+        else:
+            logprobs_bytes = b"null"
+        return b"".join(
+            (
+                self._prefix(index, b',"text":'),
+                json_dumps_bytes(text),
+                b',"logprobs":',
+                logprobs_bytes,
+                self._suffix(finish_reason, b',"finish_reason":'),
+            )
+        )
+
+    def chat_finish(self, index: int, finish_reason: Optional[str]) -> bytes:
+        """Encode the final chat chunk, which has an empty delta."""
+        return self.event(
+            {
+                "id": self.id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": self.model,
+                "choices": [
+                    {"index": index, "delta": {}, "finish_reason": finish_reason}
+                ],
+            }
+        )
+
+    @staticmethod
+    def event(obj: Any) -> bytes:
+        """Encode a full object (e.g. a plain dict) as one event."""
+        return b"data: " + json_dumps_bytes(obj) + b"\n\n"
@@ -0,0 +1,294 @@
+"""
+Admission control for the OpenAI-compatible API server.
+
+Every request is mapped to a priority class through its API key. A class has a
+token-bucket rate limit and a maximum queueing delay. Admitted requests run
+while the gateway has free slots; the number of slots follows the capacity the
+workers report through `/worker_get_status`. Other requests wait in a bounded
+priority queue. A request is shed with HTTP 429 and a `Retry-After` header when
+it is over its rate limit, when it would miss its queueing deadline, or when the
+queue is full and only lower-priority requests can be dropped to make room.
+"""
+import asyncio
+import dataclasses
+import heapq
+import itertools
+import json
+import math
+import time
+from typing import Dict, List, Optional
+
+from fastchat.constants import ErrorCode
+
+
+@dataclasses.dataclass
+class PriorityClass:
+    name: str
+    # Lower values are served first.
+    priority: int = 1
+    # Sustained requests per second per API key. 0 means unlimited.
+    rate: float = 0.0
+    # Bucket size of the rate limit. Defaults to one second of `rate`.
+    burst: Optional[float] = None
+    # Maximum time in seconds a request may wait in the gateway queue.
+    max_queue_time: float = 30.0
+
+
+DEFAULT_CLASS = PriorityClass(name="default")
+
+
+class AdmissionRejected(Exception):
+    def __init__(
+        self,
+        message: str,
+        retry_after: float,
+        code: int = ErrorCode.ENGINE_OVERLOADED,
+    ):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+        self.code = code
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def try_acquire(self) -> float:
+        """Take one token. Returns 0 on success or the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+@dataclasses.dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    deadline: float = dataclasses.field(compare=False)
+    future: asyncio.Future = dataclasses.field(compare=False)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        capacity: int,
+        max_queue_size: int,
+        classes: Optional[List[PriorityClass]] = None,
+        key_classes: Optional[Dict[str, str]] = None,
+        default_class: str = "default",
+    ):
+        self.capacity = capacity
+        self.max_queue_size = max_queue_size
+        self.classes = {c.name: c for c in classes or []}
+        self.classes.setdefault(DEFAULT_CLASS.name, DEFAULT_CLASS)
+        self.key_classes = key_classes or {}
+        self.default_class = default_class
+
+        self.in_flight = 0
+        self.queue: List[_Waiter] = []
+        self.buckets: Dict[Optional[str], TokenBucket] = {}
+        self.seq = itertools.count()
+        # Moving average of how long an admitted request holds its slot.
+        self.avg_service_time = 1.0
+        self.num_rejected = 0
+
+    def get_class(self, api_key: Optional[str]) -> PriorityClass:
+        return self.classes[self.key_classes.get(api_key, self.default_class)]
+
+    def set_capacity(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._dispatch()
+
+    async def acquire(self, api_key: Optional[str]) -> float:
+        """Wait for a slot. Returns the admission time, to be passed to `release`."""
+        cls = self.get_class(api_key)
+        self._check_rate_limit(api_key, cls)
+
+        if self.in_flight < self.capacity and not self.queue:
+            self.in_flight += 1
+            return time.monotonic()
+
+        estimated_wait = self._estimate_wait(cls.priority)
+        if estimated_wait > cls.max_queue_time:
+            self._reject(
+                f"Server is overloaded. Estimated queueing time {estimated_wait:.1f}s "
+                f"exceeds the limit of class '{cls.name}'.",
+                estimated_wait,
+            )
+        if len(self.queue) >= self.max_queue_size:
+            self._shed_lowest_priority(cls.priority)
+
+        waiter = _Waiter(
+            cls.priority,
+            next(self.seq),
+            time.monotonic() + cls.max_queue_time,
+            asyncio.get_running_loop().create_future(),
+        )
+        heapq.heappush(self.queue, waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), cls.max_queue_time)
+        except asyncio.TimeoutError:
+            # The slot may have been granted, or the request shed, just as the
+            # wait timed out. A shed request was already counted as rejected.
+            if not waiter.future.done():
+                self._remove(waiter)
+                self._reject(
+                    f"Server is overloaded. Request waited longer than "
+                    f"{cls.max_queue_time}s.",
+                    self._estimate_wait(cls.priority),
+                )
+        except asyncio.CancelledError:
+            # The client went away. Give the slot back if it was just granted.
+            if waiter.future.done() and not waiter.future.exception():
+                self.release(time.monotonic())
+            else:
+                self._remove(waiter)
+            raise
+        # Raises AdmissionRejected if the waiter was shed while queued.
+        waiter.future.result()
+        return time.monotonic()
+
+    def release(self, admitted_at: float):
+        service_time = time.monotonic() - admitted_at
+        self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * service_time
+        self.in_flight -= 1
+        self._dispatch()
+
+    def get_stats(self) -> Dict:
+        return {
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "queue_length": len(self.queue),
+            "avg_service_time": self.avg_service_time,
+            "num_rejected": self.num_rejected,
+        }
+
+    def _check_rate_limit(self, api_key: Optional[str], cls: PriorityClass):
+        if cls.rate <= 0:
+            return
+        bucket = self.buckets.get(api_key)
+        if bucket is None:
+            burst = cls.burst if cls.burst is not None else max(1.0, cls.rate)
+            bucket = self.buckets[api_key] = TokenBucket(cls.rate, burst)
+        retry_after = bucket.try_acquire()
+        if retry_after > 0:
+            self._reject(
+                f"Rate limit of class '{cls.name}' ({cls.rate} requests/s) reached.",
+                retry_after,
+                code=ErrorCode.RATE_LIMIT,
+            )
+
+    def _estimate_wait(self, priority: int) -> float:
+        ahead = sum(1 for w in self.queue if w.priority <= priority)
+        return (ahead + 1) * self.avg_service_time / max(1, self.capacity)
+
+    def _shed_lowest_priority(self, priority: int):
+        victim = max(self.queue) if self.queue else None
+        if victim is None or victim.priority <= priority:
+            self._reject(
+                "Server is overloaded. The request queue is full.",
+                self._estimate_wait(priority),
+            )
+        self._remove(victim)
+        self.num_rejected += 1
+        victim.future.set_exception(
+            AdmissionRejected(
+                "Server is overloaded. Request was preempted by higher priority traffic.",
+                self._estimate_wait(victim.priority),
+            )
+        )
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.queue and self.in_flight < self.capacity:
+            waiter = heapq.heappop(self.queue)
+            if waiter.future.done() or waiter.deadline < now:
+                continue
+            self.in_flight += 1
+            waiter.future.set_result(None)
+
+    def _remove(self, waiter: _Waiter):
+        try:
+            self.queue.remove(waiter)
+            heapq.heapify(self.queue)
+        except ValueError:
+            pass
+
+    def _reject(
+        self, message: str, retry_after: float, code: int = ErrorCode.ENGINE_OVERLOADED
+    ):
+        self.num_rejected += 1
+        raise AdmissionRejected(message, retry_after, code)
+
+
+def parse_priority_classes(config: Dict[str, Dict]) -> List[PriorityClass]:
+    """Build classes from a mapping like {"batch": {"priority": 2, "rate": 1}}."""
+    return [PriorityClass(name=name, **fields) for name, fields in config.items()]
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that holds an admission slot for the whole response.
+
+    Slots are released only after the last byte is sent, so streaming
+    responses count against the capacity for their full duration.
+    """
+
+    def __init__(self, app, controller: AdmissionController, path_prefixes):
+        self.app = app
+        self.controller = controller
+        self.path_prefixes = tuple(path_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            admitted_at = await self.controller.acquire(self._get_api_key(scope))
+        except AdmissionRejected as e:
+            await self._send_rejection(send, e)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(admitted_at)
+
+    @staticmethod
+    def _get_api_key(scope) -> Optional[str]:
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, credentials = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer":
+                    return credentials.strip()
+        return None
+
+    @staticmethod
+    async def _send_rejection(send, e: AdmissionRejected):
+        body = json.dumps(
+            {
+                "object": "error",
+                "message": e.message,
+                "code": int(e.code),
+            }
+        ).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(max(1, math.ceil(e.retry_after))).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
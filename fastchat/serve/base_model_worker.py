@@ -4,10 +4,10 @@ import time
 from typing import List
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 import requests
 
-from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
+from fastchat.constants import EMBEDDING_MEDIA_TYPE, WORKER_HEART_BEAT_INTERVAL
 from fastchat.conversation import Conversation
 from fastchat.utils import pretty_print_semaphore, build_logger
 
@@ -147,11 +147,14 @@ class BaseModelWorker:
             "model_names": self.model_names,
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            "capacity": self.limit_worker_concurrency,
         }
 
     def count_token(self, params):
-        prompt = params["prompt"]
+        if params.get("input_ids") is not None:
+            return {"count": len(params["input_ids"]), "error_code": 0}
 
+        prompt = params["prompt"]
         try:
             input_ids = self.tokenizer(prompt).input_ids
             input_echo_len = len(input_ids)
@@ -187,6 +190,22 @@ def acquire_worker_semaphore():
     return worker.semaphore.acquire()
 
 
+def create_embedding_response(embedding, background=None):
+    """Send packed embeddings as raw bytes and everything else as JSON."""
+    if isinstance(embedding.get("embedding"), bytes):
+        return Response(
+            content=embedding["embedding"],
+            media_type=EMBEDDING_MEDIA_TYPE,
+            headers={
+                "X-Embedding-Shape": ",".join(map(str, embedding["shape"])),
+                "X-Embedding-Dtype": embedding["dtype"],
+                "X-Token-Num": str(embedding["token_num"]),
+            },
+            background=background,
+        )
+    return JSONResponse(content=embedding, background=background)
+
+
 def create_background_tasks():
     background_tasks = BackgroundTasks()
     background_tasks.add_task(release_worker_semaphore)
@@ -217,7 +236,7 @@ async def api_get_embeddings(request: Request):
     await acquire_worker_semaphore()
     embedding = worker.get_embeddings(params)
     release_worker_semaphore()
-    return JSONResponse(content=embedding)
+    return create_embedding_response(embedding)
 
 
 @app.post("/worker_get_status")
@@ -15,7 +15,6 @@ import threading
 
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
-import numpy as np
 import requests
 import uvicorn
 
@@ -53,6 +52,8 @@ class WorkerInfo:
     check_heart_beat: bool
     last_heart_beat: str
     multimodal: bool
+    # Per-model queue lengths and residency reported by multi-model workers.
+    model_status: dict = dataclasses.field(default_factory=dict)
 
 
 def heart_beat_controller(controller):
@@ -96,6 +97,7 @@ class Controller:
             check_heart_beat,
             time.time(),
             multimodal,
+            worker_status.get("model_status", {}),
         )
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
@@ -155,6 +157,8 @@ class Controller:
 
     def get_worker_address(self, model_name: str):
         if self.dispatch_method == DispatchMethod.LOTTERY:
+            import numpy as np
+
             worker_names = []
             worker_speeds = []
             for w_name, w_info in self.worker_info.items():
@@ -193,12 +197,19 @@ class Controller:
             for w_name, w_info in self.worker_info.items():
                 if model_name in w_info.model_names:
                     worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
+                    # Prefer workers that do not have to page the model in.
+                    model_status = w_info.model_status.get(model_name, {})
+                    swap_in = not model_status.get("resident", True)
+                    queue_length = model_status.get("queue_length", w_info.queue_length)
+                    worker_qlen.append((swap_in, queue_length / w_info.speed))
             if len(worker_names) == 0:
                 return ""
-            min_index = np.argmin(worker_qlen)
+            min_index = worker_qlen.index(min(worker_qlen))
             w_name = worker_names[min_index]
             self.worker_info[w_name].queue_length += 1
+            model_status = self.worker_info[w_name].model_status.get(model_name)
+            if model_status and "queue_length" in model_status:
+                model_status["queue_length"] += 1
             logger.info(
                 f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}"
             )
@@ -206,12 +217,16 @@ class Controller:
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
+    def receive_heart_beat(
+        self, worker_name: str, queue_length: int, model_status: dict = None
+    ):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
         self.worker_info[worker_name].queue_length = queue_length
+        if model_status is not None:
+            self.worker_info[worker_name].model_status = model_status
         self.worker_info[worker_name].last_heart_beat = time.time()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
@@ -248,6 +263,7 @@ class Controller:
         model_names = set()
         speed = 0
         queue_length = 0
+        capacity = 0
 
         for w_name in self.worker_info:
             worker_status = self.get_worker_status(w_name)
@@ -255,12 +271,14 @@ class Controller:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
                 queue_length += worker_status["queue_length"]
+                capacity += worker_status.get("capacity", 0)
 
         model_names = sorted(list(model_names))
         return {
             "model_names": model_names,
             "speed": speed,
             "queue_length": queue_length,
+            "capacity": capacity,
         }
 
     def worker_api_generate_stream(self, params):
@@ -329,7 +347,9 @@ async def get_worker_address(request: Request):
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
-    exist = controller.receive_heart_beat(data["worker_name"], data["queue_length"])
+    exist = controller.receive_heart_beat(
+        data["worker_name"], data["queue_length"], data.get("model_status")
+    )
     return {"exist": exist}
 
 
@@ -0,0 +1,92 @@
+"""
+Weighted-fair sharing of a worker's concurrency slots between its models.
+
+The multi-model worker runs several models on one device. Every model has its
+own queue, an optional concurrency limit and a weight. When a slot frees up,
+the next request is taken from the model with the smallest start-time-fair
+tag, so a busy model gets at most its weighted share of the slots while other
+models have requests waiting, and can use every slot when they don't.
+"""
+import asyncio
+import collections
+import dataclasses
+from typing import Deque, Dict, Optional
+
+
+@dataclasses.dataclass
+class _Waiter:
+    tag: float
+    future: asyncio.Future
+
+
+class FairScheduler:
+    def __init__(
+        self,
+        capacity: int,
+        weights: Dict[str, float],
+        model_capacity: Optional[int] = None,
+    ):
+        self.capacity = capacity
+        self.weights = weights
+        self.model_capacity = model_capacity or capacity
+
+        self.in_flight = collections.Counter()
+        self.queues: Dict[str, Deque[_Waiter]] = {
+            name: collections.deque() for name in weights
+        }
+        # Start-time fair queuing: the virtual time is the tag of the request
+        # last started; each model's next tag follows its previous one.
+        self.virtual_time = 0.0
+        self.last_finish = collections.Counter()
+
+    async def acquire(self, name: str):
+        """Wait for a slot for a request to model `name`."""
+        tag = max(self.virtual_time, self.last_finish[name])
+        self.last_finish[name] = tag + 1 / self.weights[name]
+
+        waiter = _Waiter(tag, asyncio.get_running_loop().create_future())
+        self.queues[name].append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # The client went away. Give the slot back if it was just granted.
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(name)
+            else:
+                self.queues[name].remove(waiter)
+            raise
+
+    def release(self, name: str):
+        self.in_flight[name] -= 1
+        self._dispatch()
+
+    def get_queue_length(self, name: Optional[str] = None) -> int:
+        """Requests running or waiting, for one model or for all of them."""
+        if name is None:
+            return sum(self.in_flight.values()) + sum(map(len, self.queues.values()))
+        return self.in_flight[name] + len(self.queues[name])
+
+    def _can_start(self, name: str) -> bool:
+        return (
+            sum(self.in_flight.values()) < self.capacity
+            and self.in_flight[name] < self.model_capacity
+        )
+
+    def _start(self, name: str, tag: float):
+        self.in_flight[name] += 1
+        self.virtual_time = max(self.virtual_time, tag)
+
+    def _dispatch(self):
+        while True:
+            heads = [
+                (queue[0].tag, name)
+                for name, queue in self.queues.items()
+                if queue and self._can_start(name)
+            ]
+            if not heads:
+                return
+            tag, name = min(heads)
+            waiter = self.queues[name].popleft()
+            self._start(name, tag)
+            waiter.future.set_result(None)
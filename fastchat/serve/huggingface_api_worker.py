@@ -254,6 +254,7 @@ async def api_get_status(request: Request):
         "model_names": [m for w in workers for m in w.model_names],
         "speed": 1,
         "queue_length": sum([w.get_queue_length() for w in workers]),
+        "capacity": sum([w.limit_worker_concurrency for w in workers]),
     }
 
 
@@ -72,8 +72,9 @@ def generate_stream(
         device = model.device
 
     # Read parameters
-    prompt = params["prompt"]
-    len_prompt = len(prompt)
+    prompt = params.get("prompt")
+    # Token ids of the prompt, e.g. from `Conversation.encode`, skip tokenization.
+    input_ids = params.get("input_ids")
     temperature = float(params.get("temperature", 1.0))
     repetition_penalty = float(params.get("repetition_penalty", 1.0))
     top_p = float(params.get("top_p", 1.0))
@@ -89,7 +90,17 @@ def generate_stream(
     logits_processor = prepare_logits_processor(
         temperature, repetition_penalty, top_p, top_k
     )
-    input_ids = tokenizer(prompt).input_ids
+    if input_ids is None:
+        input_ids = tokenizer(prompt).input_ids
+    elif prompt is None:
+        # Only used to strip the prompt from the echoed output.
+        prompt = tokenizer.decode(
+            input_ids,
+            skip_special_tokens=True,
+            spaces_between_special_tokens=False,
+            clean_up_tokenization_spaces=True,
+        )
+    len_prompt = len(prompt)
 
     if model.config.is_encoder_decoder:
         max_src_len = context_len
@@ -18,6 +18,7 @@ from typing import List
 from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.responses import StreamingResponse, JSONResponse
 
+from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
 from fastchat.serve.base_model_worker import BaseModelWorker
 from fastchat.serve.model_worker import (
     logger,
@@ -77,6 +78,14 @@ class LightLLMWorker(BaseModelWorker):
     async def generate_stream(self, params):
         self.call_ct += 1
 
+        if params.get("input_ids") is not None:
+            ret = {
+                "text": f"{SERVER_ERROR_MSG}\n\n(This model only accepts text prompts, not input_ids.)",
+                "error_code": ErrorCode.INTERNAL_ERROR,
+            }
+            yield (json.dumps(ret) + "\0").encode()
+            return
+
         prompt = params.pop("prompt")
         request_id = params.pop("request_id")
         temperature = float(params.get("temperature", 1.0))
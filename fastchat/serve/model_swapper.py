@@ -0,0 +1,240 @@
+"""
+Keep a bounded set of models resident and page the others in on demand.
+
+Used by the multi-model worker to serve more models than fit on its device.
+A model is paged in when a request for it arrives and the least recently used
+idle models are evicted until the resident set fits in the budget again.
+Evicted models either go back to disk, to be reloaded from their model path,
+or are parked in (pinned) CPU memory, which is much faster to page in. Models
+with requests in progress are never evicted; a model chosen to make room for a
+waiting page-in takes no new requests until its current ones finish.
+"""
+import gc
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Optional
+
+OFFLOAD_TIERS = ("disk", "cpu")
+
+logger = logging.getLogger(__name__)
+
+
+def get_model_size(model) -> int:
+    """Bytes taken by the parameters and buffers of a torch model."""
+    size = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        size += tensor.numel() * tensor.element_size()
+    return size
+
+
+def empty_device_cache(device: str):
+    import torch
+
+    if device == "cuda":
+        torch.cuda.empty_cache()
+    elif device == "xpu":
+        torch.xpu.empty_cache()
+    elif device == "npu":
+        torch.npu.empty_cache()
+
+
+class ModelSwapper:
+    """LRU residency for model workers.
+
+    A worker needs a `load()` method that sets `worker.model`, and a `device`.
+    """
+
+    def __init__(
+        self,
+        max_resident_models: Optional[int] = None,
+        max_resident_memory: Optional[int] = None,
+        offload: str = "disk",
+        on_change: Optional[Callable[[], None]] = None,
+    ):
+        if offload not in OFFLOAD_TIERS:
+            raise ValueError(f"Invalid offload tier: {offload}")
+        self.max_resident_models = max_resident_models
+        self.max_resident_memory = max_resident_memory
+        self.offload = offload
+        self.on_change = on_change
+
+        # Worker -> bytes on the device, least recently used first.
+        self.resident = OrderedDict()
+        self.sizes = {}
+        self.in_use = Counter()
+        self.load_latency = {}
+        self.evict_latency = {}
+        # Workers being paged in by an `acquire` outside the lock.
+        self.loading = set()
+        # Busy workers chosen for eviction by a waiting page-in. They take no
+        # new requests, so that steady traffic cannot keep them resident.
+        self.draining = set()
+        self.condition = threading.Condition()
+
+    def acquire(self, worker):
+        """Page `worker` in if needed and keep it resident until `release`.
+
+        The model is loaded without holding the lock, so that requests for
+        resident models and releases are not blocked by a slow page-in.
+        """
+        with self.condition:
+            if not self._reserve(worker):
+                return
+
+        try:
+            tic = time.perf_counter()
+            if worker.model is None:
+                worker.load()
+            else:
+                worker.model.to(worker.device)
+            latency = time.perf_counter() - tic
+            size = get_model_size(worker.model)
+        except BaseException:
+            with self.condition:
+                self.loading.discard(worker)
+                self.in_use[worker] -= 1
+                self.condition.notify_all()
+            raise
+
+        with self.condition:
+            self.loading.discard(worker)
+            self.load_latency[worker] = latency
+            self.sizes[worker] = size
+            self.resident[worker] = size
+            self.condition.notify_all()
+            # The size of a model is only known once it has been loaded.
+            self._make_room(0, exclude=worker)
+        self._notify_change()
+
+    def release(self, worker):
+        with self.condition:
+            self.in_use[worker] -= 1
+            self.condition.notify_all()
+
+    def warm_up(self, workers):
+        """Page in workers in order until the next one does not fit."""
+        for worker in workers:
+            if self._over_budget(0, 1):
+                break
+            self.acquire(worker)
+            self.release(worker)
+
+    def get_status(self, worker) -> Dict:
+        return {
+            "resident": worker in self.resident,
+            "load_latency": self.load_latency.get(worker),
+            "evict_latency": self.evict_latency.get(worker),
+        }
+
+    def _reserve(self, worker) -> bool:
+        """Make room for `worker`, mark it as loading and in use, with the lock
+        held.
+
+        Returns False if it is already resident, True if the caller has to
+        page it in.
+        """
+        while True:
+            if worker in self.resident:
+                if worker in self.draining:
+                    # It is about to be evicted; wait and page it back in.
+                    self.condition.wait()
+                    continue
+                self.resident.move_to_end(worker)
+                self.in_use[worker] += 1
+                return False
+            if worker in self.loading:
+                # Another request is paging it in.
+                self.condition.wait()
+                continue
+            self._make_room(self.sizes.get(worker, 0), exclude=worker)
+            # Another request may have paged it in while this one waited.
+            if worker in self.resident or worker in self.loading:
+                continue
+            self.loading.add(worker)
+            self.in_use[worker] += 1
+            return True
+
+    def _notify_change(self):
+        """Run `on_change` in the background; its failures only get logged."""
+        if self.on_change is None:
+            return
+
+        def run():
+            try:
+                self.on_change()
+            except Exception:
+                logger.exception("Model swapper on_change callback failed")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _over_budget(self, extra_bytes: int, extra_models: int) -> bool:
+        # Models being loaded count against the budget already.
+        if self.max_resident_models is not None:
+            num_models = len(self.resident) + len(self.loading)
+            if num_models + extra_models > self.max_resident_models:
+                return True
+        if self.max_resident_memory is not None:
+            used = sum(self.resident.values())
+            used += sum(self.sizes.get(w, 0) for w in self.loading)
+            if used + extra_bytes > self.max_resident_memory:
+                return True
+        return False
+
+    def _make_room(self, extra_bytes: int, exclude):
+        extra_models = 0 if exclude in self.resident else 1
+        victim = None
+        try:
+            while self._over_budget(extra_bytes, extra_models):
+                idle = [
+                    w for w in self.resident if w is not exclude and not self.in_use[w]
+                ]
+                if idle:
+                    self._evict(idle[0])
+                elif any(
+                    w is not exclude for w in list(self.resident) + list(self.loading)
+                ):
+                    # Every other model is busy or loading. Drain the least
+                    # recently used one and wait for a model to finish.
+                    if victim not in self.resident:
+                        victim = next(
+                            (
+                                w
+                                for w in self.resident
+                                if w is not exclude and w not in self.draining
+                            ),
+                            None,
+                        )
+                        if victim is not None:
+                            self.draining.add(victim)
+                    self.condition.wait()
+                else:
+                    # A single model over the budget is still served.
+                    break
+        finally:
+            if victim is not None:
+                self.draining.discard(victim)
+                self.condition.notify_all()
+
+    def _evict(self, worker):
+        tic = time.perf_counter()
+        if self.offload == "cpu":
+            import torch
+
+            worker.model.to("cpu")
+            if torch.cuda.is_available():
+                # Pinned memory makes the next page-in a fast async copy.
+                for tensor in list(worker.model.parameters()) + list(
+                    worker.model.buffers()
+                ):
+                    tensor.data = tensor.data.pin_memory()
+        else:
+            # Keep the tokenizer and the context length, which are cheap and
+            # still needed to count tokens.
+            worker.model = None
+        gc.collect()
+        empty_device_cache(worker.device)
+        del self.resident[worker]
+        self.draining.discard(worker)
+        self.evict_latency[worker] = time.perf_counter() - tic
@@ -28,6 +28,7 @@ from fastchat.serve.base_model_worker import BaseModelWorker, app
 from fastchat.utils import (
     build_logger,
     get_context_length,
+    pack_embeddings,
     str_to_torch_dtype,
 )
 
@@ -61,6 +62,7 @@ class ModelWorker(BaseModelWorker):
         embed_in_truncate: bool = False,
         seed: Optional[int] = None,
         debug: bool = False,
+        lazy_load: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -73,9 +75,8 @@ class ModelWorker(BaseModelWorker):
             conv_template=conv_template,
         )
 
-        logger.info(f"Loading the model {self.model_names} on worker {worker_id} ...")
-        self.model, self.tokenizer = load_model(
-            model_path,
+        self.model_path = model_path
+        self.load_kwargs = dict(
             revision=revision,
             device=device,
             num_gpus=num_gpus,
@@ -90,17 +91,30 @@ class ModelWorker(BaseModelWorker):
             debug=debug,
         )
         self.device = device
-        if self.tokenizer.pad_token == None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.context_len = get_context_length(self.model.config)
-        self.generate_stream_func = get_generate_stream_function(self.model, model_path)
+        self.model = None
         self.stream_interval = stream_interval
         self.embed_in_truncate = embed_in_truncate
         self.seed = seed
 
+        # With `lazy_load`, the owner calls `load` before the first request.
+        if not lazy_load:
+            self.load()
         if not no_register:
             self.init_heart_beat()
 
+    def load(self):
+        """Load the model weights and the tokenizer from `model_path`."""
+        logger.info(
+            f"Loading the model {self.model_names} on worker {self.worker_id} ..."
+        )
+        self.model, self.tokenizer = load_model(self.model_path, **self.load_kwargs)
+        if self.tokenizer.pad_token == None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.context_len = get_context_length(self.model.config)
+        self.generate_stream_func = get_generate_stream_function(
+            self.model, self.model_path
+        )
+
     def generate_stream_gate(self, params):
         if self.device == "npu":
             import torch_npu
@@ -213,6 +227,7 @@ class ModelWorker(BaseModelWorker):
             attention_mask = input_ids != tokenizer.pad_token_id
 
             base64_encode = params.get("encoding_format", None)
+            embedding_dtype = params.get("embedding_dtype", None)
 
             if self.embed_in_truncate:
                 embedding, token_num = self.__process_embed_chunk(
@@ -275,7 +290,13 @@ class ModelWorker(BaseModelWorker):
 
                 ret["token_num"] = all_token_num
 
-            if base64_encode == "base64":
+            if embedding_dtype is not None:
+                # Binary transport: the API server decodes at the edge.
+                out_embeddings, meta = pack_embeddings(
+                    normalized_embeddings, embedding_dtype
+                )
+                ret.update(meta)
+            elif base64_encode == "base64":
                 out_embeddings = self.__encode_base64(normalized_embeddings)
             else:
                 out_embeddings = normalized_embeddings.tolist()
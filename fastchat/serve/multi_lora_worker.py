@@ -0,0 +1,564 @@
+"""
+A worker that serves many LoRA adapters on top of one base model.
+
+The base model is loaded once and every adapter is attached to the same
+PeftModel, so each additional fine-tune only costs the memory of its LoRA
+weights. Adapters can be loaded and unloaded at runtime through
+`/worker_load_adapter` and `/worker_unload_adapter`.
+
+Generation runs on a single background thread. Requests that are waiting when
+a batch starts are left-padded into one batch, whichever adapter they use, and
+every forward routes each row through its own adapter with peft's
+`adapter_names`. Finished rows are dropped from the KV cache; requests that
+arrive while a batch is decoding join the next one.
+
+Usage:
+python3 -m fastchat.serve.multi_lora_worker --model-path lmsys/vicuna-7b-v1.5 \
+    --lora-path path/to/adapter-a --lora-names vicuna-a \
+    --lora-path path/to/adapter-b --lora-names vicuna-b
+"""
+import argparse
+from collections import Counter
+import json
+import os
+import queue
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+import torch
+import uvicorn
+
+from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
+from fastchat.model.model_adapter import add_model_args, load_model
+from fastchat.serve.base_model_worker import BaseModelWorker, app
+from fastchat.serve.inference import prepare_logits_processor
+from fastchat.serve.model_worker import logger, worker_id
+from fastchat.utils import get_context_length, is_partial_stop, str_to_torch_dtype
+
+# The adapter name peft uses for rows that should skip every adapter.
+BASE_ADAPTER_NAME = "__base__"
+
+
+class LoraRequest:
+    """The decoding state of one request in a batch."""
+
+    def __init__(
+        self,
+        tokenizer,
+        params: Dict,
+        adapter_name: str,
+        context_len: int,
+        stream_interval: int,
+    ):
+        self.tokenizer = tokenizer
+        self.adapter_name = adapter_name
+        self.stream_interval = stream_interval
+
+        prompt = params.get("prompt")
+        input_ids = params.get("input_ids")
+        self.temperature = float(params.get("temperature", 1.0))
+        self.repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        self.top_p = float(params.get("top_p", 1.0))
+        top_k = int(params.get("top_k", -1))  # -1 means disable
+        self.max_new_tokens = max(1, int(params.get("max_new_tokens", 256)))
+        self.logprobs = params.get("logprobs", None)
+        self.echo = bool(params.get("echo", True))
+        self.stop_str = params.get("stop", None)
+        if self.stop_str is not None and not isinstance(self.stop_str, (str, list)):
+            raise ValueError("Invalid stop field type.")
+        self.stop_token_ids = set(params.get("stop_token_ids", None) or [])
+        self.stop_token_ids.add(tokenizer.eos_token_id)
+
+        self.logits_processor = prepare_logits_processor(
+            self.temperature, self.repetition_penalty, self.top_p, top_k
+        )
+        if input_ids is None:
+            input_ids = tokenizer(prompt).input_ids
+        elif prompt is None:
+            # Only used to strip the prompt from the echoed output.
+            prompt = tokenizer.decode(
+                input_ids,
+                skip_special_tokens=True,
+                spaces_between_special_tokens=False,
+                clean_up_tokenization_spaces=True,
+            )
+        self.len_prompt = len(prompt)
+
+        max_src_len = context_len - self.max_new_tokens - 1
+        self.input_ids = list(input_ids[-max_src_len:])
+        self.output_ids = list(self.input_ids)
+        self.token_logprobs = [None] * len(self.input_ids)
+        self.output = ""
+        self.finished = False
+        self.outputs = queue.Queue()
+
+    def set_prompt_logprobs(self, logits: torch.Tensor):
+        """Record prompt logprobs from the prefill logits of this row."""
+        if self.logprobs is None:
+            return
+        log_probs = torch.log_softmax(logits[:-1].float(), dim=-1)
+        labels = torch.as_tensor(self.input_ids[1:], device=logits.device)
+        self.token_logprobs[1:] = log_probs.gather(-1, labels[:, None])[:, 0].tolist()
+
+    def sample(self, logits: torch.Tensor) -> int:
+        """Pick the next token from the raw logits of the last position."""
+        last_token_logits = logits[None]
+        if self.logits_processor:
+            if self.repetition_penalty > 1.0:
+                output_ids = torch.as_tensor([self.output_ids], device=logits.device)
+            else:
+                output_ids = None
+            last_token_logits = self.logits_processor(output_ids, last_token_logits)
+        last_token_logits = last_token_logits[0]
+
+        if self.temperature < 1e-5 or self.top_p < 1e-8:  # greedy
+            token = int(torch.argmax(last_token_logits))
+        else:
+            probs = torch.softmax(last_token_logits.float(), dim=-1)
+            token = int(torch.multinomial(probs, num_samples=1))
+        if self.logprobs is not None:
+            # Logprobs are based on the raw logits.
+            self.token_logprobs.append(
+                torch.log_softmax(logits.float(), dim=-1)[token].item()
+            )
+        self.output_ids.append(token)
+        return token
+
+    def step(self):
+        """Stream the output after a sampled token and detect the end."""
+        i = len(self.output_ids) - len(self.input_ids) - 1
+        stopped = self.output_ids[-1] in self.stop_token_ids
+        if i % self.stream_interval == 0 or i == self.max_new_tokens - 1 or stopped:
+            output, stopped, partially_stopped = self.decode(stopped)
+            self.output = output
+            # Prevent yielding partial stop sequence
+            if not partially_stopped:
+                self.outputs.put(self.make_output(None))
+
+        if stopped or i == self.max_new_tokens - 1:
+            self.finished = True
+            self.outputs.put(self.make_output("stop" if stopped else "length"))
+            self.outputs.put(None)
+
+    def decode(self, stopped: bool):
+        if self.echo:
+            output_ids = self.output_ids
+            rfind_start = self.len_prompt
+        else:
+            output_ids = self.output_ids[len(self.input_ids) :]
+            rfind_start = 0
+        output = self.tokenizer.decode(
+            output_ids,
+            skip_special_tokens=True,
+            spaces_between_special_tokens=False,
+            clean_up_tokenization_spaces=True,
+        )
+
+        partially_stopped = False
+        stop_strs = [self.stop_str] if isinstance(self.stop_str, str) else self.stop_str
+        for each_stop in stop_strs or []:
+            pos = output.rfind(each_stop, rfind_start)
+            if pos != -1:
+                output = output[:pos]
+                stopped = True
+                break
+            partially_stopped = is_partial_stop(output, each_stop)
+            if partially_stopped:
+                break
+        return output, stopped, partially_stopped
+
+    def make_output(self, finish_reason: Optional[str]):
+        prompt_tokens = len(self.input_ids)
+        completion_tokens = len(self.output_ids) - prompt_tokens
+        ret_logprobs = None
+        if self.logprobs is not None:
+            start = 0 if self.echo else prompt_tokens
+            tokens = [self.tokenizer.decode(t) for t in self.output_ids[start:]]
+            text_offset = []
+            curr_pos = 0
+            for text in tokens:
+                text_offset.append(curr_pos)
+                curr_pos += len(text)
+            ret_logprobs = {
+                "text_offset": text_offset,
+                "tokens": tokens,
+                "token_logprobs": self.token_logprobs[start:],
+                "top_logprobs": [{}] * len(tokens),
+            }
+        return {
+            "text": self.output,
+            "error_code": 0,
+            "logprobs": ret_logprobs,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            "finish_reason": finish_reason,
+        }
+
+
+class MultiLoraWorker(BaseModelWorker):
+    def __init__(
+        self,
+        controller_addr: str,
+        worker_addr: str,
+        worker_id: str,
+        model_path: str,
+        model_names: List[str],
+        limit_worker_concurrency: int,
+        no_register: bool,
+        device: str,
+        num_gpus: int,
+        max_gpu_memory: str,
+        lora_paths: Iterable[str] = (),
+        lora_names: Optional[List[List[str]]] = None,
+        revision: str = None,
+        dtype: Optional[torch.dtype] = None,
+        load_8bit: bool = False,
+        cpu_offloading: bool = False,
+        stream_interval: int = 2,
+        conv_template: Optional[str] = None,
+        **kwargs,
+    ):
+        super().__init__(
+            controller_addr,
+            worker_addr,
+            worker_id,
+            model_path,
+            model_names,
+            limit_worker_concurrency,
+            conv_template=conv_template,
+        )
+
+        logger.info(f"Loading the model {self.model_names} on worker {worker_id} ...")
+        self.model, self.tokenizer = load_model(
+            model_path,
+            revision=revision,
+            device=device,
+            num_gpus=num_gpus,
+            max_gpu_memory=max_gpu_memory,
+            dtype=dtype,
+            load_8bit=load_8bit,
+            cpu_offloading=cpu_offloading,
+        )
+        self.device = device
+        if self.tokenizer.pad_token == None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.context_len = get_context_length(self.model.config)
+        self.stream_interval = stream_interval
+        self.no_register = no_register
+
+        # Names of the base model are served without an adapter.
+        self.adapters = {name: BASE_ADAPTER_NAME for name in self.model_names}
+        self.num_loaded_adapters = 0
+        self.adapter_use = Counter()
+        # Held for every forward so adapters never change under a batch.
+        self.model_lock = threading.Lock()
+        self.pending = queue.Queue()
+
+        lora_names = lora_names or [None] * len(lora_paths)
+        for lora_path, names in zip(lora_paths, lora_names):
+            self.load_adapter(lora_path, names)
+
+        threading.Thread(target=self.generation_loop, daemon=True).start()
+        if not no_register:
+            self.init_heart_beat()
+
+    def load_adapter(self, lora_path: str, model_names: Optional[List[str]] = None):
+        """Attach a LoRA adapter to the shared base model and serve it."""
+        from peft import PeftModel
+
+        model_names = model_names or [lora_path.rstrip("/").split("/")[-1]]
+        for name in model_names:
+            if name in self.adapters:
+                raise ValueError(f"Model name {name} is already served.")
+
+        # peft keeps adapters in ModuleDicts, so names must not contain dots.
+        adapter_name = f"adapter_{self.num_loaded_adapters}"
+        logger.info(f"Loading the adapter {model_names} from {lora_path} ...")
+        with self.model_lock:
+            if self.num_loaded_adapters == 0:
+                self.model = PeftModel.from_pretrained(
+                    self.model, lora_path, adapter_name=adapter_name
+                )
+            else:
+                self.model.load_adapter(lora_path, adapter_name=adapter_name)
+            self.model.eval()
+            self.num_loaded_adapters += 1
+            for name in model_names:
+                self.adapters[name] = adapter_name
+        self.model_names = self.model_names + model_names
+        return adapter_name
+
+    def unload_adapter(self, model_name: str):
+        """Stop serving an adapter and free its weights."""
+        with self.model_lock:
+            adapter_name = self.adapters.get(model_name)
+            if adapter_name is None or adapter_name == BASE_ADAPTER_NAME:
+                raise ValueError(f"{model_name} is not a loaded adapter.")
+            if self.adapter_use[adapter_name] > 0:
+                raise ValueError(f"{model_name} has requests in progress.")
+            names = [n for n, a in self.adapters.items() if a == adapter_name]
+            for name in names:
+                del self.adapters[name]
+            self.model.delete_adapter(adapter_name)
+        self.model_names = [n for n in self.model_names if n not in names]
+        return names
+
+    def generate_stream_gate(self, params):
+        self.call_ct += 1
+
+        model_name = params.get("model", self.model_names[0])
+        try:
+            # Looked up and counted under the lock unload_adapter checks the
+            # count with, so the adapter cannot be deleted before it is used.
+            with self.model_lock:
+                adapter_name = self.adapters.get(model_name)
+                if adapter_name is None:
+                    raise ValueError(f"{model_name} is not served by this worker.")
+                self.adapter_use[adapter_name] += 1
+            try:
+                request = LoraRequest(
+                    self.tokenizer,
+                    params,
+                    adapter_name,
+                    self.context_len,
+                    self.stream_interval,
+                )
+            except ValueError:
+                with self.model_lock:
+                    self.adapter_use[adapter_name] -= 1
+                raise
+        except ValueError as e:
+            ret = {
+                "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+                "error_code": ErrorCode.INTERNAL_ERROR,
+            }
+            yield json.dumps(ret).encode() + b"\0"
+            return
+
+        self.pending.put(request)
+        while True:
+            ret = request.outputs.get()
+            if ret is None:
+                break
+            yield json.dumps(ret).encode() + b"\0"
+
+    def generate_gate(self, params):
+        for x in self.generate_stream_gate(params):
+            pass
+        return json.loads(x[:-1].decode())
+
+    def generation_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < self.limit_worker_concurrency:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.generate_batch(batch)
+            except torch.cuda.OutOfMemoryError as e:
+                self.fail_batch(batch, e, ErrorCode.CUDA_OUT_OF_MEMORY)
+            except Exception as e:
+                # Any error fails only this batch; the loop is the only thread
+                # that serves requests, so it must keep running.
+                self.fail_batch(batch, e, ErrorCode.INTERNAL_ERROR)
+            finally:
+                with self.model_lock:
+                    for request in batch:
+                        self.adapter_use[request.adapter_name] -= 1
+                torch.cuda.empty_cache()
+
+    def fail_batch(self, batch: List[LoraRequest], e: Exception, error_code: int):
+        logger.error(f"Generation failed for a batch of {len(batch)}: {e!r}")
+        for request in batch:
+            if not request.finished:
+                request.finished = True
+                request.outputs.put(
+                    {"text": f"{SERVER_ERROR_MSG}\n\n({e})", "error_code": error_code}
+                )
+                request.outputs.put(None)
+
+    @torch.inference_mode()
+    def generate_batch(self, batch: List[LoraRequest]):
+        """Decode a batch of requests to completion, one adapter per row."""
+        device = self.model.device
+        max_len = max(len(r.input_ids) for r in batch)
+        input_ids = torch.full(
+            (len(batch), max_len), self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for row, request in enumerate(batch):
+            input_ids[row, max_len - len(request.input_ids) :] = torch.as_tensor(
+                request.input_ids
+            )
+            attention_mask[row, max_len - len(request.input_ids) :] = 1
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+
+        past_key_values = None
+        while batch:
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+            kwargs = {}
+            if self.num_loaded_adapters > 0:
+                kwargs["adapter_names"] = [r.adapter_name for r in batch]
+            with self.model_lock:
+                out = self.model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids[:, -input_ids.shape[1] :],
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    **kwargs,
+                )
+            if past_key_values is None:
+                for row, request in enumerate(batch):
+                    request.set_prompt_logprobs(
+                        out.logits[row, max_len - len(request.input_ids) :]
+                    )
+            past_key_values = out.past_key_values
+            logits = out.logits[:, -1, :]
+
+            keep = []
+            for row, request in enumerate(batch):
+                request.sample(logits[row])
+                request.step()
+                if not request.finished:
+                    keep.append(row)
+            if len(keep) < len(batch):
+                index = torch.as_tensor(keep, dtype=torch.long, device=device)
+                past_key_values.batch_select_indices(index)
+                attention_mask = attention_mask[index]
+                batch = [batch[row] for row in keep]
+            if not batch:
+                break
+
+            input_ids = torch.as_tensor(
+                [[r.output_ids[-1]] for r in batch], device=device
+            )
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((len(batch), 1))], dim=-1
+            )
+
+
+@app.post("/worker_load_adapter")
+async def api_load_adapter(request: Request):
+    params = await request.json()
+    try:
+        worker.load_adapter(params["lora_path"], params.get("model_names"))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    if not worker.no_register:
+        worker.register_to_controller()
+    return {"model_names": worker.model_names}
+
+
+@app.post("/worker_unload_adapter")
+async def api_unload_adapter(request: Request):
+    params = await request.json()
+    try:
+        worker.unload_adapter(params["model"])
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    if not worker.no_register:
+        worker.register_to_controller()
+    return {"model_names": worker.model_names}
+
+
+def create_multi_lora_worker():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21002)
+    parser.add_argument("--worker-address", type=str, default="http://localhost:21002")
+    parser.add_argument(
+        "--controller-address", type=str, default="http://localhost:21001"
+    )
+    add_model_args(parser)
+    parser.add_argument(
+        "--model-names",
+        type=lambda s: s.split(","),
+        help="Optional display comma separated names of the base model",
+    )
+    parser.add_argument(
+        "--lora-path",
+        type=str,
+        default=[],
+        action="append",
+        help="One or more paths to LoRA adapters of the base model.",
+    )
+    parser.add_argument(
+        "--lora-names",
+        type=lambda s: s.split(","),
+        action="append",
+        help="One or more adapter names.  Values must be aligned with `--lora-path` values.",
+    )
+    parser.add_argument(
+        "--conv-template", type=str, default=None, help="Conversation prompt template."
+    )
+    parser.add_argument(
+        "--limit-worker-concurrency",
+        type=int,
+        default=8,
+        help="Limit the model concurrency, which is also the largest batch size.",
+    )
+    parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument("--no-register", action="store_true")
+    parser.add_argument(
+        "--ssl",
+        action="store_true",
+        required=False,
+        default=False,
+        help="Enable SSL. Requires OS Environment variables 'SSL_KEYFILE' and 'SSL_CERTFILE'.",
+    )
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    if args.gpus:
+        if len(args.gpus.split(",")) < args.num_gpus:
+            raise ValueError(
+                f"Larger --num-gpus ({args.num_gpus}) than --gpus {args.gpus}!"
+            )
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+
+    worker = MultiLoraWorker(
+        args.controller_address,
+        args.worker_address,
+        worker_id,
+        args.model_path,
+        args.model_names,
+        args.limit_worker_concurrency,
+        no_register=args.no_register,
+        device=args.device,
+        num_gpus=args.num_gpus,
+        max_gpu_memory=args.max_gpu_memory,
+        lora_paths=args.lora_path,
+        lora_names=args.lora_names,
+        revision=args.revision,
+        dtype=str_to_torch_dtype(args.dtype),
+        load_8bit=args.load_8bit,
+        cpu_offloading=args.cpu_offloading,
+        stream_interval=args.stream_interval,
+        conv_template=args.conv_template,
+    )
+    return args, worker
+
+
+if __name__ == "__main__":
+    args, worker = create_multi_lora_worker()
+    if args.ssl:
+        uvicorn.run(
+            app,
+            host=args.host,
+            port=args.port,
+            log_level="info",
+            ssl_keyfile=os.environ["SSL_KEYFILE"],
+            ssl_certfile=os.environ["SSL_CERTFILE"],
+        )
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, log_level="info")
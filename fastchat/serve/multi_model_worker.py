@@ -5,8 +5,19 @@ supports running a list of models on the same machine so that they can
 
 Each model can have one or more model names.
 
-This multi-model worker assumes the models shares some underlying weights and
-thus reports the combined queue lengths for health checks.
+The models share the device through per-model queues. Each model gets a
+weighted-fair share of the `--limit-worker-concurrency` slots
+(`--model-weights`) and at most `--limit-model-concurrency` of them. The
+combined queue length is reported for health checks, and the queue length of
+every model is reported in `model_status` so that the controller can dispatch
+by model.
+
+With `--max-resident-models` or `--max-resident-memory`, only some of the
+models are kept on the device. The others are paged in when a request for them
+arrives and the least recently used idle models are evicted to disk or to CPU
+memory (`--offload-tier`). The residency and the swap latencies of every model
+are reported to the controller, which prefers workers that have a model
+resident.
 
 We recommend using this with multiple Peft models (with `peft` in the name)
 where all Peft models are trained on the exact same base model.
@@ -56,7 +67,10 @@ from fastchat.model.model_codet5p import generate_stream_codet5p
 from fastchat.modules.gptq import GptqConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
+from fastchat.serve.base_model_worker import create_embedding_response
+from fastchat.serve.fair_scheduler import FairScheduler
 from fastchat.serve.inference import generate_stream
+from fastchat.serve.model_swapper import OFFLOAD_TIERS, ModelSwapper
 from fastchat.serve.model_worker import ModelWorker, worker_id, logger
 from fastchat.utils import build_logger, pretty_print_semaphore, get_context_length
 
@@ -66,29 +80,127 @@ from fastchat.utils import build_logger, pretty_print_semaphore, get_context_len
 # each API call.
 workers = []
 worker_map = {}
+# Shares the device between the workers, keyed by their first model name.
+scheduler = None
+# Set when only some of the models are kept resident.
+model_swapper = None
 app = FastAPI()
 
 
-def release_worker_semaphore():
-    workers[0].semaphore.release()
+async def acquire_worker(worker):
+    await scheduler.acquire(worker.model_names[0])
+    try:
+        await acquire_model(worker)
+    except BaseException:
+        scheduler.release(worker.model_names[0])
+        raise
 
 
-def acquire_worker_semaphore():
-    if workers[0].semaphore is None:
-        # Share the same semaphore for all workers because
-        # all workers share the same GPU.
-        semaphore = asyncio.Semaphore(workers[0].limit_worker_concurrency)
-        for w in workers:
-            w.semaphore = semaphore
-    return workers[0].semaphore.acquire()
+async def release_worker(worker):
+    # Async so that background tasks run it on the event loop: the scheduler
+    # wakes its waiters through asyncio futures, which are not thread-safe.
+    release_model(worker)
+    scheduler.release(worker.model_names[0])
 
 
-def create_background_tasks():
+async def acquire_model(worker):
+    if model_swapper is not None:
+        await asyncio.to_thread(model_swapper.acquire, worker)
+
+
+def release_model(worker):
+    if model_swapper is not None:
+        model_swapper.release(worker)
+
+
+async def ensure_tokenizer(worker):
+    """Page in a model that has never been loaded to get its tokenizer."""
+    if worker.tokenizer is None:
+        await acquire_model(worker)
+        release_model(worker)
+
+
+def create_background_tasks(worker):
     background_tasks = BackgroundTasks()
-    background_tasks.add_task(release_worker_semaphore)
+    background_tasks.add_task(release_worker, worker)
     return background_tasks
 
 
+def create_error_response(e: Exception):
+    ret = {
+        "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+        "error_code": ErrorCode.INTERNAL_ERROR,
+    }
+    return JSONResponse(ret)
+
+
+def get_status():
+    status = {
+        "model_names": [m for w in workers for m in w.model_names],
+        "speed": 1,
+        "queue_length": scheduler.get_queue_length(),
+        "capacity": workers[0].limit_worker_concurrency,
+        "model_status": get_model_status(),
+    }
+    return status
+
+
+def get_model_status():
+    model_status = {}
+    for w in workers:
+        key = w.model_names[0]
+        status = {
+            "queue_length": scheduler.get_queue_length(key),
+            "capacity": scheduler.model_capacity,
+            "weight": scheduler.weights[key],
+        }
+        if model_swapper is not None:
+            status.update(model_swapper.get_status(w))
+        for model_name in w.model_names:
+            model_status[model_name] = status
+    return model_status
+
+
+def register_to_controller(controller_address, worker_address, check_heart_beat):
+    url = controller_address + "/register_worker"
+    data = {
+        "worker_name": worker_address,
+        "check_heart_beat": check_heart_beat,
+        "worker_status": get_status(),
+    }
+    r = requests.post(url, json=data)
+    assert r.status_code == 200
+
+
+def send_heart_beat(controller_address, worker_address):
+    url = controller_address + "/receive_heart_beat"
+    while True:
+        try:
+            ret = requests.post(
+                url,
+                json={
+                    "worker_name": worker_address,
+                    "queue_length": scheduler.get_queue_length(),
+                    "model_status": get_model_status(),
+                },
+                timeout=5,
+            )
+            exist = ret.json()["exist"]
+            break
+        except (requests.exceptions.RequestException, KeyError) as e:
+            logger.error(f"heart beat error: {e}")
+        time.sleep(5)
+
+    if not exist:
+        register_to_controller(controller_address, worker_address, True)
+
+
+def heart_beat_worker(controller_address, worker_address):
+    while True:
+        time.sleep(WORKER_HEART_BEAT_INTERVAL)
+        send_heart_beat(controller_address, worker_address)
+
+
 # Note: for all the calls below, we make a hard assumption that the caller
 # includes the model name in the payload, otherwise we can't figure out which
 # underlying sub-worker to call.
@@ -97,46 +209,52 @@ def create_background_tasks():
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
+    try:
+        await acquire_worker(worker)
+    except (ValueError, RuntimeError) as e:
+        return create_error_response(e)
     generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
+    background_tasks = create_background_tasks(worker)
     return StreamingResponse(generator, background=background_tasks)
 
 
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
+    try:
+        await acquire_worker(worker)
+    except (ValueError, RuntimeError) as e:
+        return create_error_response(e)
     output = worker.generate_gate(params)
-    release_worker_semaphore()
+    await release_worker(worker)
     return JSONResponse(output)
 
 
 @app.post("/worker_get_embeddings")
 async def api_get_embeddings(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
+    try:
+        await acquire_worker(worker)
+    except (ValueError, RuntimeError) as e:
+        return create_error_response(e)
     embedding = worker.get_embeddings(params)
-    background_tasks = create_background_tasks()
-    return JSONResponse(content=embedding, background=background_tasks)
+    background_tasks = create_background_tasks(worker)
+    return create_embedding_response(embedding, background=background_tasks)
 
 
 @app.post("/worker_get_status")
 async def api_get_status(request: Request):
-    return {
-        "model_names": [m for w in workers for m in w.model_names],
-        "speed": 1,
-        "queue_length": sum([w.get_queue_length() for w in workers]),
-    }
+    return get_status()
 
 
 @app.post("/count_token")
 async def api_count_token(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
+    await ensure_tokenizer(worker)
     return worker.count_token(params)
 
 
@@ -151,10 +269,13 @@ async def api_get_conv(request: Request):
 async def api_model_details(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
+    await ensure_tokenizer(worker)
     return {"context_length": worker.context_len}
 
 
 def create_multi_model_worker():
+    global scheduler, model_swapper
+
     # Note: Ensure we resolve arg conflicts.  We let `add_model_args` add MOST
     # of the model args but we'll override one to have an append action that
     # supports multiple values.
@@ -188,6 +309,38 @@ def create_multi_model_worker():
         help="Conversation prompt template. Values must be aligned with `--model-path` values. If only one value is provided, it will be repeated for all models.",
     )
     parser.add_argument("--limit-worker-concurrency", type=int, default=5)
+    parser.add_argument(
+        "--limit-model-concurrency",
+        type=int,
+        default=None,
+        help="Limit the concurrency of each model. Defaults to --limit-worker-concurrency.",
+    )
+    parser.add_argument(
+        "--model-weights",
+        type=float,
+        default=None,
+        action="append",
+        help="Share of the worker concurrency each model gets when models compete. Values must be aligned with `--model-path` values. If only one value is provided, it will be repeated for all models.",
+    )
+    parser.add_argument(
+        "--max-resident-models",
+        type=int,
+        default=None,
+        help="Keep at most this many models on the device and page the others in on demand.",
+    )
+    parser.add_argument(
+        "--max-resident-memory",
+        type=float,
+        default=None,
+        help="Keep at most this many GiB of model weights on the device and page the others in on demand.",
+    )
+    parser.add_argument(
+        "--offload-tier",
+        type=str,
+        choices=OFFLOAD_TIERS,
+        default="disk",
+        help="Where evicted models are kept. 'cpu' keeps them in pinned CPU memory for faster page-in.",
+    )
     parser.add_argument("--stream-interval", type=int, default=2)
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument(
@@ -235,13 +388,27 @@ def create_multi_model_worker():
     if args.model_names is None:
         args.model_names = [[x.split("/")[-1]] for x in args.model_path]
 
+    swap_models = (
+        args.max_resident_models is not None or args.max_resident_memory is not None
+    )
+    if swap_models and args.offload_tier == "cpu":
+        if args.num_gpus > 1 or args.load_8bit or args.cpu_offloading:
+            raise ValueError(
+                "--offload-tier cpu needs each model on a single device without "
+                "--load-8bit or --cpu-offloading."
+            )
+
     if args.conv_template is None:
         args.conv_template = [None] * len(args.model_path)
     elif len(args.conv_template) == 1:  # Repeat the same template
         args.conv_template = args.conv_template * len(args.model_path)
 
+    if args.model_weights is None:
+        args.model_weights = [1.0] * len(args.model_path)
+    elif len(args.model_weights) == 1:  # Repeat the same weight
+        args.model_weights = args.model_weights * len(args.model_path)
+
     # Launch all workers
-    workers = []
     for conv_template, model_path, model_names in zip(
         args.conv_template, args.model_path, args.model_names
     ):
@@ -252,7 +419,8 @@ def create_multi_model_worker():
             model_path,
             model_names,
             args.limit_worker_concurrency,
-            args.no_register,
+            # The sub-workers are registered and kept alive together below.
+            no_register=True,
             device=args.device,
             num_gpus=args.num_gpus,
             max_gpu_memory=args.max_gpu_memory,
@@ -263,24 +431,48 @@ def create_multi_model_worker():
             xft_config=xft_config,
             stream_interval=args.stream_interval,
             conv_template=conv_template,
+            lazy_load=swap_models,
         )
         workers.append(w)
         for model_name in model_names:
             worker_map[model_name] = w
 
+    scheduler = FairScheduler(
+        args.limit_worker_concurrency,
+        {w.model_names[0]: weight for w, weight in zip(workers, args.model_weights)},
+        args.limit_model_concurrency,
+    )
+
+    if swap_models:
+
+        def on_change():
+            # Let the controller know which models are resident now.
+            if not args.no_register:
+                register_to_controller(
+                    args.controller_address, args.worker_address, True
+                )
+
+        max_resident_memory = None
+        if args.max_resident_memory is not None:
+            max_resident_memory = int(args.max_resident_memory * 2**30)
+        model_swapper = ModelSwapper(
+            args.max_resident_models,
+            max_resident_memory,
+            offload=args.offload_tier,
+        )
+        model_swapper.warm_up(workers)
+        model_swapper.on_change = on_change
+
     # Register all models
-    url = args.controller_address + "/register_worker"
-    data = {
-        "worker_name": workers[0].worker_addr,
-        "check_heart_beat": not args.no_register,
-        "worker_status": {
-            "model_names": [m for w in workers for m in w.model_names],
-            "speed": 1,
-            "queue_length": sum([w.get_queue_length() for w in workers]),
-        },
-    }
-    r = requests.post(url, json=data)
-    assert r.status_code == 200
+    register_to_controller(
+        args.controller_address, args.worker_address, not args.no_register
+    )
+    if not args.no_register:
+        threading.Thread(
+            target=heart_beat_worker,
+            args=(args.controller_address, args.worker_address),
+            daemon=True,
+        ).start()
 
     return args, workers
 
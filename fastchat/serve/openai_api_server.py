@@ -11,28 +11,28 @@ import asyncio
 import argparse
 import json
 import os
-from typing import Generator, Optional, Union, Dict, List, Any
+from typing import AsyncGenerator, Optional, Union, Dict, List, Any
 
 import aiohttp
 import fastapi
 from fastapi import Depends, HTTPException
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
 import httpx
 
 from pydantic_settings import BaseSettings
 import shortuuid
-import tiktoken
 import uvicorn
 
 from fastchat.constants import (
+    EMBEDDING_MEDIA_TYPE,
     WORKER_API_TIMEOUT,
     WORKER_API_EMBEDDING_BATCH_SIZE,
     ErrorCode,
 )
-from fastchat.conversation import Conversation, SeparatorStyle
+from fastchat.conversation import Conversation, PromptRenderer, SeparatorStyle
 from fastchat.protocol.openai_api_protocol import (
     ChatCompletionRequest,
     ChatCompletionResponse,
@@ -44,8 +44,6 @@ from fastchat.protocol.openai_api_protocol import (
     CompletionResponse,
     CompletionResponseChoice,
     DeltaMessage,
-    CompletionResponseStreamChoice,
-    CompletionStreamResponse,
     EmbeddingsRequest,
     EmbeddingsResponse,
     ErrorResponse,
@@ -53,6 +51,7 @@ from fastchat.protocol.openai_api_protocol import (
     ModelCard,
     ModelList,
     ModelPermission,
+    StreamChunkEncoder,
     UsageInfo,
 )
 from fastchat.protocol.api_protocol import (
@@ -61,11 +60,37 @@ from fastchat.protocol.api_protocol import (
     APITokenCheckResponse,
     APITokenCheckResponseItem,
 )
-from fastchat.utils import build_logger
+from fastchat.serve.admission import (
+    AdmissionController,
+    AdmissionMiddleware,
+    parse_priority_classes,
+)
+from fastchat.serve.response_cache import ResponseCache
+from fastchat.utils import (
+    EMBEDDING_TRANSPORT_DTYPES,
+    build_logger,
+    unpack_embeddings,
+)
 
 logger = build_logger("openai_api_server", "openai_api_server.log")
 
 conv_template_map = {}
+conv_renderer_map = {}
+
+# Cache of worker outputs for greedy requests. Set by --response-cache-size.
+response_cache: Optional[ResponseCache] = None
+
+# Gateway admission control. Set by --admission-control.
+admission_controller: Optional[AdmissionController] = None
+# Interval in seconds for refreshing the admission capacity from the workers.
+ADMISSION_CAPACITY_REFRESH_INTERVAL = 10
+ADMISSION_PATH_PREFIXES = (
+    "/v1/chat/completions",
+    "/v1/completions",
+    "/v1/embeddings",
+    "/v1/engines/",
+    "/api/v1/chat/completions",
+)
 
 fetch_timeout = aiohttp.ClientTimeout(total=3 * 3600)
 
@@ -98,6 +123,10 @@ class AppSettings(BaseSettings):
     # The address of the model controller.
     controller_address: str = "http://localhost:21001"
     api_keys: Optional[List[str]] = None
+    # Precision of the binary embedding payload requested from workers
+    embedding_dtype: str = "float32"
+    # Fixed admission capacity. <= 0 follows the capacity reported by workers.
+    admission_capacity: int = 0
 
 
 app_settings = AppSettings()
@@ -229,6 +258,8 @@ def process_input(model_name, inp):
     if isinstance(inp, str):
         inp = [inp]
     elif isinstance(inp, list):
+        import tiktoken
+
         if isinstance(inp[0], int):
             try:
                 decoding = tiktoken.model.encoding_for_model(model_name)
@@ -280,29 +311,18 @@ async def get_gen_params(
     best_of: Optional[int] = None,
     use_beam_search: Optional[bool] = None,
 ) -> Dict[str, Any]:
-    conv = await get_conv(model_name, worker_addr)
-    conv = Conversation(
-        name=conv["name"],
-        system_template=conv["system_template"],
-        system_message=conv["system_message"],
-        roles=conv["roles"],
-        messages=list(conv["messages"]),  # prevent in-place modification
-        offset=conv["offset"],
-        sep_style=SeparatorStyle(conv["sep_style"]),
-        sep=conv["sep"],
-        sep2=conv["sep2"],
-        stop_str=conv["stop_str"],
-        stop_token_ids=conv["stop_token_ids"],
-    )
+    conv = await get_conv_renderer(model_name, worker_addr)
 
     if isinstance(messages, str):
         prompt = messages
         images = []
     else:
+        system_message = conv.system_message
+        conv_messages = [[x, y] for x, y in conv.messages]
         for message in messages:
             msg_role = message["role"]
             if msg_role == "system":
-                conv.set_system_message(message["content"])
+                system_message = message["content"]
             elif msg_role == "user":
                 if type(message["content"]) == list:
                     image_list = [
@@ -319,18 +339,18 @@ async def get_gen_params(
                     # TODO(chris): This only applies to LLaVA model. Implement an image_token string in the conv template.
                     text = "<image>\n" * len(image_list)
                     text += "\n".join(text_list)
-                    conv.append_message(conv.roles[0], (text, image_list))
+                    conv_messages.append([conv.roles[0], (text, image_list)])
                 else:
-                    conv.append_message(conv.roles[0], message["content"])
+                    conv_messages.append([conv.roles[0], message["content"]])
             elif msg_role == "assistant":
-                conv.append_message(conv.roles[1], message["content"])
+                conv_messages.append([conv.roles[1], message["content"]])
             else:
                 raise ValueError(f"Unknown role: {msg_role}")
 
         # Add a blank message for the assistant.
-        conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
-        images = conv.get_images()
+        conv_messages.append([conv.roles[1], None])
+        prompt = conv.render(system_message, conv_messages)
+        images = conv.get_images(conv_messages)
 
     gen_params = {
         "model": model_name,
@@ -394,6 +414,49 @@ async def get_conv(model_name: str, worker_addr: str):
     return conv_template
 
 
+async def get_conv_renderer(model_name: str, worker_addr: str) -> PromptRenderer:
+    """Get the compiled conversation template of a worker's model."""
+    renderer = conv_renderer_map.get((worker_addr, model_name))
+    if renderer is None:
+        conv = await get_conv(model_name, worker_addr)
+        renderer = Conversation(
+            name=conv["name"],
+            system_template=conv["system_template"],
+            system_message=conv["system_message"],
+            roles=conv["roles"],
+            messages=conv["messages"],
+            offset=conv["offset"],
+            sep_style=SeparatorStyle(conv["sep_style"]),
+            sep=conv["sep"],
+            sep2=conv["sep2"],
+            stop_str=conv["stop_str"],
+            stop_token_ids=conv["stop_token_ids"],
+        ).compile()
+        conv_renderer_map[(worker_addr, model_name)] = renderer
+    return renderer
+
+
+async def refresh_admission_capacity():
+    """Follow the total concurrency reported by the workers."""
+    controller_address = app_settings.controller_address
+    while True:
+        try:
+            status = await fetch_remote(
+                controller_address + "/worker_get_status", None, ""
+            )
+            if status.get("capacity"):
+                admission_controller.set_capacity(status["capacity"])
+        except Exception as e:
+            logger.warning(f"Failed to refresh admission capacity: {e}")
+        await asyncio.sleep(ADMISSION_CAPACITY_REFRESH_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_admission_capacity_refresh():
+    if admission_controller is not None and app_settings.admission_capacity <= 0:
+        asyncio.create_task(refresh_admission_capacity())
+
+
 @app.get("/v1/models", dependencies=[Depends(check_api_key)])
 async def show_available_models():
     controller_address = app_settings.controller_address
@@ -485,12 +548,13 @@ async def create_chat_completion(request: ChatCompletionRequest):
 
 async def chat_completion_stream_generator(
     model_name: str, gen_params: Dict[str, Any], n: int, worker_addr: str
-) -> Generator[str, Any, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Event stream format:
     https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events#event_stream_format
     """
     id = f"chatcmpl-{shortuuid.random()}"
+    encoder = StreamChunkEncoder(id, model_name)
     finish_stream_events = []
     for i in range(n):
         # First chunk with role
@@ -502,13 +566,13 @@ async def chat_completion_stream_generator(
         chunk = ChatCompletionStreamResponse(
             id=id, choices=[choice_data], model=model_name
         )
-        yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+        yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n".encode()
 
         previous_text = ""
         async for content in generate_completion_stream(gen_params, worker_addr):
             if content["error_code"] != 0:
-                yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
+                yield encoder.event(content)
+                yield encoder.DONE
                 return
             decoded_unicode = content["text"].replace("\ufffd", "")
             delta_text = decoded_unicode[len(previous_text) :]
@@ -518,25 +582,16 @@ async def chat_completion_stream_generator(
                 else previous_text
             )
 
+            finish_reason = content.get("finish_reason", None)
             if len(delta_text) == 0:
-                delta_text = None
-            choice_data = ChatCompletionResponseStreamChoice(
-                index=i,
-                delta=DeltaMessage(content=delta_text),
-                finish_reason=content.get("finish_reason", None),
-            )
-            chunk = ChatCompletionStreamResponse(
-                id=id, choices=[choice_data], model=model_name
-            )
-            if delta_text is None:
-                if content.get("finish_reason", None) is not None:
-                    finish_stream_events.append(chunk)
+                if finish_reason is not None:
+                    finish_stream_events.append(encoder.chat_finish(i, finish_reason))
                 continue
-            yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
-    # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
+            yield encoder.chat_delta(i, delta_text, finish_reason)
+    # There is not "content" field in the last delta message.
     for finish_chunk in finish_stream_events:
-        yield f"data: {finish_chunk.model_dump_json(exclude_none=True)}\n\n"
-    yield "data: [DONE]\n\n"
+        yield finish_chunk
+    yield encoder.DONE
 
 
 @app.post("/v1/completions", dependencies=[Depends(check_api_key)])
@@ -620,9 +675,10 @@ async def create_completion(request: CompletionRequest):
 
 async def generate_completion_stream_generator(
     request: CompletionRequest, n: int, worker_addr: str
-):
+) -> AsyncGenerator[bytes, None]:
     model_name = request.model
     id = f"cmpl-{shortuuid.random()}"
+    encoder = StreamChunkEncoder(id, model_name, object="text_completion")
     finish_stream_events = []
     for text in request.prompt:
         for i in range(n):
@@ -643,8 +699,8 @@ async def generate_completion_stream_generator(
             )
             async for content in generate_completion_stream(gen_params, worker_addr):
                 if content["error_code"] != 0:
-                    yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
+                    yield encoder.event(content)
+                    yield encoder.DONE
                     return
                 decoded_unicode = content["text"].replace("\ufffd", "")
                 delta_text = decoded_unicode[len(previous_text) :]
@@ -654,31 +710,44 @@ async def generate_completion_stream_generator(
                     else previous_text
                 )
                 # todo: index is not apparent
-                choice_data = CompletionResponseStreamChoice(
-                    index=i,
-                    text=delta_text,
-                    logprobs=create_openai_logprobs(content.get("logprobs", None)),
+                chunk = encoder.completion_delta(
+                    i,
+                    delta_text,
+                    logprobs=content.get("logprobs", None),
                     finish_reason=content.get("finish_reason", None),
                 )
-                chunk = CompletionStreamResponse(
-                    id=id,
-                    object="text_completion",
-                    choices=[choice_data],
-                    model=model_name,
-                )
                 if len(delta_text) == 0:
                     if content.get("finish_reason", None) is not None:
                         finish_stream_events.append(chunk)
                     continue
-                yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
-    # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
+                yield chunk
     for finish_chunk in finish_stream_events:
-        yield f"data: {finish_chunk.model_dump_json(exclude_unset=True)}\n\n"
-    yield "data: [DONE]\n\n"
+        yield finish_chunk
+    yield encoder.DONE
 
 
 async def generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
-    controller_address = app_settings.controller_address
+    if response_cache is not None:
+        cached = response_cache.get(payload)
+        if cached is not None:
+            # Replay the final output as a single chunk; callers diff on text.
+            yield cached
+            return
+
+    last_content = None
+    async for content in _generate_completion_stream(payload, worker_addr):
+        last_content = content
+        yield content
+
+    if (
+        response_cache is not None
+        and last_content is not None
+        and last_content.get("finish_reason") is not None
+    ):
+        response_cache.put(payload, last_content)
+
+
+async def _generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
     async with httpx.AsyncClient() as client:
         delimiter = b"\0"
         async with client.stream(
@@ -700,7 +769,15 @@ async def generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
 
 
 async def generate_completion(payload: Dict[str, Any], worker_addr: str):
-    return await fetch_remote(worker_addr + "/worker_generate", payload, "")
+    if response_cache is not None:
+        cached = response_cache.get(payload)
+        if cached is not None:
+            return cached
+
+    content = await fetch_remote(worker_addr + "/worker_generate", payload, "")
+    if response_cache is not None and isinstance(content, dict):
+        response_cache.put(payload, content)
+    return content
 
 
 @app.post("/v1/embeddings", dependencies=[Depends(check_api_key)])
@@ -727,6 +804,7 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
             "model": request.model,
             "input": batch,
             "encoding_format": request.encoding_format,
+            "embedding_dtype": app_settings.embedding_dtype,
         }
         embedding = await get_embedding(payload)
         if "error_code" in embedding and embedding["error_code"] != 0:
@@ -740,7 +818,7 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
             for i, emb in enumerate(embedding["embedding"])
         ]
         token_num += embedding["token_num"]
-    return EmbeddingsResponse(
+    response = EmbeddingsResponse(
         data=data,
         model=request.model,
         usage=UsageInfo(
@@ -748,16 +826,40 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
             total_tokens=token_num,
             completion_tokens=None,
         ),
-    ).model_dump(exclude_none=True)
+    )
+    return Response(
+        content=response.model_dump_json(exclude_none=True),
+        media_type="application/json",
+    )
 
 
 async def get_embedding(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
     model_name = payload["model"]
     worker_addr = await get_worker_address(model_name)
 
-    embedding = await fetch_remote(worker_addr + "/worker_get_embeddings", payload)
-    return json.loads(embedding)
+    async with aiohttp.ClientSession(timeout=fetch_timeout) as session:
+        async with session.post(
+            worker_addr + "/worker_get_embeddings", json=payload
+        ) as response:
+            if response.status != 200:
+                return {
+                    "text": f"{response.reason}",
+                    "error_code": ErrorCode.INTERNAL_ERROR,
+                }
+            body = await response.read()
+            if response.content_type != EMBEDDING_MEDIA_TYPE:
+                # Workers without binary transport answer with JSON.
+                return json.loads(body)
+            shape = [int(x) for x in response.headers["X-Embedding-Shape"].split(",")]
+            return {
+                "embedding": unpack_embeddings(
+                    body,
+                    shape,
+                    response.headers["X-Embedding-Dtype"],
+                    payload["encoding_format"],
+                ),
+                "token_num": int(response.headers["X-Token-Num"]),
+            }
 
 
 ### GENERAL API - NOT OPENAI COMPATIBLE ###
@@ -872,6 +974,28 @@ async def create_chat_completion(request: APIChatCompletionRequest):
     return ChatCompletionResponse(model=request.model, choices=choices, usage=usage)
 
 
+@app.get("/api/v1/response_cache/stats", dependencies=[Depends(check_api_key)])
+async def get_response_cache_stats():
+    """
+    Reports hit and miss counters of the response cache.
+    This is not part of the OpenAI API spec.
+    """
+    if response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **response_cache.get_stats()}
+
+
+@app.get("/api/v1/admission/stats", dependencies=[Depends(check_api_key)])
+async def get_admission_stats():
+    """
+    Reports the state of the gateway admission queue.
+    This is not part of the OpenAI API spec.
+    """
+    if admission_controller is None:
+        return {"enabled": False}
+    return {"enabled": True, **admission_controller.get_stats()}
+
+
 ### END GENERAL API - NOT OPENAI COMPATIBLE ###
 
 
@@ -901,6 +1025,64 @@ def create_openai_api_server():
         type=lambda s: s.split(","),
         help="Optional list of comma separated API keys",
     )
+    parser.add_argument(
+        "--embedding-dtype",
+        type=str,
+        default="float32",
+        choices=EMBEDDING_TRANSPORT_DTYPES,
+        help="Precision of the binary embedding payload sent by workers. "
+        "float16 halves the transferred bytes at a small precision cost.",
+    )
+    parser.add_argument(
+        "--response-cache-size",
+        type=int,
+        default=0,
+        help="Cache up to this many responses of temperature-0 requests in memory. "
+        "0 disables the cache.",
+    )
+    parser.add_argument(
+        "--response-cache-dir",
+        type=str,
+        default=None,
+        help="Optional directory where cached responses are also stored on disk.",
+    )
+    parser.add_argument(
+        "--admission-control",
+        action="store_true",
+        help="Queue requests in the gateway with per-API-key priorities and rate limits.",
+    )
+    parser.add_argument(
+        "--admission-capacity",
+        type=int,
+        default=0,
+        help="Number of requests forwarded to workers at once. "
+        "0 follows the capacity reported by the workers.",
+    )
+    parser.add_argument(
+        "--admission-max-queue-size",
+        type=int,
+        default=256,
+        help="Maximum number of requests waiting in the gateway queue.",
+    )
+    parser.add_argument(
+        "--priority-classes",
+        type=json.loads,
+        default={},
+        help="Priority classes as JSON, e.g. "
+        '\'{"interactive": {"priority": 0}, "batch": {"priority": 2, "rate": 1, "max_queue_time": 5}}\'',
+    )
+    parser.add_argument(
+        "--api-key-classes",
+        type=json.loads,
+        default={},
+        help="Mapping from API key to priority class name as JSON.",
+    )
+    parser.add_argument(
+        "--default-priority-class",
+        type=str,
+        default="default",
+        help="Priority class of API keys not listed in --api-key-classes.",
+    )
     parser.add_argument(
         "--ssl",
         action="store_true",
@@ -919,6 +1101,27 @@ def create_openai_api_server():
     )
     app_settings.controller_address = args.controller_address
     app_settings.api_keys = args.api_keys
+    app_settings.embedding_dtype = args.embedding_dtype
+    if args.response_cache_size > 0:
+        global response_cache
+        response_cache = ResponseCache(
+            args.response_cache_size, cache_dir=args.response_cache_dir
+        )
+    if args.admission_control:
+        global admission_controller
+        app_settings.admission_capacity = args.admission_capacity
+        admission_controller = AdmissionController(
+            capacity=max(1, args.admission_capacity),
+            max_queue_size=args.admission_max_queue_size,
+            classes=parse_priority_classes(args.priority_classes),
+            key_classes=args.api_key_classes,
+            default_class=args.default_priority_class,
+        )
+        app.add_middleware(
+            AdmissionMiddleware,
+            controller=admission_controller,
+            path_prefixes=ADMISSION_PATH_PREFIXES,
+        )
 
     logger.info(f"args: {args}")
     return args
@@ -0,0 +1,109 @@
+"""
+An opt-in cache of worker responses for deterministic (greedy) requests.
+
+Entries are keyed on the normalized generation parameters sent to the worker,
+kept in an in-memory LRU and optionally written through to a local directory
+so that they survive restarts and can be shared by several API servers.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+
+def is_deterministic(gen_params: Dict[str, Any]) -> bool:
+    """Whether the worker will decode greedily for these parameters."""
+    temperature = gen_params.get("temperature")
+    top_p = gen_params.get("top_p")
+    # Same thresholds as fastchat.serve.inference.generate_stream
+    return (temperature is not None and temperature < 1e-5) or (
+        top_p is not None and top_p < 1e-8
+    )
+
+
+def make_cache_key(gen_params: Dict[str, Any]) -> str:
+    params = dict(gen_params)
+    # `stop` is built from a set, so its order is not stable across processes.
+    if params.get("stop"):
+        params["stop"] = sorted(params["stop"])
+    blob = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Size-bounded LRU of final worker outputs with an optional disk tier."""
+
+    def __init__(self, max_entries: int, cache_dir: Optional[str] = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, gen_params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if not is_deterministic(gen_params):
+            return None
+
+        key = make_cache_key(gen_params)
+        output = self.entries.get(key)
+        if output is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return output
+
+        output = self._read_disk(key)
+        if output is not None:
+            self._insert(key, output)
+            self.disk_hits += 1
+            return output
+
+        self.misses += 1
+        return None
+
+    def put(self, gen_params: Dict[str, Any], output: Dict[str, Any]):
+        if not is_deterministic(gen_params) or output.get("error_code", 0) != 0:
+            return
+
+        key = make_cache_key(gen_params)
+        self._insert(key, output)
+        self.stores += 1
+        if self.cache_dir is not None:
+            path = self._path(key)
+            with open(path + ".tmp", "w", encoding="utf-8") as fout:
+                json.dump(output, fout, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def _insert(self, key: str, output: Dict[str, Any]):
+        self.entries[key] = output
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return None
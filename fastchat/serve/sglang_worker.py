@@ -81,6 +81,8 @@ class SGLWorker(BaseModelWorker):
     async def generate_stream(self, params):
         self.call_ct += 1
 
+        if params.get("input_ids") is not None:
+            raise ValueError("This model only accepts text prompts, not input_ids.")
         prompt = params.pop("prompt")
         images = params.get("images", [])
         temperature = float(params.get("temperature", 1.0))
@@ -0,0 +1,106 @@
+"""
+Per-batch attention metadata shared by all layers of the patched llama attention.
+
+Every decoder layer of a forward pass receives the same `attention_mask` and
+`position_ids` tensors. The rotary cos/sin at those positions, the sequence
+boundaries of packed rows and the unpadding indices of padded rows are
+therefore computed by the first layer and reused by the others, instead of
+being rebuilt, with a device to host sync, in every layer.
+"""
+from typing import Callable, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers.models.llama.modeling_llama import rotate_half
+
+from fastchat.train.packing import get_cu_seqlens
+
+# name -> (key tensors, other key values, value)
+_cache = {}
+
+
+def cached(name: str, tensors: Tuple, key: Tuple, fn: Callable):
+    """Return `fn()`, computed once for the same `tensors` objects and `key`.
+
+    The cache keeps references to `tensors`, so their ids are not reused while
+    they are cached, and their versions, so in-place changes invalidate it.
+    Only the latest batch is kept for each name.
+    """
+    versions = tuple(t._version for t in tensors)
+    entry = _cache.get(name)
+    if (
+        entry is not None
+        and len(entry[0]) == len(tensors)
+        and all(a is b for a, b in zip(entry[0], tensors))
+        and entry[1] == (versions, key)
+    ):
+        return entry[2]
+    value = fn()
+    _cache[name] = (tensors, (versions, key), value)
+    return value
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def get_rotary_cos_sin(
+    rotary_emb, x: torch.Tensor, position_ids: torch.Tensor, seq_len: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """The rotary cos and sin at `position_ids`, of shape (b, s, head_dim)."""
+
+    def compute():
+        cos, sin = rotary_emb(x, seq_len=seq_len)
+        # (1, 1, seq_len, dim) in older transformers, (seq_len, dim) in newer.
+        return tuple(
+            t.reshape(-1, t.shape[-1])[position_ids].to(x.dtype) for t in (cos, sin)
+        )
+
+    # The rotary embeddings of all layers are the same.
+    return cached("rotary", (position_ids,), (seq_len, x.dtype, x.device), compute)
+
+
+def apply_rotary(
+    q: torch.Tensor, k: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor, dim: int
+):
+    """Rotate q and k by the cos and sin of `get_rotary_cos_sin`.
+
+    `dim` is the heads dimension of q and k: 2 for (b, s, h, d) and 1 for
+    (b, h, s, d).
+    """
+    cos, sin = cos.unsqueeze(dim), sin.unsqueeze(dim)
+    return tuple((x * cos) + (rotate_half(x) * sin) for x in (q, k))
+
+
+def get_packed_cu_seqlens(
+    position_ids: Optional[torch.Tensor], bsz: int, seq_len: int
+) -> Tuple[Optional[torch.Tensor], int]:
+    """Boundaries of the sequences packed into the rows, split where the
+    positions restart, or (None, 0) if no row holds more than one sequence."""
+    if position_ids is None:
+        return None, 0
+
+    def compute():
+        cu_seqlens, max_seqlen = get_cu_seqlens(position_ids.expand(bsz, seq_len))
+        if len(cu_seqlens) == bsz + 1:
+            return None, 0
+        return cu_seqlens, max_seqlen
+
+    return cached("packed", (position_ids,), (bsz, seq_len), compute)
+
+
+def get_unpad_info(
+    attention_mask: torch.Tensor, seq_len: int
+) -> Tuple[torch.Tensor, torch.Tensor, int]:
+    """The indices of the tokens kept by the last `seq_len` columns of a
+    (b, s) key padding mask, their cumulative sequence lengths and the longest
+    sequence, as computed by `flash_attn.bert_padding.unpad_input`."""
+
+    def compute():
+        mask = attention_mask[:, -seq_len:]
+        seqlens = mask.sum(dim=-1, dtype=torch.int32)
+        indices = torch.nonzero(mask.flatten(), as_tuple=False).flatten()
+        cu_seqlens = F.pad(torch.cumsum(seqlens, dim=0, dtype=torch.int32), (1, 0))
+        return indices, cu_seqlens, int(seqlens.max())
+
+    return cached(f"unpad_{seq_len}", (attention_mask,), (seq_len,), compute)
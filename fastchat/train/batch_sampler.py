@@ -0,0 +1,196 @@
+"""
+Token-budget batching for supervised fine-tuning.
+
+Instead of a fixed number of examples padded to `model_max_length`, every batch
+holds examples of similar length, as many as fit in a budget of tokens, padded
+to the longest one. Examples are shuffled, sorted by length within large
+buckets and cut into batches; the batch order is then shuffled again. All of
+it is seeded by the seed and the epoch, so every rank computes the same batches
+and a resumed run sees the same batches as the original one.
+"""
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler, Subset
+from transformers import Trainer, TrainerCallback
+
+
+def get_lengths(dataset: Dataset) -> List[int]:
+    """The number of non-padding tokens of every example.
+
+    Datasets without a `lengths` attribute are read in full, so a lazy
+    dataset tokenizes, and caches, the whole corpus before the first batch.
+    """
+    if isinstance(dataset, Subset):
+        lengths = get_lengths(dataset.dataset)
+        return [lengths[i] for i in dataset.indices]
+    if hasattr(dataset, "lengths"):
+        return list(dataset.lengths)
+    return [int(dataset[i]["attention_mask"].sum()) for i in range(len(dataset))]
+
+
+def make_batches(
+    lengths: Sequence[int], order: Sequence[int], max_tokens: int
+) -> List[List[int]]:
+    """Cut `order` into batches of at most `max_tokens` padded tokens."""
+    batches = []
+    batch, batch_len = [], 0
+    for i in order:
+        new_len = max(batch_len, lengths[i])
+        if batch and new_len * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch, new_len = [], lengths[i]
+        batch.append(i)
+        batch_len = new_len
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Batches of similar-length examples within a token budget.
+
+    With `num_replicas` > 1, every rank gets every `num_replicas`-th batch of
+    the same sequence. Neighbouring batches come from the same bucket, so the
+    ranks work on batches of similar lengths in each step. The number of
+    batches is rounded up to a multiple of `num_replicas` by repeating the
+    last ones.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+        bucket_size: int = 1024,
+    ):
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def get_batches(self) -> List[List[int]]:
+        """The batches of this rank in this epoch."""
+        if self._batches is not None:
+            return self._batches
+
+        lengths = self.lengths
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(lengths), generator=generator).tolist()
+            # Sort within buckets only, so that batches still vary between epochs.
+            buckets = [
+                sorted(order[i : i + self.bucket_size], key=lambda j: -lengths[j])
+                for i in range(0, len(order), self.bucket_size)
+            ]
+            order = [i for bucket in buckets for i in bucket]
+        else:
+            order = sorted(range(len(lengths)), key=lambda j: -lengths[j])
+        batches = make_batches(lengths, order, self.max_tokens)
+
+        # Repeat the last batches so that every rank gets as many.
+        if len(batches) % self.num_replicas:
+            batches += batches[len(batches) % self.num_replicas - self.num_replicas :]
+        # Shuffle whole steps, i.e. groups of one batch for each rank.
+        steps = [
+            batches[i : i + self.num_replicas]
+            for i in range(0, len(batches), self.num_replicas)
+        ]
+        if self.shuffle:
+            perm = torch.randperm(len(steps), generator=generator).tolist()
+            steps = [steps[i] for i in perm]
+        self._batches = [step[self.rank] for step in steps]
+        return self._batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.get_batches())
+
+    def __len__(self) -> int:
+        return len(self.get_batches())
+
+
+def collate_dynamic_padding(examples: List[Dict[str, torch.Tensor]]) -> Dict:
+    """Stack padded examples and cut the padding the batch does not need.
+
+    The columns that are padding in every example are cut from both ends, so
+    left and right padding both work.
+    """
+    batch = {key: torch.stack([e[key] for e in examples]) for key in examples[0]}
+    if "attention_mask" in batch:
+        columns = batch["attention_mask"].any(0).nonzero()
+        if len(columns):
+            start, end = int(columns[0]), int(columns[-1]) + 1
+            batch = {key: value[:, start:end] for key, value in batch.items()}
+    return batch
+
+
+class _SetEpochCallback(TrainerCallback):
+    def __init__(self):
+        self.sampler = None
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        if self.sampler is not None:
+            self.sampler.set_epoch(int(state.epoch or 0))
+
+
+class TokenBudgetTrainer(Trainer):
+    """A Trainer that batches by `args.max_tokens_per_batch` tokens.
+
+    The data loaders are not prepared by accelerate, as the sampler already
+    splits the batches between the ranks; the Trainer moves the batches to
+    the device itself. Distributed evaluation gathers per-example losses,
+    which needs the same batch size on every rank, so it keeps fixed-size
+    batches and only pads them dynamically.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get("data_collator") is None:
+            kwargs["data_collator"] = collate_dynamic_padding
+        super().__init__(*args, **kwargs)
+        self.set_epoch_callback = _SetEpochCallback()
+        self.add_callback(self.set_epoch_callback)
+
+    def _get_token_budget_dataloader(self, dataset, shuffle: bool) -> DataLoader:
+        sampler = TokenBudgetBatchSampler(
+            get_lengths(dataset),
+            self.args.max_tokens_per_batch,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+            shuffle=shuffle,
+            seed=self.args.seed,
+        )
+        if shuffle:
+            self.set_epoch_callback.sampler = sampler
+        return DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.train_dataset is None:
+            raise ValueError("Trainer: training requires a train_dataset.")
+        return self._get_token_budget_dataloader(self.train_dataset, shuffle=True)
+
+    def get_eval_dataloader(self, eval_dataset: Optional[Dataset] = None):
+        if self.args.world_size > 1 or isinstance(eval_dataset, str):
+            return super().get_eval_dataloader(eval_dataset)
+        if eval_dataset is None:
+            eval_dataset = self.eval_dataset
+        return self._get_token_budget_dataloader(eval_dataset, shuffle=False)
@@ -3,30 +3,20 @@ from typing import Optional, Tuple
 
 import torch
 from flash_attn import __version__ as flash_attn_version
-from flash_attn.bert_padding import pad_input, unpad_input
+from flash_attn.bert_padding import index_first_axis, pad_input
 from flash_attn.flash_attn_interface import (
     flash_attn_func,
+    flash_attn_varlen_func,
     flash_attn_varlen_kvpacked_func,
 )
-from transformers.models.llama.modeling_llama import (
-    LlamaAttention,
-    LlamaModel,
-    rotate_half,
-)
-
+from transformers.models.llama.modeling_llama import LlamaAttention, LlamaModel
 
-def apply_rotary_pos_emb(q, k, cos_sin, position_ids):
-    gather_indices = position_ids[:, :, None, None]  # [bsz, seq_len, 1, 1]
-    gather_indices = gather_indices.repeat(
-        1, 1, cos_sin[0].shape[1], cos_sin[0].shape[3]
-    )
-    bsz = gather_indices.shape[0]
-    cos, sin = (
-        torch.gather(x.transpose(1, 2).repeat(bsz, 1, 1, 1), 1, gather_indices)
-        for x in cos_sin
-    )
-    q, k = ((x * cos) + (rotate_half(x) * sin) for x in (q, k))
-    return q, k
+from fastchat.train.attention_cache import (
+    apply_rotary,
+    get_packed_cu_seqlens,
+    get_rotary_cos_sin,
+    get_unpad_info,
+)
 
 
 def forward(
@@ -63,8 +53,9 @@ def forward(
         past_kv_len = past_key_value[0].shape[2]
         kv_seq_len += past_kv_len
 
-    cos_sin = self.rotary_emb(v, seq_len=kv_seq_len)
-    q, k = apply_rotary_pos_emb(q, k, cos_sin, position_ids)
+    # Computed by the first layer and shared by the others.
+    cos, sin = get_rotary_cos_sin(self.rotary_emb, v, position_ids, kv_seq_len)
+    q, k = apply_rotary(q, k, cos, sin, dim=2)
 
     if past_key_value is not None:
         assert (
@@ -76,15 +67,38 @@ def forward(
 
     past_key_value = (k.transpose(1, 2), v.transpose(1, 2)) if use_cache else None
 
-    if attention_mask is None:
+    if attention_mask is None and past_kv_len == 0:
+        # Packed rows hold several sequences, split where the positions restart.
+        cu_seqlens, max_s = get_packed_cu_seqlens(position_ids, bsz, q_len)
+    else:
+        cu_seqlens = None
+
+    if cu_seqlens is not None:
+        output = flash_attn_varlen_func(
+            q.reshape(-1, self.num_heads, self.head_dim),
+            k.reshape(-1, kv_heads, self.head_dim),
+            v.reshape(-1, kv_heads, self.head_dim),
+            cu_seqlens,
+            cu_seqlens,
+            max_s,
+            max_s,
+            0.0,
+            softmax_scale=None,
+            causal=True,
+        ).view(bsz, q_len, -1)
+    elif attention_mask is None:
         output = flash_attn_func(q, k, v, 0.0, softmax_scale=None, causal=True).view(
             bsz, q_len, -1
         )
     else:
-        q, indices, cu_q_lens, max_s = unpad_input(q, attention_mask[:, -q_len:])
-        # We can skip concat and call unpad twice but seems better to call unpad only once.
-        kv, _, cu_k_lens, max_k = unpad_input(
-            torch.stack((k, v), dim=2), attention_mask
+        indices, cu_q_lens, max_s = get_unpad_info(attention_mask, q_len)
+        k_indices, cu_k_lens, max_k = get_unpad_info(attention_mask, kv_seq_len)
+        q = index_first_axis(
+            q.reshape(bsz * q_len, self.num_heads, self.head_dim), indices
+        )
+        kv = torch.stack((k, v), dim=2)
+        kv = index_first_axis(
+            kv.reshape(bsz * kv_seq_len, 2, kv_heads, self.head_dim), k_indices
         )
         output_unpad = flash_attn_varlen_kvpacked_func(
             q,
@@ -4,10 +4,16 @@ import warnings
 import torch
 from torch import nn
 import transformers
-from transformers.models.llama.modeling_llama import apply_rotary_pos_emb
 
 from flash_attn.flash_attn_interface import flash_attn_varlen_qkvpacked_func
-from flash_attn.bert_padding import unpad_input, pad_input
+from flash_attn.bert_padding import index_first_axis, pad_input
+
+from fastchat.train.attention_cache import (
+    apply_rotary,
+    get_packed_cu_seqlens,
+    get_rotary_cos_sin,
+    get_unpad_info,
+)
 
 
 def forward(
@@ -45,10 +51,11 @@ def forward(
     kv_seq_len = key_states.shape[-2]
     if past_key_value is not None:
         kv_seq_len += past_key_value[0].shape[-2]
-    cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
-    query_states, key_states = apply_rotary_pos_emb(
-        query_states, key_states, cos, sin, position_ids
+    # Computed by the first layer and shared by the others.
+    cos, sin = get_rotary_cos_sin(
+        self.rotary_emb, value_states, position_ids, kv_seq_len
     )
+    query_states, key_states = apply_rotary(query_states, key_states, cos, sin, dim=1)
 
     if past_key_value is not None:
         # reuse k, v
@@ -64,18 +71,22 @@ def forward(
 
     if key_padding_mask is None:
         qkv = qkv.reshape(-1, 3, self.num_heads, self.head_dim)
-        cu_q_lens = torch.arange(
-            0, (bsz + 1) * q_len, step=q_len, dtype=torch.int32, device=qkv.device
-        )
-        max_s = q_len
+        # Packed rows hold several sequences, split where the positions restart.
+        cu_q_lens, max_s = get_packed_cu_seqlens(position_ids, bsz, q_len)
+        if cu_q_lens is None:
+            cu_q_lens = torch.arange(
+                0, (bsz + 1) * q_len, q_len, dtype=torch.int32, device=qkv.device
+            )
+            max_s = q_len
         output = flash_attn_varlen_qkvpacked_func(
             qkv, cu_q_lens, max_s, 0.0, softmax_scale=None, causal=True
         )
         output = output.view(bsz, q_len, -1)
     else:
-        qkv = qkv.reshape(bsz, q_len, -1)
-        qkv, indices, cu_q_lens, max_s = unpad_input(qkv, key_padding_mask)
-        qkv = qkv.view(-1, 3, self.num_heads, self.head_dim)
+        indices, cu_q_lens, max_s = get_unpad_info(key_padding_mask, q_len)
+        qkv = index_first_axis(
+            qkv.reshape(bsz * q_len, 3, self.num_heads, self.head_dim), indices
+        )
         output_unpad = flash_attn_varlen_qkvpacked_func(
             qkv, cu_q_lens, max_s, 0.0, softmax_scale=None, causal=True
         )
@@ -91,6 +102,8 @@ def _prepare_decoder_attention_mask(
     self, attention_mask, input_shape, inputs_embeds, past_key_values_length
 ):
     # [bsz, seq_len]
+    if attention_mask is not None and torch.all(attention_mask):
+        return None  # Full rows, possibly packed, are split by position ids
     return attention_mask
 
 
@@ -10,6 +10,13 @@ import torch
 import transformers.models.llama.modeling_llama
 from torch import nn
 
+from fastchat.train.attention_cache import (
+    apply_rotary,
+    cached,
+    get_packed_cu_seqlens,
+    get_rotary_cos_sin,
+)
+
 try:
     import xformers.ops
 except ImportError:
@@ -51,13 +58,11 @@ def xformers_forward(
     kv_seq_len = key_states.shape[-2]
     if past_key_value is not None:
         kv_seq_len += past_key_value[0].shape[-2]
-    cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
-    (
-        query_states,
-        key_states,
-    ) = transformers.models.llama.modeling_llama.apply_rotary_pos_emb(
-        query_states, key_states, cos, sin, position_ids
+    # Computed by the first layer and shared by the others.
+    cos, sin = get_rotary_cos_sin(
+        self.rotary_emb, value_states, position_ids, kv_seq_len
     )
+    query_states, key_states = apply_rotary(query_states, key_states, cos, sin, dim=1)
     # [bsz, nh, t, hd]
 
     if past_key_value is not None:
@@ -73,9 +78,34 @@ def xformers_forward(
         key_states = key_states.transpose(1, 2)
         value_states = value_states.transpose(1, 2)
 
+        # Packed rows hold several sequences, split where the positions restart.
+        cu_seqlens = None
+        if kv_seq_len == q_len:
+            cu_seqlens, _ = get_packed_cu_seqlens(position_ids, bsz, q_len)
+        if cu_seqlens is not None:
+            attn_bias = cached(
+                "xformers_block_diagonal",
+                (cu_seqlens,),
+                (),
+                lambda: xformers.ops.fmha.BlockDiagonalCausalMask.from_seqlens(
+                    (cu_seqlens[1:] - cu_seqlens[:-1]).tolist()
+                ),
+            )
+            attn_output = xformers.ops.memory_efficient_attention(
+                query_states.reshape(1, bsz * q_len, self.num_heads, self.head_dim),
+                key_states.reshape(1, bsz * q_len, self.num_heads, self.head_dim),
+                value_states.reshape(1, bsz * q_len, self.num_heads, self.head_dim),
+                attn_bias=attn_bias,
+            )
         # This is a nasty hack. We know attention_mask in transformers is either LowerTriangular or all Zeros.
         # We therefore check if one element in the upper triangular portion is zero. If it is, then the mask is all zeros.
-        if attention_mask is None or attention_mask[0, 0, 0, 1] == 0:
+        # The check syncs with the device, so it is done once per forward.
+        elif attention_mask is None or cached(
+            "xformers_no_mask",
+            (attention_mask,),
+            (),
+            lambda: bool(attention_mask[0, 0, 0, 1] == 0),
+        ):
             # input and output should be of form (bsz, q_len, num_heads, head_dim)
             attn_output = xformers.ops.memory_efficient_attention(
                 query_states, key_states, value_states, attn_bias=None
@@ -0,0 +1,127 @@
+"""
+Sequence packing for supervised fine-tuning.
+
+Short conversations are concatenated into rows of `model_max_length` tokens
+instead of being padded to it one by one. Every packed row carries
+`position_ids` that restart at 0 at the beginning of each conversation. The
+attention monkey patches in this directory turn these restarts into
+variable-length (cu_seqlens) attention, so conversations packed into one row
+never attend to each other. HF models loaded with
+`attn_implementation="flash_attention_2"` do the same.
+"""
+import bisect
+from typing import Dict, List, Sequence, Tuple
+
+import torch
+from torch.utils.data import Dataset
+from transformers.trainer_pt_utils import LabelSmoother
+
+IGNORE_TOKEN_ID = LabelSmoother.ignore_index
+
+
+def pack_lengths(lengths: Sequence[int], max_length: int) -> List[List[int]]:
+    """Group example indices into rows of at most `max_length` tokens.
+
+    Uses best-fit decreasing: longest examples first, each into the row with
+    the least room left that still fits it.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+    rows = []
+    # Sorted (room left, row index) of the rows that are not full.
+    free = []
+    for i in order:
+        length = min(lengths[i], max_length)
+        pos = bisect.bisect_left(free, (length, -1))
+        if pos == len(free):
+            rows.append([i])
+            room, row = max_length - length, len(rows) - 1
+        else:
+            room, row = free.pop(pos)
+            rows[row].append(i)
+            room -= length
+        if room > 0:
+            bisect.insort(free, (room, row))
+    return rows
+
+
+def get_cu_seqlens(position_ids: torch.Tensor) -> Tuple[torch.Tensor, int]:
+    """Cumulative sequence lengths of a flattened batch of packed rows.
+
+    Sequences start wherever the position ids restart at 0, which includes the
+    start of every row. Returns the int32 boundaries and the longest length.
+    """
+    position_ids = position_ids.flatten()
+    starts = torch.nonzero(position_ids == 0).flatten()
+    end = torch.tensor([position_ids.numel()], device=position_ids.device)
+    cu_seqlens = torch.cat([starts, end]).to(torch.int32)
+    max_seqlen = int((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+    return cu_seqlens, max_seqlen
+
+
+# The attention monkey patches that split packed rows at position restarts.
+VARLEN_ATTENTION_PATCHES = (
+    "fastchat.train.llama_flash_attn_monkey_patch",
+    "fastchat.train.llama2_flash_attn_monkey_patch",
+    "fastchat.train.llama_xformers_attn_monkey_patch",
+)
+
+
+def check_packing_support(model: torch.nn.Module):
+    """Raise unless the attention of `model` keeps packed conversations apart.
+
+    Plain attention lets every token of a packed row attend to the earlier
+    conversations of the row, which silently trains on the wrong context.
+    """
+    attn_implementation = getattr(model.config, "_attn_implementation", None)
+    if attn_implementation and attn_implementation.startswith("flash_attention"):
+        return
+    for module in model.modules():
+        if type(module).forward.__module__ in VARLEN_ATTENTION_PATCHES:
+            return
+    raise ValueError(
+        "--pack_sequences needs attention that splits packed rows: train with "
+        "train_mem.py or train_xformers.py, or load the model with "
+        'attn_implementation="flash_attention_2".'
+    )
+
+
+class PackedDataset(Dataset):
+    """Pack the examples of a padded supervised dataset into full rows."""
+
+    def __init__(self, dataset: Dataset, max_length: int, pad_token_id: int):
+        super(PackedDataset, self).__init__()
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+
+        self.input_ids = []
+        self.labels = []
+        for i in range(len(dataset)):
+            example = dataset[i]
+            labels = example["labels"]
+            # Examples without any target (e.g. masked out) only cost FLOPs.
+            if not labels.ne(IGNORE_TOKEN_ID).any():
+                continue
+            mask = example["attention_mask"].bool()
+            self.input_ids.append(example["input_ids"][mask][:max_length])
+            self.labels.append(labels[mask][:max_length])
+        self.rows = pack_lengths([len(x) for x in self.input_ids], max_length)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        input_ids = torch.full((self.max_length,), self.pad_token_id)
+        labels = torch.full((self.max_length,), IGNORE_TOKEN_ID)
+        position_ids = torch.arange(self.max_length)
+        start = 0
+        for j in self.rows[i]:
+            end = start + len(self.input_ids[j])
+            input_ids[start:end] = self.input_ids[j]
+            labels[start:end] = self.labels[j]
+            # The first token is never predicted from the previous conversation.
+            labels[start] = IGNORE_TOKEN_ID
+            position_ids[start:end] = torch.arange(end - start)
+            start = end
+        # The padding at the end of the row is a sequence of its own.
+        position_ids[start:] = torch.arange(self.max_length - start)
+        return dict(input_ids=input_ids, labels=labels, position_ids=position_ids)
@@ -0,0 +1,222 @@
+"""
+Tokenize a training data file once into a memory-mapped cache.
+
+The cache is a directory with the token ids of all conversations back to back
+(input_ids.bin, int32), a byte per token that marks the tokens trained on
+(label_mask.bin), the start of every conversation (offsets.bin, int64) and a
+meta.json. Training maps these files instead of parsing and tokenizing the
+data in every rank, so startup is instant and all ranks on a node share the
+same page cache.
+
+Usage:
+python3 -m fastchat.train.pretokenize --model-path lmsys/vicuna-7b-v1.5 --data-path data.json --output-dir data-tokenized --model-max-length 2048
+"""
+import argparse
+import json
+import os
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+import transformers
+from transformers.trainer_pt_utils import LabelSmoother
+
+from fastchat.data.streaming import chunked, iter_records
+
+IGNORE_TOKEN_ID = LabelSmoother.ignore_index
+
+
+class TokenizedDatasetWriter:
+    """Append tokenized conversations to a cache directory."""
+
+    def __init__(self, output_dir: str, meta: Optional[Dict] = None):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.meta = dict(meta or {})
+        # meta.json is written last, so an interrupted run leaves no cache.
+        meta_path = os.path.join(output_dir, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        self.input_ids_file = open(os.path.join(output_dir, "input_ids.bin"), "wb")
+        self.label_mask_file = open(os.path.join(output_dir, "label_mask.bin"), "wb")
+        self.offsets = [0]
+
+    def write(self, input_ids: torch.Tensor, labels: torch.Tensor):
+        """Append one conversation, without padding."""
+        self.input_ids_file.write(input_ids.numpy().astype(np.int32).tobytes())
+        self.label_mask_file.write(
+            labels.ne(IGNORE_TOKEN_ID).numpy().astype(np.uint8).tobytes()
+        )
+        self.offsets.append(self.offsets[-1] + len(input_ids))
+
+    def close(self):
+        self.input_ids_file.close()
+        self.label_mask_file.close()
+        np.array(self.offsets, dtype=np.int64).tofile(
+            os.path.join(self.output_dir, "offsets.bin")
+        )
+        meta = dict(
+            self.meta,
+            num_examples=len(self.offsets) - 1,
+            num_tokens=self.offsets[-1],
+        )
+        with open(os.path.join(self.output_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.input_ids_file.close()
+            self.label_mask_file.close()
+
+
+class TokenizedDataset(Dataset):
+    """Supervised dataset read from a cache written by TokenizedDatasetWriter.
+
+    Examples are padded to `max_length` on access, like SupervisedDataset.
+    """
+
+    def __init__(self, path: str, max_length: int, pad_token_id: int):
+        super(TokenizedDataset, self).__init__()
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+        self.offsets = np.fromfile(os.path.join(path, "offsets.bin"), dtype=np.int64)
+        self.input_ids = None
+        self.label_mask = None
+
+    def _open(self):
+        # Mapped lazily so that data loader workers map the files themselves
+        # instead of receiving pickled copies.
+        shape = (self.meta["num_tokens"],)
+        self.input_ids = np.memmap(
+            os.path.join(self.path, "input_ids.bin"), np.int32, "r", shape=shape
+        )
+        self.label_mask = np.memmap(
+            os.path.join(self.path, "label_mask.bin"), np.uint8, "r", shape=shape
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["input_ids"] = state["label_mask"] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """The number of tokens of every example, read from the index only."""
+        return np.minimum(np.diff(self.offsets), self.max_length)
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        if self.input_ids is None:
+            self._open()
+        start = self.offsets[i]
+        end = min(self.offsets[i + 1], start + self.max_length)
+        length = end - start
+        tokens = torch.from_numpy(self.input_ids[start:end].astype(np.int64))
+        mask = torch.from_numpy(self.label_mask[start:end].astype(np.bool_))
+
+        input_ids = torch.full((self.max_length,), self.pad_token_id)
+        input_ids[:length] = tokens
+        labels = torch.full((self.max_length,), IGNORE_TOKEN_ID)
+        labels[:length] = torch.where(mask, tokens, IGNORE_TOKEN_ID)
+        attention_mask = torch.zeros(self.max_length, dtype=torch.bool)
+        attention_mask[:length] = True
+        return dict(input_ids=input_ids, labels=labels, attention_mask=attention_mask)
+
+
+def pretokenize(
+    model_path: str,
+    data_path: str,
+    output_dir: str,
+    model_max_length: int,
+    with_template: bool = False,
+    chunk_size: int = 1000,
+    use_fast_tokenizer: bool = False,
+    trust_remote_code: bool = False,
+):
+    # Same tokenizer setup as the training scripts.
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        model_path,
+        model_max_length=model_max_length,
+        padding_side="right",
+        use_fast=use_fast_tokenizer,
+        trust_remote_code=trust_remote_code,
+    )
+    tokenizer.pad_token = tokenizer.unk_token
+
+    if with_template:
+        from fastchat.train.train_with_template import preprocess
+
+        def preprocess_chunk(examples):
+            return preprocess(
+                [e["conversations"] for e in examples],
+                tokenizer,
+                model_path,
+                systems=[e.get("system", "") for e in examples],
+            )
+
+    else:
+        from fastchat.train.train import preprocess
+
+        def preprocess_chunk(examples):
+            return preprocess([e["conversations"] for e in examples], tokenizer)
+
+    meta = dict(
+        model_path=model_path,
+        data_path=data_path,
+        model_max_length=model_max_length,
+        with_template=with_template,
+    )
+    with TokenizedDatasetWriter(output_dir, meta) as writer:
+        for examples in tqdm(chunked(iter_records(data_path), chunk_size)):
+            data_dict = preprocess_chunk(examples)
+            for input_ids, labels, attention_mask in zip(
+                data_dict["input_ids"],
+                data_dict["labels"],
+                data_dict["attention_mask"],
+            ):
+                writer.write(input_ids[attention_mask], labels[attention_mask])
+    print(f"#examples: {len(writer.offsets) - 1}, #tokens: {writer.offsets[-1]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--output-dir", type=str, required=True)
+    parser.add_argument("--model-max-length", type=int, default=512)
+    parser.add_argument(
+        "--with-template",
+        action="store_true",
+        help="Preprocess like train_with_template.py instead of train.py",
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument(
+        "--use-fast-tokenizer",
+        action="store_true",
+        help="Match training with --use_fast_tokenizer True",
+    )
+    parser.add_argument("--trust-remote-code", action="store_true")
+    args = parser.parse_args()
+
+    pretokenize(
+        args.model_path,
+        args.data_path,
+        args.output_dir,
+        args.model_max_length,
+        with_template=args.with_template,
+        chunk_size=args.chunk_size,
+        use_fast_tokenizer=args.use_fast_tokenizer,
+        trust_remote_code=args.trust_remote_code,
+    )
@@ -0,0 +1,109 @@
+"""
+Stream a JSONL training file instead of loading it into every rank.
+
+Each rank and each data loader worker reads its own byte range of the file and
+tokenizes it on the fly, so startup is instant and memory does not depend on
+the size of the corpus. The stream repeats forever so that all ranks always
+have data; set the length of training with --max_steps. Records are read in
+file order, so shuffle the file beforehand.
+"""
+from typing import Callable, Dict, Iterator
+
+import torch
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from transformers import Trainer
+
+from fastchat.data.streaming import chunked, get_shard_range, iter_jsonl_range
+from fastchat.train.batch_sampler import collate_dynamic_padding
+
+
+def get_rank_and_world_size():
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+class StreamingSupervisedDataset(IterableDataset):
+    """Supervised examples tokenized on the fly from a sharded JSONL file.
+
+    `preprocess(sources, tokenizer)` turns a list of conversations into padded
+    `input_ids`, `labels` and `attention_mask`, like `train.preprocess`.
+    """
+
+    def __init__(
+        self,
+        data_path: str,
+        tokenizer,
+        preprocess: Callable,
+        chunk_size: int = 64,
+    ):
+        super(StreamingSupervisedDataset, self).__init__()
+        self.data_path = data_path
+        self.tokenizer = tokenizer
+        self.preprocess = preprocess
+        self.chunk_size = chunk_size
+
+    def get_shard(self):
+        """The index of the shard of this rank and worker, and the number of shards."""
+        rank, world_size = get_rank_and_world_size()
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return rank, world_size
+        return (
+            rank * worker_info.num_workers + worker_info.id,
+            world_size * worker_info.num_workers,
+        )
+
+    def iter_shard(self) -> Iterator[Dict[str, torch.Tensor]]:
+        start, end = get_shard_range(self.data_path, *self.get_shard())
+        records = iter_jsonl_range(self.data_path, start, end)
+        for chunk in chunked(records, self.chunk_size):
+            data_dict = self.preprocess(
+                [record["conversations"] for record in chunk], self.tokenizer
+            )
+            for i in range(len(chunk)):
+                yield dict(
+                    input_ids=data_dict["input_ids"][i],
+                    labels=data_dict["labels"][i],
+                    attention_mask=data_dict["attention_mask"][i],
+                )
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        while True:
+            empty = True
+            for example in self.iter_shard():
+                empty = False
+                yield example
+            if empty:
+                # Repeating an empty shard would never yield anything.
+                shard, num_shards = self.get_shard()
+                raise ValueError(
+                    f"Shard {shard} of {num_shards} of {self.data_path} has no "
+                    "records. Use fewer ranks or data loader workers."
+                )
+
+
+class StreamingTrainer(Trainer):
+    """A Trainer for StreamingSupervisedDataset.
+
+    The training data loader is not prepared by accelerate, which would either
+    read everything on the main process and dispatch it or read everything on
+    every rank; the dataset already splits the file between the ranks. Batches
+    are padded dynamically to their longest example.
+    """
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get("data_collator") is None:
+            kwargs["data_collator"] = collate_dynamic_padding
+        super().__init__(*args, **kwargs)
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.train_dataset is None:
+            raise ValueError("Trainer: training requires a train_dataset.")
+        return DataLoader(
+            self.train_dataset,
+            batch_size=self._train_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
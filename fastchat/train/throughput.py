@@ -0,0 +1,211 @@
+"""
+Throughput and MFU logging for the training scripts.
+
+ThroughputCallback writes one JSON line every `logging_steps` steps with:
+- tokens per second, counting only non-padding tokens, over all ranks
+- the fraction of the batches that is padding
+- achieved model TFLOPs per device and the model FLOPs utilization (MFU),
+  estimated from the model size and sequence lengths as 6 * N + 12 * L * H * S
+  FLOPs per token
+- the average time per step spent waiting for data, in forward, in backward
+  and in the optimizer step
+- the peak memory allocated on any device
+
+Tokens and forward times are measured by hooks on the model; the other phases
+by the Trainer's callback events. Phases are timed after synchronizing the
+device, which costs a little throughput itself.
+
+The peak TFLOPs of the device, needed for MFU, are looked up from its name or
+read from the FASTCHAT_PEAK_TFLOPS environment variable.
+"""
+import json
+import os
+import time
+from typing import Dict, Optional
+
+import torch
+from transformers import TrainerCallback
+
+# Dense 16-bit tensor core peak TFLOPs.
+PEAK_TFLOPS = {
+    "H100": 989,
+    "H800": 989,
+    "A100": 312,
+    "A800": 312,
+    "L40S": 362,
+    "L4": 121,
+    "A10G": 70,
+    "V100": 125,
+}
+
+PHASES = ("data_wait", "forward", "backward", "optimizer")
+
+
+def get_peak_tflops() -> Optional[float]:
+    if os.getenv("FASTCHAT_PEAK_TFLOPS"):
+        return float(os.getenv("FASTCHAT_PEAK_TFLOPS"))
+    if not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name()
+    # Longest names first, so that "L40S" is not taken for "L4".
+    for key in sorted(PEAK_TFLOPS, key=len, reverse=True):
+        if key in name:
+            return PEAK_TFLOPS[key]
+    return None
+
+
+def get_num_params(model) -> int:
+    """Parameters used in the matmuls of every token, i.e. without embeddings."""
+    embeddings = (
+        model.get_input_embeddings() if hasattr(model, "get_input_embeddings") else None
+    )
+    skip = set()
+    if embeddings is not None:
+        skip = {id(p) for p in embeddings.parameters()}
+    # ZeRO-3 partitions parameters; ds_numel is their full size.
+    return sum(
+        getattr(p, "ds_numel", p.numel())
+        for p in model.parameters()
+        if id(p) not in skip
+    )
+
+
+def get_flops_per_token(config, num_params: int, seq_len: int) -> float:
+    """Model FLOPs of the forward and backward pass of one token."""
+    num_layers = getattr(config, "num_hidden_layers", None) or getattr(
+        config, "num_layers", 0
+    )
+    hidden_size = getattr(config, "hidden_size", None) or getattr(config, "d_model", 0)
+    return 6 * num_params + 12 * num_layers * hidden_size * seq_len
+
+
+class ThroughputCallback(TrainerCallback):
+    def __init__(self, output_path: Optional[str] = None, synchronize: bool = True):
+        self.output_path = output_path
+        self.synchronize = synchronize
+        self.peak_tflops = get_peak_tflops()
+        self.handles = []
+        self.model = None
+
+    def _now(self) -> float:
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _reset_window(self):
+        self.window_start = self.mark = self._now()
+        self.window_steps = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.flops = 0.0
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.in_optimizer = False
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _forward_pre_hook(self, module, args, kwargs):
+        if not module.training:
+            return
+        now = self._now()
+        self.times["data_wait"] += now - self.mark
+        self.forward_start = now
+
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is None:
+            return
+        attention_mask = kwargs.get("attention_mask")
+        tokens = (
+            int(attention_mask.sum())
+            if attention_mask is not None
+            else input_ids.numel()
+        )
+        self.tokens += tokens
+        self.padded_tokens += input_ids.numel()
+        self.flops += tokens * get_flops_per_token(
+            module.config, self.num_params, input_ids.shape[-1]
+        )
+
+    def _forward_hook(self, module, args, kwargs, output):
+        if not module.training:
+            return
+        self.mark = self._now()
+        self.times["forward"] += self.mark - self.forward_start
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if self.output_path is None:
+            self.output_path = os.path.join(args.output_dir, "throughput.jsonl")
+        self.model = model
+        self.num_params = get_num_params(model)
+        self.handles = [
+            model.register_forward_pre_hook(self._forward_pre_hook, with_kwargs=True),
+            model.register_forward_hook(self._forward_hook, with_kwargs=True),
+        ]
+        self._reset_window()
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        now = self._now()
+        self.times["backward"] += now - self.mark
+        self.mark = now
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        now = self._now()
+        self.times["backward"] += now - self.mark
+        self.mark = now
+        self.in_optimizer = True
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = self._now()
+        # Without the optimizer events (older transformers), the optimizer
+        # step is counted as part of backward.
+        self.times["optimizer" if self.in_optimizer else "backward"] += now - self.mark
+        self.mark = now
+        self.in_optimizer = False
+        self.window_steps += 1
+
+        interval = max(int(args.logging_steps), 1)
+        if state.global_step % interval == 0:
+            record = self._get_record(args, state, now)
+            if state.is_world_process_zero:
+                with open(self.output_path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            self._reset_window()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _get_record(self, args, state, now: float) -> Dict:
+        elapsed = now - self.window_start
+        totals = torch.tensor([self.tokens, self.padded_tokens], dtype=torch.float64)
+        flops = self.flops
+        peak_memory = 0.0
+        if torch.cuda.is_available():
+            peak_memory = torch.cuda.max_memory_allocated() / 2**30
+        world_size = 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            world_size = torch.distributed.get_world_size()
+            device = "cuda" if torch.distributed.get_backend() == "nccl" else "cpu"
+            stats = totals.to(device)
+            torch.distributed.all_reduce(stats)
+            totals = stats.cpu()
+            memory = torch.tensor([peak_memory], device=device)
+            torch.distributed.all_reduce(memory, op=torch.distributed.ReduceOp.MAX)
+            peak_memory = memory.item()
+        tokens, padded_tokens = totals.tolist()
+
+        tflops = flops / elapsed / 1e12
+        return {
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "tokens_per_second": tokens / elapsed,
+            "tokens_per_second_per_device": tokens / elapsed / world_size,
+            "padding_fraction": 1 - tokens / padded_tokens if padded_tokens else 0.0,
+            "tflops_per_device": tflops,
+            "mfu": tflops / self.peak_tflops if self.peak_tflops else None,
+            "step_time": {
+                phase: value / self.window_steps for phase, value in self.times.items()
+            },
+            "seconds_per_step": elapsed / self.window_steps,
+            "peak_memory_gib": peak_memory,
+        }
@@ -15,10 +15,9 @@
 #    limitations under the License.
 
 from dataclasses import dataclass, field
-import json
 import math
 import pathlib
-from typing import Dict, Optional, Sequence
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 import torch
@@ -28,7 +27,16 @@ from transformers import Trainer
 from transformers.trainer_pt_utils import LabelSmoother
 
 from fastchat.conversation import SeparatorStyle
+from fastchat.data.streaming import iter_records
 from fastchat.model.model_adapter import get_conversation_template
+from fastchat.train.batch_sampler import TokenBudgetTrainer
+from fastchat.train.packing import PackedDataset, check_packing_support
+from fastchat.train.pretokenize import TokenizedDataset
+from fastchat.train.streaming_dataset import (
+    StreamingSupervisedDataset,
+    StreamingTrainer,
+)
+from fastchat.train.throughput import ThroughputCallback
 
 IGNORE_TOKEN_ID = LabelSmoother.ignore_index
 
@@ -45,6 +53,12 @@ class ModelArguments:
     padding_side: str = field(
         default="right", metadata={"help": "The padding side in tokenizer"}
     )
+    use_fast_tokenizer: bool = field(
+        default=False,
+        metadata={
+            "help": "Use the fast tokenizer, which masks the targets from token offsets in a single pass"
+        },
+    )
 
 
 @dataclass
@@ -55,7 +69,35 @@ class DataArguments:
     eval_data_path: str = field(
         default=None, metadata={"help": "Path to the evaluation data."}
     )
+    tokenized_data_path: str = field(
+        default=None,
+        metadata={
+            "help": "Path to the training data tokenized by fastchat.train.pretokenize. Used instead of data_path."
+        },
+    )
+    eval_tokenized_data_path: str = field(
+        default=None,
+        metadata={"help": "Path to the tokenized evaluation data."},
+    )
     lazy_preprocess: bool = False
+    streaming: bool = field(
+        default=False,
+        metadata={
+            "help": "Stream a .jsonl data_path, split between ranks and data loader workers, instead of loading it. Requires --max_steps."
+        },
+    )
+    pack_sequences: bool = field(
+        default=False,
+        metadata={
+            "help": "Pack conversations into full rows of model_max_length tokens. Requires flash or xformers attention (train_mem.py, train_xformers.py), which keeps packed conversations from attending to each other."
+        },
+    )
+
+    def __post_init__(self):
+        if self.streaming and not (self.data_path or "").endswith(".jsonl"):
+            raise ValueError(
+                f"--streaming needs a .jsonl data_path, got {self.data_path}"
+            )
 
 
 @dataclass
@@ -68,6 +110,18 @@ class TrainingArguments(transformers.TrainingArguments):
             "help": "Maximum sequence length. Sequences will be right padded (and possibly truncated)."
         },
     )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Batch examples of similar length up to this many tokens per device, padded to the longest one, instead of per_device_train_batch_size examples. With --lazy_preprocess, all examples are tokenized up front to read their lengths."
+        },
+    )
+    log_throughput: bool = field(
+        default=False,
+        metadata={
+            "help": "Write tokens/s, MFU, the step time breakdown and peak memory to throughput.jsonl in the output directory."
+        },
+    )
 
 
 local_rank = None
@@ -89,6 +143,50 @@ def trainer_save_model_safe(trainer: transformers.Trainer):
         trainer.save_model()
 
 
+def get_target_spans(conv, spans) -> List[Tuple[int, int]]:
+    """Character spans of the assistant outputs, from `get_prompt_with_spans`."""
+    return [
+        (content_start, end)
+        for (role, _), (_, content_start, end) in zip(conv.messages, spans)
+        if role == conv.roles[1]
+    ]
+
+
+def mask_targets_by_offsets(
+    targets: torch.Tensor,
+    offset_mapping: torch.Tensor,
+    attention_mask: torch.Tensor,
+    conversations: List[str],
+    target_spans: List[List[Tuple[int, int]]],
+) -> torch.Tensor:
+    """Only compute loss on the tokens that start inside the target spans.
+
+    Special and padding tokens, which cover no characters, are ignored. Like
+    the per-turn masking, a conversation that fits but whose tokens do not
+    cover all of its text or all of its targets is ignored entirely.
+    """
+    starts, ends = offset_mapping[..., 0], offset_mapping[..., 1]
+    keep = torch.zeros_like(targets, dtype=torch.bool)
+    for i, spans in enumerate(target_spans):
+        covered = []
+        for start, end in spans:
+            in_span = (starts[i] >= start) & (starts[i] < end) & (ends[i] > starts[i])
+            keep[i] |= in_span
+            covered.append(end == start or bool(in_span.any()))
+        if attention_mask[i].all():
+            # Truncated: the targets that fit are still trained on.
+            continue
+        text_len = int(ends[i].max())
+        if text_len < len(conversations[i].rstrip()) or not all(covered):
+            keep[i] = False
+            rank0_print(
+                f"WARNING: tokenization mismatch: {text_len} vs. "
+                f"{len(conversations[i])} characters. (ignored)"
+            )
+    targets[~keep] = IGNORE_TOKEN_ID
+    return targets
+
+
 def preprocess(
     sources,
     tokenizer: transformers.PreTrainedTokenizer,
@@ -98,6 +196,7 @@ def preprocess(
 
     # Apply prompt templates
     conversations = []
+    target_spans = []
     for i, source in enumerate(sources):
         if roles[source[0]["from"]] != conv.roles[0]:
             # Skip the first one if it is not from human
@@ -108,7 +207,33 @@ def preprocess(
             role = roles[sentence["from"]]
             assert role == conv.roles[j % 2], f"{i}"
             conv.append_message(role, sentence["value"])
-        conversations.append(conv.get_prompt())
+        prompt, spans = conv.get_prompt_with_spans()
+        conversations.append(prompt)
+        target_spans.append(get_target_spans(conv, spans))
+
+    if tokenizer.is_fast:
+        # Mask targets in the same pass using the character offsets of tokens.
+        encoding = tokenizer(
+            conversations,
+            return_tensors="pt",
+            padding="max_length",
+            max_length=tokenizer.model_max_length,
+            truncation=True,
+            return_offsets_mapping=True,
+        )
+        input_ids = encoding.input_ids
+        targets = mask_targets_by_offsets(
+            input_ids.clone(),
+            encoding.offset_mapping,
+            encoding.attention_mask,
+            conversations,
+            target_spans,
+        )
+        return dict(
+            input_ids=input_ids,
+            labels=targets,
+            attention_mask=input_ids.ne(tokenizer.pad_token_id),
+        )
 
     # Tokenize conversations
     input_ids = tokenizer(
@@ -232,24 +357,62 @@ class LazySupervisedDataset(Dataset):
         return ret
 
 
+def load_tokenized_dataset(
+    path: str, tokenizer: transformers.PreTrainedTokenizer
+) -> TokenizedDataset:
+    dataset = TokenizedDataset(path, tokenizer.model_max_length, tokenizer.pad_token_id)
+    if dataset.meta.get("model_max_length") != tokenizer.model_max_length:
+        rank0_print(
+            f"WARNING: {path} was tokenized with model_max_length="
+            f"{dataset.meta.get('model_max_length')}, "
+            f"training uses {tokenizer.model_max_length}."
+        )
+    return dataset
+
+
 def make_supervised_data_module(
     tokenizer: transformers.PreTrainedTokenizer, data_args
 ) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
+    # Packing needs the length of every example, so it preprocesses eagerly.
     dataset_cls = (
-        LazySupervisedDataset if data_args.lazy_preprocess else SupervisedDataset
+        LazySupervisedDataset
+        if data_args.lazy_preprocess and not data_args.pack_sequences
+        else SupervisedDataset
     )
     rank0_print("Loading data...")
 
-    train_json = json.load(open(data_args.data_path, "r"))
-    train_dataset = dataset_cls(train_json, tokenizer=tokenizer)
+    if data_args.tokenized_data_path:
+        train_dataset = load_tokenized_dataset(data_args.tokenized_data_path, tokenizer)
+    elif data_args.streaming:
+        if data_args.pack_sequences:
+            raise ValueError("Packing needs all the data and cannot be streamed.")
+        train_dataset = StreamingSupervisedDataset(
+            data_args.data_path, tokenizer, preprocess
+        )
+    else:
+        train_json = list(iter_records(data_args.data_path))
+        train_dataset = dataset_cls(train_json, tokenizer=tokenizer)
 
-    if data_args.eval_data_path:
-        eval_json = json.load(open(data_args.eval_data_path, "r"))
+    if data_args.eval_tokenized_data_path:
+        eval_dataset = load_tokenized_dataset(
+            data_args.eval_tokenized_data_path, tokenizer
+        )
+    elif data_args.eval_data_path:
+        eval_json = list(iter_records(data_args.eval_data_path))
         eval_dataset = dataset_cls(eval_json, tokenizer=tokenizer)
     else:
         eval_dataset = None
 
+    if data_args.pack_sequences:
+        train_dataset = PackedDataset(
+            train_dataset, tokenizer.model_max_length, tokenizer.pad_token_id
+        )
+        if eval_dataset is not None:
+            eval_dataset = PackedDataset(
+                eval_dataset, tokenizer.model_max_length, tokenizer.pad_token_id
+            )
+
     return dict(train_dataset=train_dataset, eval_dataset=eval_dataset)
 
 
@@ -281,12 +444,14 @@ def train():
         cache_dir=training_args.cache_dir,
         trust_remote_code=model_args.trust_remote_code,
     )
+    if data_args.pack_sequences:
+        check_packing_support(model)
     tokenizer = transformers.AutoTokenizer.from_pretrained(
         model_args.model_name_or_path,
         cache_dir=training_args.cache_dir,
         model_max_length=training_args.model_max_length,
         padding_side=model_args.padding_side,
-        use_fast=False,
+        use_fast=model_args.use_fast_tokenizer,
         trust_remote_code=model_args.trust_remote_code,
     )
 
@@ -297,9 +462,17 @@ def train():
     data_module = make_supervised_data_module(tokenizer=tokenizer, data_args=data_args)
 
     # Start trainner
-    trainer = Trainer(
+    if data_args.streaming:
+        trainer_cls = StreamingTrainer
+    elif training_args.max_tokens_per_batch:
+        trainer_cls = TokenBudgetTrainer
+    else:
+        trainer_cls = Trainer
+    trainer = trainer_cls(
         model=model, tokenizer=tokenizer, args=training_args, **data_module
     )
+    if training_args.log_throughput:
+        trainer.add_callback(ThroughputCallback())
     if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):
         trainer.train(resume_from_checkpoint=True)
     else:
@@ -31,6 +31,7 @@ from transformers.trainer_pt_utils import LabelSmoother
 
 from fastchat.conversation import SeparatorStyle
 from fastchat.model.model_adapter import get_conversation_template
+from fastchat.train.throughput import ThroughputCallback
 
 IGNORE_TOKEN_ID = LabelSmoother.ignore_index
 
@@ -58,6 +59,12 @@ class TrainingArguments(transformers.TrainingArguments):
             "help": "Maximum sequence length. Sequences will be right padded (and possibly truncated)."
         },
     )
+    log_throughput: bool = field(
+        default=False,
+        metadata={
+            "help": "Write tokens/s, MFU, the step time breakdown and peak memory to throughput.jsonl in the output directory."
+        },
+    )
 
 
 local_rank = None
@@ -320,6 +327,8 @@ def train():
     trainer = Trainer(
         model=model, tokenizer=tokenizer, args=training_args, **data_module
     )
+    if training_args.log_throughput:
+        trainer.add_callback(ThroughputCallback())
 
     if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):
         trainer.train(resume_from_checkpoint=True)
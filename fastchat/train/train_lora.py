@@ -28,6 +28,8 @@ import transformers
 from transformers import Trainer, BitsAndBytesConfig, deepspeed
 import torch
 
+from fastchat.train.batch_sampler import TokenBudgetTrainer
+from fastchat.train.streaming_dataset import StreamingTrainer
 from fastchat.train.train import (
     DataArguments,
     ModelArguments,
@@ -37,6 +39,8 @@ from fastchat.train.train import (
 from fastchat.train.llama_flash_attn_monkey_patch import (
     replace_llama_attn_with_flash_attn,
 )
+from fastchat.train.packing import check_packing_support
+from fastchat.train.throughput import ThroughputCallback
 
 
 @dataclass
@@ -50,6 +54,18 @@ class TrainingArguments(transformers.TrainingArguments):
         },
     )
     flash_attn: bool = False
+    max_tokens_per_batch: typing.Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Batch examples of similar length up to this many tokens per device, padded to the longest one, instead of per_device_train_batch_size examples. With --lazy_preprocess, all examples are tokenized up front to read their lengths."
+        },
+    )
+    log_throughput: bool = field(
+        default=False,
+        metadata={
+            "help": "Write tokens/s, MFU, the step time breakdown and peak memory to throughput.jsonl in the output directory."
+        },
+    )
 
 
 @dataclass
@@ -163,6 +179,8 @@ def train():
             model.model_parallel = True
 
     model = get_peft_model(model, lora_config)
+    if data_args.pack_sequences:
+        check_packing_support(model)
     if training_args.flash_attn:
         for name, module in model.named_modules():
             if "norm" in name:
@@ -181,14 +199,22 @@ def train():
         cache_dir=training_args.cache_dir,
         model_max_length=training_args.model_max_length,
         padding_side="right",
-        use_fast=False,
+        use_fast=model_args.use_fast_tokenizer,
     )
     tokenizer.pad_token = tokenizer.unk_token
 
     data_module = make_supervised_data_module(tokenizer=tokenizer, data_args=data_args)
-    trainer = Trainer(
+    if data_args.streaming:
+        trainer_cls = StreamingTrainer
+    elif training_args.max_tokens_per_batch:
+        trainer_cls = TokenBudgetTrainer
+    else:
+        trainer_cls = Trainer
+    trainer = trainer_cls(
         model=model, tokenizer=tokenizer, args=training_args, **data_module
     )
+    if training_args.log_throughput:
+        trainer.add_callback(ThroughputCallback())
 
     model.config.use_cache = False
 
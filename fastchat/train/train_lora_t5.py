@@ -43,6 +43,7 @@ from fastchat.train.train_flant5 import (
 from fastchat.train.train_lora import get_peft_state_maybe_zero_3
 
 from fastchat.model.model_adapter import get_conversation_template
+from fastchat.train.throughput import ThroughputCallback
 
 default_conversation = get_conversation_template("t5")
 
@@ -93,6 +94,12 @@ class TrainingArguments(transformers.TrainingArguments):
             "help": "Maximum sequence length. Sequences will be right padded (and possibly truncated)."
         },
     )
+    log_throughput: bool = field(
+        default=False,
+        metadata={
+            "help": "Write tokens/s, MFU, the step time breakdown and peak memory to throughput.jsonl in the output directory."
+        },
+    )
 
 
 def safe_save_model_for_hf_trainer(
@@ -194,6 +201,8 @@ def train():
     trainer = Trainer(
         model=model, tokenizer=tokenizer, args=training_args, **data_module
     )
+    if training_args.log_throughput:
+        trainer.add_callback(ThroughputCallback())
 
     if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):
         trainer.train(resume_from_checkpoint=True)
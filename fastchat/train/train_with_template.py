@@ -15,22 +15,28 @@
 #    limitations under the License.
 
 from dataclasses import dataclass, field
-import json
+import functools
 import math
-import jsonlines
+import os
 import pathlib
 from multiprocessing import Pool
 from typing import Dict, Optional, Sequence
 
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
 import transformers
 from transformers import Trainer
 from transformers.trainer_pt_utils import LabelSmoother
 
 from fastchat.conversation import SeparatorStyle
+from fastchat.data.streaming import iter_records
 from fastchat.model.model_adapter import get_conversation_template
+from fastchat.train.batch_sampler import TokenBudgetTrainer
+from fastchat.train.packing import PackedDataset, check_packing_support
+from fastchat.train.pretokenize import TokenizedDataset
+from fastchat.train.train import get_target_spans, mask_targets_by_offsets
+from fastchat.train.throughput import ThroughputCallback
 
 IGNORE_TOKEN_ID = LabelSmoother.ignore_index
 
@@ -38,6 +44,12 @@ IGNORE_TOKEN_ID = LabelSmoother.ignore_index
 @dataclass
 class ModelArguments:
     model_name_or_path: Optional[str] = field(default="facebook/opt-125m")
+    use_fast_tokenizer: bool = field(
+        default=False,
+        metadata={
+            "help": "Use the fast tokenizer, which masks the targets from token offsets in a single pass"
+        },
+    )
 
 
 @dataclass
@@ -45,7 +57,25 @@ class DataArguments:
     data_path: str = field(
         default=None, metadata={"help": "Path to the training data."}
     )
+    tokenized_data_path: str = field(
+        default=None,
+        metadata={
+            "help": "Path to the training data tokenized by fastchat.train.pretokenize --with-template. Used instead of data_path."
+        },
+    )
     lazy_preprocess: bool = False
+    preprocess_num_proc: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Number of processes to preprocess the data with. Defaults to the number of CPUs."
+        },
+    )
+    pack_sequences: bool = field(
+        default=False,
+        metadata={
+            "help": "Pack conversations into full rows of model_max_length tokens. Requires flash or xformers attention (train_mem.py, train_xformers.py), which keeps packed conversations from attending to each other."
+        },
+    )
 
 
 @dataclass
@@ -58,6 +88,18 @@ class TrainingArguments(transformers.TrainingArguments):
             "help": "Maximum sequence length. Sequences will be right padded (and possibly truncated)."
         },
     )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Batch examples of similar length up to this many tokens per device, padded to the longest one, instead of per_device_train_batch_size examples. With --lazy_preprocess, all examples are tokenized up front to read their lengths."
+        },
+    )
+    log_throughput: bool = field(
+        default=False,
+        metadata={
+            "help": "Write tokens/s, MFU, the step time breakdown and peak memory to throughput.jsonl in the output directory."
+        },
+    )
 
 
 local_rank = None
@@ -97,6 +139,29 @@ def apply_prompt_template(sources, template_id, systems=None):
     return conversations, conv
 
 
+def apply_prompt_template_with_spans(sources, template_id, systems=None):
+    """Like apply_prompt_template, with the character spans of the targets."""
+    conv = get_conversation_template(template_id)
+    roles = {"human": conv.roles[0], "gpt": conv.roles[1]}
+    conversations = []
+    target_spans = []
+    for i, source in enumerate(sources):
+        if roles[source[0]["from"]] != conv.roles[0]:
+            source = source[1:]
+
+        conv.messages = []
+        for j, sentence in enumerate(source):
+            role = roles[sentence["from"]]
+            assert role == conv.roles[j % 2], f"{i}"
+            conv.append_message(role, sentence["value"])
+        if systems and systems[i]:
+            conv.set_system_message(systems[i])
+        prompt, spans = conv.get_prompt_with_spans()
+        conversations.append(prompt)
+        target_spans.append(get_target_spans(conv, spans))
+    return conversations, target_spans
+
+
 def tokenize_conversations(conversations, tokenizer):
     input_ids = tokenizer(
         conversations,
@@ -195,29 +260,85 @@ def mask_targets(conversations, targets, tokenizer, conv):
     return targets
 
 
+def preprocess_chunk(sources, tokenizer, template_id, systems=None):
+    if tokenizer.is_fast:
+        # Mask targets in the same pass using the character offsets of tokens.
+        conversations, target_spans = apply_prompt_template_with_spans(
+            sources, template_id, systems
+        )
+        encoding = tokenizer(
+            conversations,
+            return_tensors="pt",
+            padding="max_length",
+            max_length=tokenizer.model_max_length,
+            truncation=True,
+            return_offsets_mapping=True,
+        )
+        input_ids = encoding.input_ids
+        targets = mask_targets_by_offsets(
+            input_ids.clone(),
+            encoding.offset_mapping,
+            encoding.attention_mask,
+            conversations,
+            target_spans,
+        )
+        return input_ids, targets
+
+    conversations, conv = apply_prompt_template(sources, template_id, systems)
+    input_ids, targets = tokenize_conversations(conversations, tokenizer)
+    targets = mask_targets(conversations, targets, tokenizer, conv)
+    return input_ids, targets
+
+
+# State of the preprocessing worker processes, set once by init_preprocess_worker.
+_worker_tokenizer = None
+_worker_template_id = None
+
+
+def init_preprocess_worker(tokenizer, template_id):
+    global _worker_tokenizer, _worker_template_id
+    _worker_tokenizer = tokenizer
+    _worker_template_id = template_id
+
+
+def preprocess_worker_chunk(args):
+    sources, systems = args
+    return preprocess_chunk(sources, _worker_tokenizer, _worker_template_id, systems)
+
+
 def preprocess(
-    sources, tokenizer: transformers.PreTrainedTokenizer, template_id, **kwargs
+    sources,
+    tokenizer: transformers.PreTrainedTokenizer,
+    template_id,
+    num_proc=None,
+    **kwargs,
 ) -> Dict:
     systems = None if not kwargs else kwargs.get("systems", None)
+    num_proc = num_proc or os.cpu_count() or 1
 
     # If the data volume is small, process it directly in the main thread
-    if len(sources) <= 1000:
-        conversations, conv = apply_prompt_template(sources, template_id, systems)
-        input_ids, targets = tokenize_conversations(conversations, tokenizer)
-        targets = mask_targets(conversations, targets, tokenizer, conv)
-    else:  # If the data volume is large, use multithreading for processing
-        with Pool() as p:
-            conversations, conv = p.apply_async(
-                apply_prompt_template, (sources, template_id, systems)
-            ).get()
-            input_ids, targets = p.apply_async(
-                tokenize_conversations, (conversations, tokenizer)
-            ).get()
-            targets = p.apply_async(
-                mask_targets, (conversations, targets, tokenizer, conv)
-            ).get()
-            p.close()
-            p.join()
+    if len(sources) <= 1000 or num_proc == 1:
+        input_ids, targets = preprocess_chunk(sources, tokenizer, template_id, systems)
+    else:  # If the data volume is large, process chunks in parallel
+        # A few chunks per process balance the load; the tokenizer is sent to
+        # every process once instead of with every chunk.
+        chunk_size = min(1000, math.ceil(len(sources) / (4 * num_proc)))
+        chunks = [
+            (
+                sources[i : i + chunk_size],
+                systems[i : i + chunk_size] if systems else None,
+            )
+            for i in range(0, len(sources), chunk_size)
+        ]
+        with Pool(
+            num_proc,
+            initializer=init_preprocess_worker,
+            initargs=(tokenizer, template_id),
+        ) as p:
+            # Results come back in order as soon as each chunk is done.
+            results = list(p.imap(preprocess_worker_chunk, chunks))
+        input_ids = torch.cat([r[0] for r in results])
+        targets = torch.cat([r[1] for r in results])
 
     return dict(
         input_ids=input_ids,
@@ -230,7 +351,11 @@ class SupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
     def __init__(
-        self, raw_data, tokenizer: transformers.PreTrainedTokenizer, template_id
+        self,
+        raw_data,
+        tokenizer: transformers.PreTrainedTokenizer,
+        template_id,
+        num_proc=None,
     ):
         super(SupervisedDataset, self).__init__()
 
@@ -238,7 +363,9 @@ class SupervisedDataset(Dataset):
         systems = [example.get("system", "") for example in raw_data]
         sources = [example["conversations"] for example in raw_data]
 
-        data_dict = preprocess(sources, tokenizer, template_id, systems=systems)
+        data_dict = preprocess(
+            sources, tokenizer, template_id, num_proc=num_proc, systems=systems
+        )
 
         self.input_ids = data_dict["input_ids"]
         self.labels = data_dict["labels"]
@@ -300,20 +427,29 @@ def make_supervised_data_module(
 ) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
     train_ratio = min(train_ratio, 1.0)
+    # Packing needs the length of every example, so it preprocesses eagerly.
     dataset_cls = (
-        LazySupervisedDataset if data_args.lazy_preprocess else SupervisedDataset
+        LazySupervisedDataset
+        if data_args.lazy_preprocess and not data_args.pack_sequences
+        else functools.partial(
+            SupervisedDataset, num_proc=data_args.preprocess_num_proc
+        )
     )
     rank0_print("Loading data...")
-    data_path = data_args.data_path
-    if data_path.endswith(".json"):
-        raw_data = json.load(open(data_path, "r"))
-    elif data_path.endswith(".jsonl"):
-        with jsonlines.open(data_path, mode="r") as reader:
-            raw_data = [item for item in reader]
+    if data_args.tokenized_data_path:
+        tokenized_data = TokenizedDataset(
+            data_args.tokenized_data_path,
+            tokenizer.model_max_length,
+            tokenizer.pad_token_id,
+        )
+        num_examples = len(tokenized_data)
+    else:
+        raw_data = list(iter_records(data_args.data_path))
+        num_examples = len(raw_data)
 
     # Split train/test
     np.random.seed(0)
-    perm = np.random.permutation(len(raw_data))
+    perm = np.random.permutation(num_examples)
     split = int(len(perm) * train_ratio)
     train_indices = perm[:split]
     if train_ratio < 1:
@@ -321,16 +457,27 @@ def make_supervised_data_module(
     else:
         # if train_ratio==1, we use 5% of data as eval data, make sure trainer will not throw error when eval data is empty
         eval_indices = perm[-int(len(perm) * 0.05) :]
-    train_raw_data = [raw_data[i] for i in train_indices]
-    eval_raw_data = [raw_data[i] for i in eval_indices]
-    rank0_print(f"#train {len(train_raw_data)}, #eval {len(eval_raw_data)}")
+    rank0_print(f"#train {len(train_indices)}, #eval {len(eval_indices)}")
 
-    train_dataset = dataset_cls(
-        train_raw_data, tokenizer=tokenizer, template_id=template_id
-    )
-    eval_dataset = dataset_cls(
-        eval_raw_data, tokenizer=tokenizer, template_id=template_id
-    )
+    if data_args.tokenized_data_path:
+        train_dataset = Subset(tokenized_data, train_indices)
+        eval_dataset = Subset(tokenized_data, eval_indices)
+    else:
+        train_raw_data = [raw_data[i] for i in train_indices]
+        eval_raw_data = [raw_data[i] for i in eval_indices]
+        train_dataset = dataset_cls(
+            train_raw_data, tokenizer=tokenizer, template_id=template_id
+        )
+        eval_dataset = dataset_cls(
+            eval_raw_data, tokenizer=tokenizer, template_id=template_id
+        )
+    if data_args.pack_sequences:
+        train_dataset = PackedDataset(
+            train_dataset, tokenizer.model_max_length, tokenizer.pad_token_id
+        )
+        eval_dataset = PackedDataset(
+            eval_dataset, tokenizer.model_max_length, tokenizer.pad_token_id
+        )
     return dict(train_dataset=train_dataset, eval_dataset=eval_dataset)
 
 
@@ -361,6 +508,8 @@ def train():
     )
     # Tie the weights
     model.tie_weights()
+    if data_args.pack_sequences:
+        check_packing_support(model)
 
     tokenizer = transformers.AutoTokenizer.from_pretrained(
         model_args.model_name_or_path,
@@ -369,7 +518,7 @@ def train():
         cache_dir=training_args.cache_dir,
         model_max_length=training_args.model_max_length,
         padding_side="right",
-        use_fast=False,
+        use_fast=model_args.use_fast_tokenizer,
     )
     # NOTE: if the token_id exceed the vocab_size will cause failing in training process! we need add special config and resize the embedding size!
     tokenizer.pad_token = tokenizer.unk_token
@@ -384,9 +533,12 @@ def train():
         train_ratio=0.98,
         data_args=data_args,
     )
-    trainer = Trainer(
+    trainer_cls = TokenBudgetTrainer if training_args.max_tokens_per_batch else Trainer
+    trainer = trainer_cls(
         model=model, tokenizer=tokenizer, args=training_args, **data_module
     )
+    if training_args.log_throughput:
+        trainer.add_callback(ThroughputCallback())
 
     if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):
         trainer.train(resume_from_checkpoint=True)
@@ -14,8 +14,6 @@ import time
 from typing import AsyncGenerator, Generator
 import warnings
 
-import requests
-
 from fastchat.constants import LOGDIR
 
 
@@ -364,7 +362,7 @@ def get_context_length(config):
     """Get the context length of a model from a huggingface model config."""
     rope_scaling = getattr(config, "rope_scaling", None)
     if rope_scaling:
-        rope_scaling_factor = config.rope_scaling["factor"]
+        rope_scaling_factor = config.rope_scaling.get("factor", 1)
     else:
         rope_scaling_factor = 1
 
@@ -390,6 +388,41 @@ def str_to_torch_dtype(dtype: str):
         raise ValueError(f"Unrecognized dtype: {dtype}")
 
 
+EMBEDDING_TRANSPORT_DTYPES = ("float32", "float16")
+
+
+def pack_embeddings(embeddings, dtype: str = "float32"):
+    """Pack a 2-D embedding tensor into one contiguous little-endian buffer.
+
+    Returns the raw bytes and the metadata needed by `unpack_embeddings`.
+    """
+    import numpy as np
+
+    if dtype not in EMBEDDING_TRANSPORT_DTYPES:
+        raise ValueError(f"Unrecognized embedding dtype: {dtype}")
+    array = embeddings.float().cpu().numpy()
+    array = array.astype(np.dtype(dtype).newbyteorder("<"), copy=False)
+    return array.tobytes(), {"shape": list(array.shape), "dtype": dtype}
+
+
+def unpack_embeddings(buffer: bytes, shape, dtype: str, encoding_format=None):
+    """Convert a buffer made by `pack_embeddings` into OpenAI-style rows.
+
+    Rows are lists of floats, or base64 strings of float32 bytes if
+    `encoding_format` is "base64".
+    """
+    import numpy as np
+
+    if dtype not in EMBEDDING_TRANSPORT_DTYPES:
+        raise ValueError(f"Unrecognized embedding dtype: {dtype}")
+    array = np.frombuffer(buffer, dtype=np.dtype(dtype).newbyteorder("<"))
+    array = array.reshape(shape)
+    if encoding_format == "base64":
+        array = array.astype("<f4", copy=False)
+        return [base64.b64encode(row.tobytes()).decode("utf-8") for row in array]
+    return array.tolist()
+
+
 def load_image(image_file):
     from PIL import Image
     import requests
@@ -441,6 +474,8 @@ def get_image_file_from_gcs(filename):
 
 
 def image_moderation_request(image_bytes, endpoint, api_key):
+    import requests
+
     headers = {"Content-Type": "image/jpeg", "Ocp-Apim-Subscription-Key": api_key}
 
     MAX_RETRIES = 3
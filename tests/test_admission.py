@@ -0,0 +1,122 @@
+"""
+Usage:
+python3 -m unittest tests.test_admission
+"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+from fastchat.serve.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    PriorityClass,
+)
+
+
+def make_controller(capacity=1, max_queue_size=2):
+    return AdmissionController(
+        capacity=capacity,
+        max_queue_size=max_queue_size,
+        classes=[
+            PriorityClass("interactive", priority=0),
+            PriorityClass("batch", priority=2, rate=1, burst=2),
+        ],
+        key_classes={"key-i": "interactive", "key-b": "batch"},
+    )
+
+
+class TestAdmissionController(unittest.TestCase):
+    def test_rate_limit(self):
+        async def run():
+            controller = make_controller(capacity=10)
+            await controller.acquire("key-b")
+            await controller.acquire("key-b")
+            with self.assertRaises(AdmissionRejected) as ctx:
+                await controller.acquire("key-b")
+            self.assertGreater(ctx.exception.retry_after, 0)
+            # Other keys are not affected.
+            await controller.acquire("key-i")
+
+        asyncio.run(run())
+
+    def test_priority_order_and_preemption(self):
+        async def run():
+            controller = make_controller(capacity=1, max_queue_size=2)
+            admitted_at = await controller.acquire(None)
+
+            order = []
+
+            async def request(api_key):
+                try:
+                    t = await controller.acquire(api_key)
+                except AdmissionRejected:
+                    order.append(f"rejected {api_key}")
+                    return
+                order.append(api_key)
+                controller.release(t)
+
+            tasks = [asyncio.create_task(request("key-b"))]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.create_task(request(None)))
+            await asyncio.sleep(0)
+            # The queue is full, so the batch request is shed.
+            tasks.append(asyncio.create_task(request("key-i")))
+            await asyncio.sleep(0)
+
+            controller.release(admitted_at)
+            await asyncio.gather(*tasks)
+            self.assertEqual(order, ["rejected key-b", "key-i", None])
+            self.assertEqual(controller.in_flight, 0)
+            self.assertEqual(controller.num_rejected, 1)
+
+        asyncio.run(run())
+
+    def test_grant_at_timeout_is_kept(self):
+        async def run():
+            controller = make_controller(capacity=1)
+            admitted_at = await controller.acquire(None)
+
+            async def grant_then_time_out(future, timeout):
+                # The slot is handed over just before the timeout fires.
+                controller.release(admitted_at)
+                future.cancel()
+                raise asyncio.TimeoutError
+
+            with mock.patch(
+                "fastchat.serve.admission.asyncio.wait_for", grant_then_time_out
+            ):
+                t = await controller.acquire(None)
+            self.assertEqual(controller.in_flight, 1)
+            controller.release(t)
+            self.assertEqual(controller.in_flight, 0)
+
+        asyncio.run(run())
+
+    def test_shed_at_timeout_is_counted_once(self):
+        async def run():
+            controller = make_controller(capacity=1)
+            admitted_at = await controller.acquire(None)
+
+            async def shed_then_time_out(future, timeout):
+                # Higher priority traffic sheds the request just before the
+                # timeout fires.
+                controller._shed_lowest_priority(0)
+                future.cancel()
+                raise asyncio.TimeoutError
+
+            with mock.patch(
+                "fastchat.serve.admission.asyncio.wait_for", shed_then_time_out
+            ):
+                with self.assertRaises(AdmissionRejected) as ctx:
+                    await controller.acquire("key-b")
+            self.assertIn("preempted", str(ctx.exception))
+            self.assertEqual(controller.num_rejected, 1)
+            self.assertEqual(controller.queue, [])
+            controller.release(admitted_at)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
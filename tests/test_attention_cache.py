@@ -0,0 +1,92 @@
+"""
+Usage:
+python3 -m unittest tests.test_attention_cache
+"""
+
+import unittest
+
+import torch
+from transformers.models.llama.modeling_llama import rotate_half
+
+from fastchat.train.attention_cache import (
+    apply_rotary,
+    clear_cache,
+    get_packed_cu_seqlens,
+    get_rotary_cos_sin,
+    get_unpad_info,
+)
+
+
+class RotaryEmbedding(torch.nn.Module):
+    """The rotary embedding of older transformers, with (1, 1, s, d) outputs."""
+
+    def __init__(self, dim):
+        super().__init__()
+        self.inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2).float() / dim))
+        self.calls = 0
+
+    def forward(self, x, seq_len):
+        self.calls += 1
+        freqs = torch.outer(torch.arange(seq_len).float(), self.inv_freq)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        return emb.cos()[None, None], emb.sin()[None, None]
+
+
+class TestAttentionCache(unittest.TestCase):
+    def setUp(self):
+        clear_cache()
+
+    def test_rotary(self):
+        bsz, seq_len, heads, dim = 2, 10, 3, 8
+        rotary_emb = RotaryEmbedding(dim)
+        q, k = torch.randn(2, bsz, heads, seq_len, dim)
+        position_ids = torch.tensor([[0, 1, 2, 3, 0, 1, 2, 0, 1, 2]])
+
+        cos, sin = get_rotary_cos_sin(rotary_emb, q, position_ids, seq_len)
+        q_rot, k_rot = apply_rotary(q, k, cos, sin, dim=1)
+
+        ref_cos, ref_sin = (x[0, 0][position_ids][:, None] for x in rotary_emb(q, 10))
+        self.assertTrue(torch.allclose(q_rot, q * ref_cos + rotate_half(q) * ref_sin))
+        self.assertTrue(torch.allclose(k_rot, k * ref_cos + rotate_half(k) * ref_sin))
+        # The (b, s, h, d) layout gives the same result.
+        q_rot2, _ = apply_rotary(q.transpose(1, 2), k.transpose(1, 2), cos, sin, dim=2)
+        self.assertTrue(torch.allclose(q_rot2, q_rot.transpose(1, 2)))
+
+    def test_shared_between_layers(self):
+        rotary_emb = RotaryEmbedding(8)
+        x = torch.randn(1, 1, 4, 8)
+        position_ids = torch.arange(4)[None]
+        first = get_rotary_cos_sin(rotary_emb, x, position_ids, 4)
+        second = get_rotary_cos_sin(RotaryEmbedding(8), x, position_ids, 4)
+        self.assertIs(first, second)
+        self.assertEqual(rotary_emb.calls, 1)
+        # New or modified positions are recomputed.
+        get_rotary_cos_sin(rotary_emb, x, position_ids.clone(), 4)
+        position_ids[0, 1] = 0
+        cos, _ = get_rotary_cos_sin(rotary_emb, x, position_ids, 4)
+        self.assertEqual(rotary_emb.calls, 3)
+        self.assertTrue(torch.equal(cos[0, 0], cos[0, 1]))
+
+    def test_packed_cu_seqlens(self):
+        position_ids = torch.tensor([[0, 1, 2, 0, 1], [0, 1, 0, 1, 2]])
+        cu_seqlens, max_seqlen = get_packed_cu_seqlens(position_ids, 2, 5)
+        self.assertEqual(cu_seqlens.tolist(), [0, 3, 5, 7, 10])
+        self.assertEqual(max_seqlen, 3)
+        # Unpacked rows are not split.
+        self.assertEqual(get_packed_cu_seqlens(torch.arange(5)[None], 2, 5), (None, 0))
+        self.assertEqual(get_packed_cu_seqlens(None, 2, 5), (None, 0))
+
+    def test_unpad_info(self):
+        mask = torch.tensor([[1, 1, 1, 0], [0, 1, 1, 1]], dtype=torch.bool)
+        indices, cu_seqlens, max_seqlen = get_unpad_info(mask, 4)
+        self.assertEqual(indices.tolist(), [0, 1, 2, 5, 6, 7])
+        self.assertEqual(cu_seqlens.tolist(), [0, 3, 6])
+        self.assertEqual(max_seqlen, 3)
+        # The last columns only, for the queries after a kv cache.
+        indices, cu_seqlens, max_seqlen = get_unpad_info(mask, 1)
+        self.assertEqual(indices.tolist(), [1])
+        self.assertEqual(cu_seqlens.tolist(), [0, 0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Usage:
+python3 -m unittest tests.test_batch_sampler
+"""
+
+from dataclasses import dataclass, field
+import random
+import tempfile
+from typing import Optional
+import unittest
+
+import torch
+from torch.utils.data import Dataset
+import transformers
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from fastchat.train.batch_sampler import (
+    TokenBudgetBatchSampler,
+    TokenBudgetTrainer,
+    collate_dynamic_padding,
+    get_lengths,
+)
+
+
+class PaddedDataset(Dataset):
+    def __init__(self, lengths, max_length):
+        self.examples = []
+        for length in lengths:
+            input_ids = torch.zeros(max_length, dtype=torch.long)
+            input_ids[:length] = torch.randint(1, 32, (length,))
+            self.examples.append(
+                dict(
+                    input_ids=input_ids,
+                    labels=input_ids.masked_fill(input_ids == 0, -100),
+                    attention_mask=input_ids.ne(0),
+                )
+            )
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, i):
+        return self.examples[i]
+
+
+@dataclass
+class TrainingArguments(transformers.TrainingArguments):
+    max_tokens_per_batch: Optional[int] = field(default=None)
+
+
+class TestTokenBudgetBatchSampler(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.lengths = [rng.randint(1, 100) for _ in range(500)]
+
+    def test_token_budget(self):
+        sampler = TokenBudgetBatchSampler(self.lengths, 400, seed=1)
+        batches = list(sampler)
+        self.assertEqual(sorted(sum(batches, [])), list(range(len(self.lengths))))
+        for batch in batches:
+            self.assertLessEqual(max(self.lengths[i] for i in batch) * len(batch), 400)
+        # Buckets of similar lengths need far less padding than random batches.
+        padded = sum(max(self.lengths[i] for i in b) * len(b) for b in batches)
+        self.assertLess(padded, 1.2 * sum(self.lengths))
+
+    def test_deterministic_and_epoch_dependent(self):
+        a = TokenBudgetBatchSampler(self.lengths, 400, seed=1)
+        b = TokenBudgetBatchSampler(self.lengths, 400, seed=1)
+        self.assertEqual(list(a), list(b))
+        first_epoch = list(a)
+        a.set_epoch(1)
+        self.assertNotEqual(list(a), first_epoch)
+        a.set_epoch(0)
+        self.assertEqual(list(a), first_epoch)
+
+    def test_ranks(self):
+        samplers = [
+            TokenBudgetBatchSampler(self.lengths, 400, num_replicas=3, rank=rank)
+            for rank in range(3)
+        ]
+        batches = [list(s) for s in samplers]
+        self.assertEqual(len(set(map(len, batches))), 1)
+        seen = sorted(i for rank in batches for batch in rank for i in batch)
+        self.assertEqual(sorted(set(seen)), list(range(len(self.lengths))))
+        # The ranks work on batches from the same bucket in each step.
+        for step in zip(*batches):
+            longest = [max(self.lengths[i] for i in batch) for batch in step]
+            self.assertLess(max(longest) - min(longest), 50)
+
+    def test_collate_dynamic_padding(self):
+        dataset = PaddedDataset([3, 5, 2], 16)
+        self.assertEqual(get_lengths(dataset), [3, 5, 2])
+        batch = collate_dynamic_padding([dataset[0], dataset[2]])
+        self.assertEqual(batch["input_ids"].shape, (2, 3))
+        self.assertEqual(batch["labels"].shape, (2, 3))
+        self.assertTrue(batch["attention_mask"][:, 0].all())
+
+        # Left padding is cut from the left.
+        examples = [
+            {key: value.flip(0) for key, value in dataset[i].items()} for i in (0, 2)
+        ]
+        batch = collate_dynamic_padding(examples)
+        self.assertEqual(batch["input_ids"].shape, (2, 3))
+        self.assertTrue(batch["attention_mask"][:, -1].all())
+        self.assertTrue(
+            torch.equal(batch["input_ids"][0], examples[0]["input_ids"][-3:])
+        )
+
+    def test_trainer(self):
+        config = LlamaConfig(
+            vocab_size=32,
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+        )
+        model = LlamaForCausalLM(config)
+        dataset = PaddedDataset(self.lengths[:64], 128)
+        with tempfile.TemporaryDirectory() as output_dir:
+            args = TrainingArguments(
+                output_dir=output_dir,
+                max_tokens_per_batch=256,
+                num_train_epochs=1,
+                report_to=[],
+                use_cpu=True,
+            )
+            trainer = TokenBudgetTrainer(
+                model=model, args=args, train_dataset=dataset, eval_dataset=dataset
+            )
+            dataloader = trainer.get_train_dataloader()
+            for batch in dataloader:
+                self.assertLessEqual(batch["input_ids"].numel(), 256)
+            trainer.train()
+            self.assertEqual(trainer.state.global_step, len(dataloader))
+            self.assertIn("eval_loss", trainer.evaluate())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Usage:
+python3 -m unittest tests.test_checkpoint_shards
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from fastchat.model.apply_lora import apply_lora_low_cpu_mem
+from fastchat.model.checkpoint_shards import CheckpointReader, map_shards
+from fastchat.model.convert_fp16 import convert_fp16_low_cpu_mem
+
+
+def make_model(seed):
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=32,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+    )
+    return LlamaForCausalLM(config).half()
+
+
+class TestCheckpointShards(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def save(self, model, name, safe_serialization=True):
+        path = os.path.join(self.tmp.name, name)
+        model.save_pretrained(
+            path, max_shard_size="4KB", safe_serialization=safe_serialization
+        )
+        return path
+
+    def test_reader(self):
+        model = make_model(0)
+        state_dict = model.state_dict()
+        for safe_serialization in [True, False]:
+            with self.subTest(safe_serialization=safe_serialization):
+                path = self.save(
+                    model, f"model_{safe_serialization}", safe_serialization
+                )
+                reader = CheckpointReader(path)
+                self.assertGreater(len(reader.shards), 1)
+                for name in reader.keys():
+                    self.assertTrue(
+                        torch.equal(reader.get_tensor(name), state_dict[name])
+                    )
+                self.assertEqual(
+                    sum(len(reader.keys(shard)) for shard in reader.shards),
+                    len(reader.keys()),
+                )
+
+    def test_delta_round_trip(self):
+        base_path = self.save(make_model(0), "base", safe_serialization=False)
+        target = make_model(1)
+        target_path = self.save(target, "target")
+        base = CheckpointReader(base_path)
+        delta_path = os.path.join(self.tmp.name, "delta")
+        map_shards(
+            CheckpointReader(target_path),
+            lambda name, param: param - base.get_tensor(name),
+            delta_path,
+            num_workers=2,
+        )
+        delta = CheckpointReader(delta_path)
+        result_path = os.path.join(self.tmp.name, "result")
+        map_shards(
+            base, lambda name, param: param + delta.get_tensor(name), result_path
+        )
+        target.config.save_pretrained(result_path)
+
+        result = LlamaForCausalLM.from_pretrained(
+            result_path, torch_dtype=torch.float16
+        )
+        for name, param in target.state_dict().items():
+            self.assertTrue(
+                torch.allclose(result.state_dict()[name], param, atol=1e-2), name
+            )
+
+    def test_convert_fp16(self):
+        model = make_model(0).float()
+        in_path = self.save(model, "fp32")
+        out_path = os.path.join(self.tmp.name, "fp16")
+        with mock.patch("fastchat.model.convert_fp16.AutoTokenizer"):
+            convert_fp16_low_cpu_mem(in_path, out_path, num_workers=2)
+        self.assertEqual(
+            len(CheckpointReader(out_path).shards),
+            len(CheckpointReader(in_path).shards),
+        )
+        result = LlamaForCausalLM.from_pretrained(out_path)
+        for name, param in result.state_dict().items():
+            self.assertEqual(param.dtype, torch.float16)
+            self.assertTrue(torch.equal(param, model.state_dict()[name].half()))
+
+    def test_apply_lora(self):
+        from peft import LoraConfig, get_peft_model
+
+        base = make_model(0)
+        base_path = self.save(base, "base")
+        config = LoraConfig(
+            r=4,
+            lora_alpha=8,
+            target_modules=["q_proj", "v_proj", "embed_tokens"],
+            rank_pattern={"v_proj": 2},
+            modules_to_save=["lm_head"],
+        )
+        peft_model = get_peft_model(make_model(0).float(), config)
+        for name, param in peft_model.named_parameters():
+            if param.requires_grad:
+                torch.nn.init.normal_(param.data)
+        lora_path = os.path.join(self.tmp.name, "lora")
+        peft_model.save_pretrained(lora_path)
+        expected = peft_model.merge_and_unload().half().state_dict()
+
+        target_path = os.path.join(self.tmp.name, "target")
+        with mock.patch("fastchat.model.apply_lora.AutoTokenizer"):
+            apply_lora_low_cpu_mem(base_path, target_path, lora_path)
+        result = LlamaForCausalLM.from_pretrained(
+            target_path, torch_dtype=torch.float16
+        )
+        for name, param in result.state_dict().items():
+            self.assertTrue(
+                torch.allclose(param, expected[name], rtol=1e-2, atol=1e-2), name
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
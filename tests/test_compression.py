@@ -0,0 +1,96 @@
+"""
+Usage:
+python3 -m unittest tests.test_compression
+"""
+
+import os
+import tempfile
+import unittest
+
+from tokenizers import Tokenizer, models
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from torch.nn import functional as F
+
+from fastchat.model.compression import (
+    COMPRESSED_WEIGHTS_NAME,
+    CLinear,
+    CompressionConfig,
+    compress,
+    decompress,
+    dequantize_linear,
+    export_compressed_model,
+    load_compress_model,
+)
+
+
+def save_tiny_llama(path):
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+    )
+    torch.manual_seed(0)
+    LlamaForCausalLM(config).save_pretrained(path, max_shard_size="50KB")
+    tokenizer = Tokenizer(models.WordLevel({"<unk>": 0}, unk_token="<unk>"))
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer).save_pretrained(path)
+
+
+class TestCompression(unittest.TestCase):
+    def test_low_bit_packing(self):
+        torch.manual_seed(0)
+        weight = torch.randn(300, 1000)
+        for num_bits, symmetric in [(8, True), (4, True), (4, False), (2, False)]:
+            config = CompressionConfig(
+                num_bits=num_bits, group_size=256, group_dim=1, symmetric=symmetric
+            )
+            with self.subTest(num_bits=num_bits, symmetric=symmetric):
+                packed = compress(weight, config)
+                # 300 rows, 4 groups of 256 values, 8 // num_bits values per byte
+                self.assertEqual(packed[0].numel(), 300 * 1024 * num_bits // 8)
+                dequantized = decompress(packed, config)
+                self.assertEqual(dequantized.shape, weight.shape)
+                max_error = (weight - dequantized).abs().max().item()
+                self.assertLess(max_error, 8 / 2**num_bits)
+
+                x = torch.randn(2, 3, 1000)
+                bias = torch.randn(300)
+                self.assertTrue(
+                    torch.allclose(
+                        dequantize_linear(x, packed, bias, config),
+                        F.linear(x, dequantized, bias),
+                        atol=1e-4,
+                    )
+                )
+
+    def test_export_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = os.path.join(tmp_dir, "model")
+            export_path = os.path.join(tmp_dir, "exported")
+            save_tiny_llama(model_path)
+            export_compressed_model(model_path, export_path, torch_dtype=torch.float32)
+            self.assertTrue(
+                os.path.isfile(os.path.join(export_path, COMPRESSED_WEIGHTS_NAME))
+            )
+
+            model, _ = load_compress_model(
+                model_path, "cpu", torch.float32, use_fast=True
+            )
+            exported, _ = load_compress_model(
+                export_path, "cpu", torch.float32, use_fast=True
+            )
+            self.assertIsInstance(exported.model.layers[0].mlp.up_proj, CLinear)
+
+            input_ids = torch.arange(8)[None]
+            with torch.no_grad():
+                self.assertTrue(
+                    torch.equal(model(input_ids).logits, exported(input_ids).logits)
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,221 @@
+"""
+Usage:
+python3 -m unittest tests.test_conversation
+"""
+
+import json
+import os
+import unittest
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors
+from tokenizers import trainers
+from transformers import PreTrainedTokenizerFast
+
+from fastchat.conversation import conv_templates, get_conv_template
+
+# Prompts of every template for GOLDEN_HISTORY, with the default and a custom
+# system message.
+GOLDEN_PROMPTS_FILE = os.path.join(
+    os.path.dirname(__file__), "conversation_prompts.json"
+)
+GOLDEN_HISTORY = [
+    ("user", "Hello!\n\nThis is\r\na test."),
+    ("assistant", " Hi! "),
+    ("user", ""),
+    ("assistant", "Fine."),
+    ("user", "How are you?"),
+    ("assistant", None),
+]
+CUSTOM_SYSTEM_MESSAGE = "You are a helpful assistant."
+
+
+def make_conv(name, history, system_message=None):
+    conv = get_conv_template(name)
+    if system_message is not None:
+        conv.set_system_message(system_message)
+    for role, message in history:
+        conv.append_message(conv.roles[0 if role == "user" else 1], message)
+    return conv
+
+
+def train_tokenizer(kind):
+    """A small fast tokenizer trained on the prompts of every template.
+
+    "metaspace" is SentencePiece-like, as in Llama, and "byte_level" is
+    GPT-2-like; both mark the spaces before words inside the tokens.
+    """
+    prompts = []
+    for name in conv_templates:
+        try:
+            prompts.append(make_conv(name, GOLDEN_HISTORY).get_prompt())
+        except ValueError:
+            pass
+    if kind == "metaspace":
+        tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+        tokenizer.pre_tokenizer = pre_tokenizers.Metaspace(prepend_scheme="first")
+        tokenizer.decoder = decoders.Metaspace(prepend_scheme="first")
+        special_tokens = ["<unk>", "<s>", "</s>"]
+        alphabet = []
+    else:
+        tokenizer = Tokenizer(models.BPE())
+        tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+        tokenizer.decoder = decoders.ByteLevel()
+        special_tokens = ["<|endoftext|>"]
+        alphabet = pre_tokenizers.ByteLevel.alphabet()
+    trainer = trainers.BpeTrainer(
+        vocab_size=2000, special_tokens=special_tokens, initial_alphabet=alphabet
+    )
+    tokenizer.train_from_iterator(prompts, trainer)
+    if kind == "metaspace":
+        tokenizer.post_processor = processors.TemplateProcessing(
+            single="<s> $A", special_tokens=[("<s>", 1)]
+        )
+        return PreTrainedTokenizerFast(
+            tokenizer_object=tokenizer,
+            unk_token="<unk>",
+            bos_token="<s>",
+            eos_token="</s>",
+        )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, eos_token="<|endoftext|>"
+    )
+
+
+def fresh_prompt(conv):
+    """Render from scratch, without any incremental state."""
+    return conv.copy().get_prompt()
+
+
+class TestConversationPrompt(unittest.TestCase):
+    def test_golden_prompts(self):
+        with open(GOLDEN_PROMPTS_FILE, encoding="utf-8") as fin:
+            golden = json.load(fin)
+        for name in conv_templates:
+            for key, system_message in [
+                ("default", None),
+                ("custom", CUSTOM_SYSTEM_MESSAGE),
+            ]:
+                conv = make_conv(name, GOLDEN_HISTORY, system_message)
+                with self.subTest(template=name, system_message=key):
+                    if name not in golden:
+                        self.assertRaises(ValueError, conv.get_prompt)
+                        continue
+                    self.assertEqual(conv.get_prompt(), golden[name][key])
+                    self.assertEqual(
+                        conv.compile().render(conv.system_message, conv.messages),
+                        golden[name][key],
+                    )
+
+    def test_incremental_rendering(self):
+        for name in conv_templates:
+            conv = get_conv_template(name)
+            try:
+                conv.get_prompt()
+            except ValueError:
+                continue
+            with self.subTest(template=name):
+                for turn in range(4):
+                    conv.append_message(conv.roles[0], f"Question {turn}?")
+                    conv.append_message(conv.roles[1], None)
+                    self.assertEqual(conv.get_prompt(), fresh_prompt(conv))
+                    conv.update_last_message(f"Answer {turn}.")
+                    self.assertEqual(conv.get_prompt(), fresh_prompt(conv))
+
+                # Edit a message in the middle of the history.
+                conv.messages[2][1] = "Edited question?"
+                self.assertEqual(conv.get_prompt(), fresh_prompt(conv))
+                # Regenerate the last answer.
+                conv.update_last_message(None)
+                self.assertEqual(conv.get_prompt(), fresh_prompt(conv))
+                # Drop the last turn.
+                conv.messages = conv.messages[:-2]
+                self.assertEqual(conv.get_prompt(), fresh_prompt(conv))
+                conv.set_system_message("Be brief.")
+                self.assertEqual(conv.get_prompt(), fresh_prompt(conv))
+
+    def test_encode(self):
+        history = [
+            ("user", "Hello!"),
+            ("assistant", "Hi!"),
+            ("user", "How are you?"),
+            ("assistant", None),
+        ]
+        for kind in ["metaspace", "byte_level"]:
+            tokenizer = train_tokenizer(kind)
+            for name in conv_templates:
+                conv = make_conv(name, history)
+                try:
+                    prompt = conv.get_prompt()
+                except ValueError:
+                    continue
+                with self.subTest(tokenizer=kind, template=name):
+                    encoding = conv.encode(tokenizer)
+                    # The same ids as tokenizing the whole prompt.
+                    self.assertEqual(encoding.input_ids, tokenizer(prompt).input_ids)
+                    if not encoding.spans:
+                        continue
+                    self.assertEqual(len(encoding.spans), len(conv.messages))
+                    self.assertEqual(encoding.spans[-1][2], len(encoding.input_ids))
+                    for (_, message), (start, content_start, end) in zip(
+                        conv.messages, encoding.spans
+                    ):
+                        self.assertLessEqual(start, content_start)
+                        self.assertLessEqual(content_start, end)
+                        # A token across the edge of a message belongs to
+                        # the span it ends in.
+                        content = tokenizer.decode(
+                            encoding.input_ids[max(content_start - 1, 0) : end + 1]
+                        )
+                        if message:
+                            self.assertIn(message, content)
+
+    def test_get_prompt_with_spans(self):
+        history = [
+            ("user", "Hello!"),
+            ("assistant", "Hi!"),
+            ("user", "How are you?"),
+            ("assistant", None),
+        ]
+        for name in conv_templates:
+            conv = make_conv(name, history)
+            try:
+                prompt = conv.get_prompt()
+                prompt_with_spans, spans = conv.get_prompt_with_spans()
+            except ValueError:
+                continue
+            with self.subTest(template=name):
+                self.assertEqual(prompt_with_spans, prompt)
+                self.assertEqual(len(spans), len(conv.messages))
+                self.assertEqual(spans[-1][2], len(prompt))
+                for (_, message), (start, content_start, end) in zip(
+                    conv.messages, spans
+                ):
+                    self.assertLessEqual(start, content_start)
+                    self.assertLessEqual(content_start, end)
+                    if message:
+                        self.assertIn(message, prompt[content_start:end])
+                    else:
+                        self.assertEqual(content_start, end)
+
+    def test_encode_is_cached(self):
+        tokenizer = train_tokenizer("metaspace")
+        conv = get_conv_template("vicuna_v1.1")
+        conv.append_message(conv.roles[0], "Hello!")
+        conv.append_message(conv.roles[1], None)
+        encoding = conv.encode(tokenizer)
+        self.assertIs(conv.encode(tokenizer), encoding)
+
+        conv.update_last_message("Hi!")
+        encoding = conv.encode(tokenizer)
+        self.assertEqual(encoding.input_ids, tokenizer(conv.get_prompt()).input_ids)
+        labels = encoding.get_labels(conv.roles[1])
+        self.assertEqual(tokenizer.decode([i for i in labels if i != -100]), "Hi!</s>")
+
+        conv.set_system_message("Be brief.")
+        self.assertEqual(
+            conv.encode(tokenizer).input_ids, tokenizer(conv.get_prompt()).input_ids
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Usage:
+python3 -m unittest tests.test_embedding_transport
+"""
+
+import asyncio
+import base64
+import unittest
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import numpy as np
+import torch
+
+from fastchat.serve import openai_api_server
+from fastchat.serve.base_model_worker import create_embedding_response
+from fastchat.utils import pack_embeddings, unpack_embeddings
+
+
+def get_embedding_through_worker(worker_response, payload):
+    """Run `openai_api_server.get_embedding` against a worker that answers
+    with `worker_response`."""
+
+    async def handler(request):
+        headers = dict(worker_response.headers)
+        headers.pop("content-length")
+        return web.Response(
+            body=worker_response.body,
+            status=worker_response.status_code,
+            headers=headers,
+        )
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/worker_get_embeddings", handler)
+        async with TestServer(app) as server:
+            with mock.patch.object(
+                openai_api_server,
+                "get_worker_address",
+                mock.AsyncMock(return_value=str(server.make_url("")).rstrip("/")),
+            ):
+                return await openai_api_server.get_embedding(payload)
+
+    return asyncio.run(run())
+
+
+class TestEmbeddingTransport(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.embeddings = torch.nn.functional.normalize(torch.randn(3, 8), dim=1)
+
+    def test_float32_round_trip(self):
+        buffer, meta = pack_embeddings(self.embeddings, "float32")
+        self.assertEqual(meta, {"shape": [3, 8], "dtype": "float32"})
+        self.assertEqual(len(buffer), 3 * 8 * 4)
+        rows = unpack_embeddings(buffer, meta["shape"], meta["dtype"])
+        self.assertEqual(rows, self.embeddings.tolist())
+
+    def test_float16_round_trip(self):
+        buffer, meta = pack_embeddings(self.embeddings, "float16")
+        self.assertEqual(len(buffer), 3 * 8 * 2)
+        rows = unpack_embeddings(buffer, meta["shape"], meta["dtype"])
+        self.assertEqual(rows, self.embeddings.half().float().tolist())
+        self.assertTrue(torch.allclose(torch.tensor(rows), self.embeddings, atol=1e-3))
+
+    def test_base64(self):
+        for dtype in ("float32", "float16"):
+            with self.subTest(dtype=dtype):
+                buffer, meta = pack_embeddings(self.embeddings, dtype)
+                rows = unpack_embeddings(buffer, meta["shape"], dtype, "base64")
+                # Always float32 bytes, as OpenAI clients expect.
+                decoded = [
+                    np.frombuffer(base64.b64decode(row), dtype="<f4").tolist()
+                    for row in rows
+                ]
+                expected = unpack_embeddings(buffer, meta["shape"], dtype)
+                self.assertEqual(decoded, expected)
+
+    def test_unknown_dtype(self):
+        with self.assertRaises(ValueError):
+            pack_embeddings(self.embeddings, "bfloat16")
+        with self.assertRaises(ValueError):
+            unpack_embeddings(b"", [0, 8], "int8")
+
+    def test_api_server_decodes_binary_response(self):
+        buffer, meta = pack_embeddings(self.embeddings, "float16")
+        response = create_embedding_response(
+            {"embedding": buffer, "token_num": 7, **meta}
+        )
+        payload = {"model": "m", "input": ["a"], "encoding_format": None}
+        result = get_embedding_through_worker(response, payload)
+        self.assertEqual(result["token_num"], 7)
+        self.assertEqual(
+            result["embedding"], unpack_embeddings(buffer, [3, 8], "float16")
+        )
+
+    def test_api_server_falls_back_to_json(self):
+        # Workers that do not pack embeddings answer with plain JSON.
+        embedding = {"embedding": self.embeddings.tolist(), "token_num": 7}
+        response = create_embedding_response(embedding)
+        payload = {"model": "m", "input": ["a"], "encoding_format": None}
+        self.assertEqual(get_embedding_through_worker(response, payload), embedding)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Usage:
+python3 -m unittest tests.test_fair_scheduler
+"""
+
+import asyncio
+import unittest
+from unittest import mock
+
+from fastchat.serve.fair_scheduler import FairScheduler
+
+
+class TestFairScheduler(unittest.TestCase):
+    def test_weighted_share(self):
+        async def run():
+            scheduler = FairScheduler(capacity=1, weights={"hot": 2, "cold": 1})
+            await scheduler.acquire("hot")
+            order = []
+
+            async def request(name):
+                await scheduler.acquire(name)
+                order.append(name)
+
+            # The hot model queues many more requests than the cold one.
+            tasks = [asyncio.create_task(request("hot")) for _ in range(8)]
+            tasks += [asyncio.create_task(request("cold")) for _ in range(3)]
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.get_queue_length("hot"), 9)
+            self.assertEqual(scheduler.get_queue_length("cold"), 3)
+            self.assertEqual(scheduler.get_queue_length(), 12)
+
+            name = "hot"
+            for _ in range(len(tasks)):
+                scheduler.release(name)
+                await asyncio.sleep(0)
+                name = order[-1]
+            await asyncio.gather(*tasks)
+            return order
+
+        order = asyncio.run(run())
+        # The hot model gets two slots for every slot of the cold one while
+        # both have requests waiting, then the rest of the slots.
+        self.assertEqual(order[:6], ["cold", "hot", "cold", "hot", "hot", "cold"])
+        self.assertEqual(order[6:], ["hot"] * 5)
+
+    def test_model_capacity(self):
+        async def run():
+            scheduler = FairScheduler(
+                capacity=4, weights={"a": 1, "b": 1}, model_capacity=2
+            )
+            await scheduler.acquire("a")
+            await scheduler.acquire("a")
+            waiting = asyncio.create_task(scheduler.acquire("a"))
+            await asyncio.sleep(0)
+            self.assertFalse(waiting.done())
+            # Other models still get the free slots.
+            await asyncio.wait_for(scheduler.acquire("b"), 1)
+
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            self.assertEqual(scheduler.get_queue_length("a"), 2)
+
+            scheduler.release("a")
+            await asyncio.wait_for(scheduler.acquire("a"), 1)
+            self.assertEqual(scheduler.in_flight, {"a": 2, "b": 1})
+
+        asyncio.run(run())
+
+    def test_background_release_wakes_waiters(self):
+        from fastchat.serve import multi_model_worker
+
+        async def run():
+            scheduler = FairScheduler(capacity=1, weights={"a": 1})
+            worker = mock.Mock(model_names=["a"])
+            with mock.patch.multiple(
+                multi_model_worker, scheduler=scheduler, model_swapper=None
+            ):
+                await multi_model_worker.acquire_worker(worker)
+                waiting = asyncio.create_task(scheduler.acquire("a"))
+                await asyncio.sleep(0)
+                # Starlette runs the background tasks after the response.
+                await multi_model_worker.create_background_tasks(worker)()
+                await asyncio.wait_for(waiting, 1)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Check that entry points only import what their code path needs.
+
+Usage:
+python3 -m unittest tests.test_lazy_imports
+"""
+
+import re
+import subprocess
+import sys
+import unittest
+
+MODEL_MODULES = ("torch", "transformers", "accelerate", "peft")
+
+# Modules that must not be imported by each entry point, and a generous upper
+# bound of its cumulative import time in seconds.
+ENTRY_POINTS = {
+    "fastchat.serve.controller": (MODEL_MODULES + ("numpy",), 3.0),
+    "fastchat.serve.openai_api_server": (
+        MODEL_MODULES + ("numpy", "tiktoken", "requests"),
+        5.0,
+    ),
+    "fastchat.serve.gradio_web_server": (MODEL_MODULES, 10.0),
+    "fastchat.llm_judge.common": (MODEL_MODULES + ("openai", "anthropic"), 3.0),
+}
+
+
+def get_imported_modules(code):
+    """Run `code` in a fresh interpreter and return the modules it imported."""
+    script = f"{code}\nimport sys\nprint('\\n'.join(sys.modules))"
+    output = subprocess.check_output([sys.executable, "-c", script], text=True)
+    return set(output.split())
+
+
+def get_import_time(module):
+    """Cumulative import time of `module` in seconds, as reported by -X importtime."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    pattern = re.compile(rf"^import time:\s+\d+ \|\s+(\d+) \| {re.escape(module)}$")
+    for line in proc.stderr.splitlines():
+        match = pattern.match(line)
+        if match:
+            return int(match.group(1)) / 1e6
+    raise ValueError(f"No import time reported for {module}")
+
+
+def has_dependencies(module):
+    """Whether the third-party packages `module` needs are installed."""
+    proc = subprocess.run(
+        [sys.executable, "-c", f"import {module}"], capture_output=True
+    )
+    return proc.returncode == 0
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_get_conversation_template(self):
+        modules = get_imported_modules(
+            "from fastchat.model import get_conversation_template\n"
+            "assert get_conversation_template('vicuna-7b-v1.5').name == 'vicuna_v1.1'"
+        )
+        for name in MODEL_MODULES:
+            self.assertNotIn(name, modules)
+
+    def test_entry_points(self):
+        for module, (forbidden, budget) in ENTRY_POINTS.items():
+            with self.subTest(module=module):
+                if not has_dependencies(module):
+                    self.skipTest(f"dependencies of {module} are not installed")
+                modules = get_imported_modules(f"import {module}")
+                for name in forbidden:
+                    self.assertNotIn(name, modules)
+                self.assertLess(get_import_time(module), budget)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Usage:
+python3 -m unittest tests.test_model_swapper
+"""
+
+import threading
+import time
+import unittest
+
+import torch
+
+from fastchat.serve.model_swapper import ModelSwapper
+
+
+class FakeWorker:
+    def __init__(self, hidden_size=16):
+        self.hidden_size = hidden_size
+        self.device = "cpu"
+        self.model = None
+        self.num_loads = 0
+
+    def load(self):
+        self.model = torch.nn.Linear(self.hidden_size, self.hidden_size, bias=False)
+        self.num_loads += 1
+
+
+class TestModelSwapper(unittest.TestCase):
+    def use(self, swapper, worker):
+        swapper.acquire(worker)
+        swapper.release(worker)
+
+    def test_lru_eviction(self):
+        swapper = ModelSwapper(max_resident_models=2)
+        a, b, c = FakeWorker(), FakeWorker(), FakeWorker()
+        swapper.warm_up([a, b, c])
+        self.assertEqual(list(swapper.resident), [a, b])
+
+        self.use(swapper, a)
+        self.use(swapper, c)
+        # b was the least recently used model.
+        self.assertEqual(list(swapper.resident), [a, c])
+        self.assertIsNone(b.model)
+        self.assertFalse(swapper.get_status(b)["resident"])
+        self.assertIsNotNone(swapper.get_status(b)["evict_latency"])
+
+        self.use(swapper, b)
+        self.assertEqual(b.num_loads, 2)
+        self.assertEqual(list(swapper.resident), [c, b])
+
+    def test_memory_budget_and_cpu_tier(self):
+        small, large = FakeWorker(8), FakeWorker(32)
+        # 8 * 8 and 32 * 32 float32 weights.
+        swapper = ModelSwapper(max_resident_memory=4096 + 256, offload="cpu")
+        swapper.warm_up([small, large])
+        self.assertEqual(list(swapper.resident), [small, large])
+
+        self.use(swapper, small)
+        other = FakeWorker(16)
+        self.use(swapper, other)
+        # Evicting the least recently used model makes room for 16 * 16 weights.
+        self.assertEqual(list(swapper.resident), [small, other])
+        self.assertIsNotNone(large.model)
+
+        self.use(swapper, large)
+        self.assertEqual(large.num_loads, 1)
+        self.assertIn(large, swapper.resident)
+
+    def test_busy_models_are_not_evicted(self):
+        swapper = ModelSwapper(max_resident_models=1)
+        a, b = FakeWorker(), FakeWorker()
+        swapper.acquire(a)
+
+        thread = threading.Thread(target=self.use, args=(swapper, b))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(list(swapper.resident), [a])
+        self.assertIsNone(b.model)
+
+        swapper.release(a)
+        thread.join(5)
+        self.assertEqual(list(swapper.resident), [b])
+
+    def test_page_in_under_steady_traffic(self):
+        swapper = ModelSwapper(max_resident_models=1)
+        a, b = FakeWorker(), FakeWorker()
+        swapper.warm_up([a])
+        stop = threading.Event()
+
+        def traffic():
+            # Overlapping requests: a always has one in progress.
+            while not stop.is_set():
+                swapper.acquire(a)
+                time.sleep(0.01)
+                swapper.release(a)
+
+        threads = [threading.Thread(target=traffic) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        self.assertGreater(swapper.in_use[a], 0)
+
+        paged_in = threading.Event()
+
+        def use_b():
+            swapper.acquire(b)
+            paged_in.set()
+            time.sleep(0.05)
+            swapper.release(b)
+
+        thread = threading.Thread(target=use_b)
+        thread.start()
+        try:
+            # a takes no new requests, drains and is evicted for b.
+            self.assertTrue(paged_in.wait(5))
+            self.assertEqual(list(swapper.resident), [b])
+        finally:
+            stop.set()
+            thread.join(5)
+            for t in threads:
+                t.join(5)
+        # The traffic for a paged it back in afterwards.
+        self.assertEqual(list(swapper.resident), [a])
+        self.assertEqual(swapper.draining, set())
+        self.assertEqual(sum(swapper.in_use.values()), 0)
+
+    def test_loading_does_not_block_resident_models(self):
+        swapper = ModelSwapper(max_resident_models=2)
+        fast, slow = FakeWorker(), FakeWorker()
+        swapper.warm_up([fast])
+        loading, done = threading.Event(), threading.Event()
+        load = slow.load
+
+        def slow_load():
+            loading.set()
+            done.wait(5)
+            load()
+
+        slow.load = slow_load
+        thread = threading.Thread(target=self.use, args=(swapper, slow))
+        thread.start()
+        loading.wait(5)
+        # The resident model is served while the other one loads.
+        self.use(swapper, fast)
+        self.assertEqual(list(swapper.resident), [fast])
+        done.set()
+        thread.join(5)
+        self.assertEqual(list(swapper.resident), [fast, slow])
+
+    def test_failures_do_not_pin_models(self):
+        swapper = ModelSwapper(max_resident_models=1)
+        a, b = FakeWorker(), FakeWorker()
+        changed = threading.Event()
+
+        def on_change():
+            changed.set()
+            raise RuntimeError("controller is down")
+
+        swapper.on_change = on_change
+        self.use(swapper, a)
+        self.assertTrue(changed.wait(5))
+        self.assertEqual(swapper.in_use[a], 0)
+
+        def broken_load():
+            raise OSError("no such model")
+
+        b.load = broken_load
+        with self.assertRaises(OSError):
+            swapper.acquire(b)
+        self.assertEqual(swapper.in_use[b], 0)
+        self.assertEqual(swapper.loading, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+"""
+Usage:
+python3 -m unittest tests.test_multi_lora_worker
+"""
+
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from peft import LoraConfig, PeftModel, get_peft_model
+from tokenizers import Tokenizer, models, pre_tokenizers
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from fastchat.constants import ErrorCode
+from fastchat.serve.inference import generate_stream
+from fastchat.serve import multi_lora_worker
+from fastchat.serve.multi_lora_worker import LoraRequest, MultiLoraWorker
+
+
+def save_tiny_llama_with_adapters(path, num_adapters):
+    config = LlamaConfig(
+        vocab_size=32,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        eos_token_id=1,
+    )
+    torch.manual_seed(0)
+    model_path = os.path.join(path, "base")
+    LlamaForCausalLM(config).save_pretrained(model_path)
+    vocab = {"<unk>": 0, "</s>": 1, **{f"w{i}": i for i in range(2, 32)}}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="<unk>", eos_token="</s>"
+    ).save_pretrained(model_path)
+
+    lora_paths = []
+    for i in range(num_adapters):
+        lora_config = LoraConfig(
+            r=4,
+            target_modules=["q_proj", "v_proj", "down_proj"],
+            init_lora_weights=False,
+        )
+        model = get_peft_model(
+            LlamaForCausalLM.from_pretrained(model_path), lora_config
+        )
+        lora_paths.append(os.path.join(path, f"lora-{i}"))
+        model.save_pretrained(lora_paths[-1])
+    return model_path, lora_paths
+
+
+def generate(worker, params):
+    return [json.loads(x[:-1]) for x in worker.generate_stream_gate(params)]
+
+
+class TestMultiLoraWorker(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.model_path, cls.lora_paths = save_tiny_llama_with_adapters(
+            cls.tmp_dir.name, 2
+        )
+        cls.worker = MultiLoraWorker(
+            "http://localhost:21001",
+            "http://localhost:21002",
+            "test",
+            cls.model_path,
+            ["base"],
+            limit_worker_concurrency=4,
+            no_register=True,
+            device="cpu",
+            num_gpus=1,
+            max_gpu_memory=None,
+            lora_paths=cls.lora_paths[:1],
+            lora_names=[["lora-0"]],
+            conv_template="one_shot",
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def reference_output(self, lora_path, params):
+        model = LlamaForCausalLM.from_pretrained(self.model_path)
+        if lora_path is not None:
+            model = PeftModel.from_pretrained(model, lora_path)
+        *_, output = generate_stream(
+            model.eval(), self.worker.tokenizer, dict(params), "cpu", 2048
+        )
+        return output["text"]
+
+    def test_mixed_adapter_batch(self):
+        self.worker.load_adapter(self.lora_paths[1], ["lora-1"])
+        self.assertEqual(self.worker.model_names, ["base", "lora-0", "lora-1"])
+
+        requests = [
+            ("base", None, [2, 3, 4, 5, 6, 7]),
+            ("lora-0", self.lora_paths[0], [8, 9]),
+            ("lora-1", self.lora_paths[1], [10, 11, 12, 13]),
+            ("lora-0", self.lora_paths[0], [2, 3, 4, 5, 6, 7]),
+        ]
+        batch = []
+        for model, _, input_ids in requests:
+            params = {
+                "input_ids": input_ids,
+                "temperature": 0,
+                "max_new_tokens": 3 + len(batch),
+                "echo": False,
+            }
+            batch.append(
+                LoraRequest(
+                    self.worker.tokenizer,
+                    params,
+                    self.worker.adapters[model],
+                    self.worker.context_len,
+                    stream_interval=2,
+                )
+            )
+        # Decode all requests in one batch, with rows finishing at different steps.
+        self.worker.generate_batch(batch)
+        outputs = [list(iter(r.outputs.get_nowait, None))[-1] for r in batch]
+
+        for (model, lora_path, input_ids), output in zip(requests, outputs):
+            with self.subTest(model=model, input_ids=input_ids):
+                self.assertEqual(output["error_code"], 0)
+                params = {
+                    "input_ids": input_ids,
+                    "temperature": 0,
+                    "max_new_tokens": output["usage"]["completion_tokens"],
+                    "echo": False,
+                }
+                self.assertEqual(
+                    output["text"], self.reference_output(lora_path, params)
+                )
+
+        self.assertNotEqual(outputs[0]["text"], outputs[3]["text"])
+
+        # Requests through the worker API are decoded by the generation thread.
+        params = {
+            "model": "lora-0",
+            "input_ids": requests[3][2],
+            "temperature": 0,
+            "max_new_tokens": 6,
+            "echo": False,
+        }
+        self.assertEqual(generate(self.worker, params)[-1], outputs[3])
+
+        self.assertEqual(self.worker.unload_adapter("lora-1"), ["lora-1"])
+        params["model"] = "lora-1"
+        self.assertEqual(
+            generate(self.worker, params)[0]["error_code"], ErrorCode.INTERNAL_ERROR
+        )
+
+    def test_generation_loop_survives_errors(self):
+        params = {"model": "base", "input_ids": [2, 3], "max_new_tokens": 2}
+        with mock.patch.object(
+            self.worker, "generate_batch", side_effect=KeyError("boom")
+        ):
+            outputs = generate(self.worker, params)
+        self.assertEqual(outputs[-1]["error_code"], ErrorCode.INTERNAL_ERROR)
+        self.assertIn("boom", outputs[-1]["text"])
+        # The loop keeps serving later requests.
+        self.assertEqual(generate(self.worker, params)[-1]["error_code"], 0)
+
+    def test_unload_adapter_with_request_in_flight(self):
+        self.worker.load_adapter(self.lora_paths[1], ["lora-unload"])
+        params = {"model": "lora-unload", "input_ids": [2, 3], "max_new_tokens": 2}
+
+        def make_request(*args, **kwargs):
+            # The adapter of a request being set up cannot be unloaded.
+            with self.assertRaises(ValueError):
+                self.worker.unload_adapter("lora-unload")
+            return LoraRequest(*args, **kwargs)
+
+        with mock.patch.object(
+            multi_lora_worker, "LoraRequest", side_effect=make_request
+        ):
+            self.assertEqual(generate(self.worker, params)[-1]["error_code"], 0)
+        adapter_name = self.worker.adapters["lora-unload"]
+        # The generation thread releases the adapter after the last output.
+        for _ in range(100):
+            if not self.worker.adapter_use[adapter_name]:
+                break
+            time.sleep(0.05)
+
+        # Invalid requests do not keep the adapter in use.
+        outputs = generate(self.worker, dict(params, stop=1))
+        self.assertEqual(outputs[-1]["error_code"], ErrorCode.INTERNAL_ERROR)
+        self.assertEqual(self.worker.adapter_use[adapter_name], 0)
+        self.assertEqual(self.worker.unload_adapter("lora-unload"), ["lora-unload"])
+
+
+if __name__ == "__main__":
+    unittest.main()
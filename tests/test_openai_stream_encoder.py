@@ -0,0 +1,75 @@
+"""
+Usage:
+python3 -m unittest tests.test_openai_stream_encoder
+"""
+
+import unittest
+
+from fastchat.protocol.openai_api_protocol import (
+    ChatCompletionResponseStreamChoice,
+    ChatCompletionStreamResponse,
+    CompletionResponseStreamChoice,
+    CompletionStreamResponse,
+    DeltaMessage,
+    LogProbs,
+    StreamChunkEncoder,
+)
+
+TEXTS = ["Hello", ' "quoted" \\ \n\t\x01', "é 中文 😀", " "]
+FINISH_REASONS = [None, "stop", "length"]
+
+
+class TestStreamChunkEncoder(unittest.TestCase):
+    def test_chat_delta_matches_pydantic(self):
+        encoder = StreamChunkEncoder("chatcmpl-abc", "vicuna-7b")
+        for text in TEXTS:
+            for finish_reason in FINISH_REASONS:
+                chunk = ChatCompletionStreamResponse(
+                    id="chatcmpl-abc",
+                    model="vicuna-7b",
+                    choices=[
+                        ChatCompletionResponseStreamChoice(
+                            index=1,
+                            delta=DeltaMessage(content=text),
+                            finish_reason=finish_reason,
+                        )
+                    ],
+                )
+                expected = f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+                self.assertEqual(
+                    encoder.chat_delta(1, text, finish_reason), expected.encode()
+                )
+
+    def test_completion_delta_matches_pydantic(self):
+        encoder = StreamChunkEncoder("cmpl-abc", "vicuna-7b", object="text_completion")
+        logprobs = {
+            "text_offset": [0],
+            "token_logprobs": [-0.25],
+            "tokens": ["Hello"],
+            "top_logprobs": [{"Hello": -0.25}],
+        }
+        # Workers may send only some of the fields.
+        partial_logprobs = {"tokens": ["Hello"], "token_logprobs": [None]}
+        for text in TEXTS:
+            for lp in [None, logprobs, partial_logprobs]:
+                chunk = CompletionStreamResponse(
+                    id="cmpl-abc",
+                    object="text_completion",
+                    model="vicuna-7b",
+                    choices=[
+                        CompletionResponseStreamChoice(
+                            index=0,
+                            text=text,
+                            logprobs=LogProbs(**lp) if lp else None,
+                            finish_reason="stop",
+                        )
+                    ],
+                )
+                expected = f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+                self.assertEqual(
+                    encoder.completion_delta(0, text, lp, "stop"), expected.encode()
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
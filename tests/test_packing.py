@@ -0,0 +1,111 @@
+"""
+Usage:
+python3 -m unittest tests.test_packing
+"""
+
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+
+import torch
+from torch.utils.data import Dataset
+from transformers import LlamaConfig, LlamaForCausalLM
+from transformers.models.llama.modeling_llama import LlamaAttention
+
+from fastchat.train.packing import (
+    IGNORE_TOKEN_ID,
+    PackedDataset,
+    check_packing_support,
+    get_cu_seqlens,
+    pack_lengths,
+)
+
+
+class PaddedDataset(Dataset):
+    def __init__(self, lengths, max_length, pad_token_id=0):
+        self.examples = []
+        for n, length in enumerate(lengths):
+            input_ids = torch.full((max_length,), pad_token_id)
+            input_ids[:length] = torch.arange(length) + 100 * (n + 1)
+            labels = torch.full((max_length,), IGNORE_TOKEN_ID)
+            labels[1:length] = input_ids[1:length]
+            self.examples.append(
+                dict(
+                    input_ids=input_ids,
+                    labels=labels,
+                    attention_mask=input_ids.ne(pad_token_id),
+                )
+            )
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, i):
+        return self.examples[i]
+
+
+class TestPacking(unittest.TestCase):
+    def test_pack_lengths(self):
+        lengths = [7, 2, 5, 3, 8, 1]
+        rows = pack_lengths(lengths, 8)
+        self.assertEqual(rows, [[4], [0, 5], [2, 3], [1]])
+        self.assertEqual(sorted(sum(rows, [])), list(range(len(lengths))))
+        for row in rows:
+            self.assertLessEqual(sum(lengths[i] for i in row), 8)
+
+    def test_get_cu_seqlens(self):
+        position_ids = torch.tensor([[0, 1, 2, 0, 1, 0], [0, 1, 2, 3, 4, 5]])
+        cu_seqlens, max_seqlen = get_cu_seqlens(position_ids)
+        self.assertEqual(cu_seqlens.dtype, torch.int32)
+        self.assertEqual(cu_seqlens.tolist(), [0, 3, 5, 6, 12])
+        self.assertEqual(max_seqlen, 6)
+
+    def test_packed_dataset(self):
+        dataset = PackedDataset(PaddedDataset([3, 2, 4], 8), 8, pad_token_id=0)
+        self.assertEqual(len(dataset), 2)
+
+        row = dataset[0]
+        # The 4 and 3 token examples share the first row, then padding.
+        self.assertEqual(
+            row["input_ids"].tolist(), [300, 301, 302, 303, 100, 101, 102, 0]
+        )
+        self.assertEqual(row["position_ids"].tolist(), [0, 1, 2, 3, 0, 1, 2, 0])
+        ignore = IGNORE_TOKEN_ID
+        self.assertEqual(
+            row["labels"].tolist(),
+            [ignore, 301, 302, 303, ignore, 101, 102, ignore],
+        )
+        self.assertEqual(get_cu_seqlens(row["position_ids"])[0].tolist(), [0, 4, 7, 8])
+
+    def test_skip_examples_without_targets(self):
+        padded = PaddedDataset([3, 2], 4)
+        padded.examples[0]["labels"].fill_(IGNORE_TOKEN_ID)
+        dataset = PackedDataset(padded, 4, pad_token_id=0)
+        self.assertEqual(len(dataset), 1)
+        self.assertEqual(dataset[0]["input_ids"].tolist(), [200, 201, 0, 0])
+
+    def test_check_packing_support(self):
+        config = LlamaConfig(
+            vocab_size=32,
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+        )
+        model = LlamaForCausalLM(config)
+        with self.assertRaisesRegex(ValueError, "pack_sequences"):
+            check_packing_support(model)
+
+        def patched_forward(self, *args, **kwargs):
+            pass
+
+        patched_forward.__module__ = "fastchat.train.llama_xformers_attn_monkey_patch"
+        with mock.patch.object(LlamaAttention, "forward", patched_forward):
+            check_packing_support(model)
+        config = SimpleNamespace(_attn_implementation="flash_attention_2")
+        with mock.patch.object(model, "config", config):
+            check_packing_support(model)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+Usage:
+python3 -m unittest tests.test_pretokenize
+"""
+
+import pickle
+import tempfile
+import unittest
+
+import torch
+
+from fastchat.train.pretokenize import (
+    IGNORE_TOKEN_ID,
+    TokenizedDataset,
+    TokenizedDatasetWriter,
+)
+
+
+class TestTokenizedDataset(unittest.TestCase):
+    def test_round_trip(self):
+        examples = [
+            (torch.tensor([1, 5, 6, 7]), torch.tensor([-100, -100, 6, 7])),
+            (
+                torch.tensor([1, 8, 9, 10, 11, 12]),
+                torch.tensor([-100, 8, 9, -100, 11, 12]),
+            ),
+        ]
+        with tempfile.TemporaryDirectory() as path:
+            with TokenizedDatasetWriter(path, dict(model_max_length=5)) as writer:
+                for input_ids, labels in examples:
+                    writer.write(input_ids, labels)
+
+            dataset = TokenizedDataset(path, max_length=5, pad_token_id=0)
+            self.assertEqual(len(dataset), 2)
+            self.assertEqual(dataset.meta["num_tokens"], 10)
+            self.assertEqual(dataset.meta["model_max_length"], 5)
+
+            item = dataset[0]
+            self.assertEqual(item["input_ids"].tolist(), [1, 5, 6, 7, 0])
+            self.assertEqual(
+                item["labels"].tolist(), [IGNORE_TOKEN_ID] * 2 + [6, 7, IGNORE_TOKEN_ID]
+            )
+            self.assertEqual(item["attention_mask"].tolist(), [1, 1, 1, 1, 0])
+
+            # Longer examples are truncated to max_length.
+            item = dataset[1]
+            self.assertEqual(item["input_ids"].tolist(), [1, 8, 9, 10, 11])
+            self.assertEqual(item["labels"].tolist(), [-100, 8, 9, -100, 11])
+
+            # Pickled copies (e.g. in spawned data loader workers) map the
+            # files again instead of carrying their contents.
+            copy = pickle.loads(pickle.dumps(dataset))
+            self.assertIsNone(copy.input_ids)
+            self.assertTrue(torch.equal(copy[1]["input_ids"], item["input_ids"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
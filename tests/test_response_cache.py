@@ -0,0 +1,58 @@
+"""
+Usage:
+python3 -m unittest tests.test_response_cache
+"""
+
+import tempfile
+import unittest
+
+from fastchat.serve.response_cache import ResponseCache
+
+
+def make_params(prompt, temperature=0.0, stop=("</s>", "USER:")):
+    return {
+        "model": "vicuna-7b",
+        "prompt": prompt,
+        "temperature": temperature,
+        "top_p": 1.0,
+        "max_new_tokens": 32,
+        "stop": list(stop),
+    }
+
+
+OUTPUT = {"text": "Hi!", "error_code": 0, "finish_reason": "stop"}
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_hit_ignores_stop_order(self):
+        cache = ResponseCache(max_entries=4)
+        cache.put(make_params("Hello"), OUTPUT)
+        self.assertEqual(
+            cache.get(make_params("Hello", stop=("USER:", "</s>"))), OUTPUT
+        )
+        self.assertIsNone(cache.get(make_params("Bye")))
+        self.assertEqual(cache.get_stats()["hits"], 1)
+        self.assertEqual(cache.get_stats()["misses"], 1)
+
+    def test_sampling_and_errors_are_not_cached(self):
+        cache = ResponseCache(max_entries=4)
+        cache.put(make_params("Hello", temperature=0.7), OUTPUT)
+        cache.put(make_params("Bye"), {"text": "oops", "error_code": 50001})
+        self.assertEqual(len(cache.entries), 0)
+        self.assertIsNone(cache.get(make_params("Hello", temperature=0.7)))
+
+    def test_lru_eviction_and_disk_tier(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache(max_entries=1, cache_dir=cache_dir)
+            cache.put(make_params("a"), OUTPUT)
+            cache.put(make_params("b"), OUTPUT)
+            self.assertEqual(len(cache.entries), 1)
+            self.assertEqual(cache.get(make_params("a")), OUTPUT)
+            self.assertEqual(cache.get_stats()["disk_hits"], 1)
+
+            fresh = ResponseCache(max_entries=1, cache_dir=cache_dir)
+            self.assertEqual(fresh.get(make_params("b")), OUTPUT)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Usage:
+python3 -m unittest tests.test_safetensors_loader
+"""
+
+import os
+import tempfile
+import unittest
+
+from safetensors.torch import save_file
+import torch
+
+from fastchat.model.safetensors_loader import SafetensorsFile, load_safetensors
+
+
+class TestSafetensorsLoader(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.shards = [
+            {
+                "a.weight": torch.randn(4, 8, dtype=torch.bfloat16),
+                "a.ids": torch.arange(5),
+            },
+            {
+                "b.weight": torch.randn(3, dtype=torch.float16),
+                "b.empty": torch.empty(0),
+            },
+        ]
+        self.files = []
+        for i, shard in enumerate(self.shards):
+            filename = os.path.join(self.tmp_dir.name, f"model-{i}.safetensors")
+            save_file(shard, filename, metadata={"format": "pt"})
+            self.files.append(filename)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_read_views(self):
+        f = SafetensorsFile(self.files[0])
+        self.assertEqual(f.metadata, {"format": "pt"})
+        self.assertEqual(sorted(f.keys()), ["a.ids", "a.weight"])
+        for name, tensor in self.shards[0].items():
+            self.assertTrue(torch.equal(f.get_tensor(name), tensor))
+
+    def test_load_converts_floating_point_tensors(self):
+        state_dict = load_safetensors(
+            self.files,
+            dtype=torch.float32,
+            transform=lambda name, t: t * 2 if name == "b.weight" else t,
+        )
+        self.assertEqual(len(state_dict), 4)
+        self.assertEqual(state_dict["a.weight"].dtype, torch.float32)
+        self.assertEqual(state_dict["a.ids"].dtype, torch.int64)
+        self.assertTrue(
+            torch.equal(state_dict["a.weight"], self.shards[0]["a.weight"].float())
+        )
+        self.assertTrue(
+            torch.equal(state_dict["b.weight"], self.shards[1]["b.weight"].float() * 2)
+        )
+        self.assertEqual(state_dict["b.empty"].numel(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Usage:
+python3 -m unittest tests.test_streaming
+"""
+
+import io
+import itertools
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+
+from fastchat.data.streaming import (
+    RecordWriter,
+    _iter_json_array,
+    get_shard_range,
+    iter_jsonl_range,
+    iter_records,
+    map_chunks,
+)
+from fastchat.train.streaming_dataset import StreamingSupervisedDataset
+from fastchat.train.train import DataArguments
+
+
+def make_records(n):
+    return [
+        {
+            "id": str(i),
+            "conversations": [
+                {"from": "human", "value": "ü" * (i % 7) + ' "quoted" ]},'},
+                {"from": "gpt", "value": str(i)},
+            ],
+        }
+        for i in range(n)
+    ]
+
+
+def square_all(chunk):
+    return [x * x for x in chunk]
+
+
+def fake_preprocess(sources, tokenizer):
+    ids = torch.tensor([[int(source[1]["value"])] for source in sources])
+    return dict(input_ids=ids, labels=ids, attention_mask=ids.ge(0))
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.records = make_records(50)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, records):
+        path = os.path.join(self.tmp.name, name)
+        with RecordWriter(path) as writer:
+            for record in records:
+                writer.write(record)
+        return path
+
+    def test_round_trip(self):
+        for name in ["data.json", "data.jsonl"]:
+            with self.subTest(name=name):
+                path = self.write(name, self.records)
+                self.assertEqual(list(iter_records(path)), self.records)
+                self.assertEqual(list(iter_records(path, 5, 8)), self.records[5:8])
+        # The .json output is a regular JSON array.
+        with open(os.path.join(self.tmp.name, "data.json")) as f:
+            self.assertEqual(json.load(f), self.records)
+
+    def test_json_array_across_reads(self):
+        text = json.dumps(self.records, indent=2)
+        records = list(_iter_json_array(io.StringIO(text), chunk_size=16))
+        self.assertEqual(records, self.records)
+        with self.assertRaises(ValueError):
+            list(_iter_json_array(io.StringIO(text[:-10]), chunk_size=16))
+
+    def test_jsonl_shards(self):
+        path = self.write("data.jsonl", self.records)
+        for num_shards in [1, 3, 7]:
+            shards = [
+                list(iter_jsonl_range(path, *get_shard_range(path, i, num_shards)))
+                for i in range(num_shards)
+            ]
+            self.assertEqual(sum(shards, []), self.records)
+
+    def test_map_chunks(self):
+        results = map_chunks(square_all, range(100), chunk_size=7, max_workers=2)
+        self.assertEqual(sum(results, []), [x * x for x in range(100)])
+
+    def test_streaming_dataset(self):
+        path = self.write("data.jsonl", self.records)
+        dataset = StreamingSupervisedDataset(path, None, fake_preprocess, chunk_size=4)
+        seen = []
+        for rank in range(2):
+            with mock.patch(
+                "fastchat.train.streaming_dataset.get_rank_and_world_size",
+                return_value=(rank, 2),
+            ):
+                seen += [int(x["input_ids"]) for x in dataset.iter_shard()]
+        self.assertEqual(seen, list(range(50)))
+        # The stream repeats.
+        first = [int(x["input_ids"]) for x in itertools.islice(dataset, 60)]
+        self.assertEqual(first, list(range(50)) + list(range(10)))
+
+        # More shards than records leaves some shards empty.
+        path = self.write("small.jsonl", self.records[:2])
+        dataset = StreamingSupervisedDataset(path, None, fake_preprocess)
+        with mock.patch(
+            "fastchat.train.streaming_dataset.get_rank_and_world_size",
+            return_value=(7, 8),
+        ):
+            with self.assertRaisesRegex(ValueError, "no records"):
+                next(iter(dataset))
+
+    def test_streaming_needs_jsonl(self):
+        with self.assertRaisesRegex(ValueError, "jsonl"):
+            DataArguments(data_path="data.json", streaming=True)
+        DataArguments(data_path="data.jsonl", streaming=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Usage:
+python3 -m unittest tests.test_throughput
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+from torch.utils.data import Dataset
+from transformers import LlamaConfig, LlamaForCausalLM, Trainer, TrainingArguments
+
+from fastchat.train.throughput import (
+    PHASES,
+    ThroughputCallback,
+    get_flops_per_token,
+    get_num_params,
+)
+
+
+class HalfPaddedDataset(Dataset):
+    def __len__(self):
+        return 16
+
+    def __getitem__(self, i):
+        input_ids = torch.randint(1, 32, (8,))
+        attention_mask = torch.arange(8) < 4
+        return dict(
+            input_ids=input_ids,
+            labels=input_ids.masked_fill(~attention_mask, -100),
+            attention_mask=attention_mask,
+        )
+
+
+class TestThroughputCallback(unittest.TestCase):
+    def setUp(self):
+        config = LlamaConfig(
+            vocab_size=32,
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+        )
+        self.model = LlamaForCausalLM(config)
+
+    def test_flops_per_token(self):
+        num_params = get_num_params(self.model)
+        embeddings = self.model.get_input_embeddings().weight.numel()
+        total = sum(p.numel() for p in self.model.parameters())
+        self.assertEqual(num_params, total - embeddings)
+        self.assertEqual(
+            get_flops_per_token(self.model.config, num_params, 8),
+            6 * num_params + 12 * 2 * 16 * 8,
+        )
+
+    def test_trainer(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            args = TrainingArguments(
+                output_dir=output_dir,
+                per_device_train_batch_size=2,
+                gradient_accumulation_steps=2,
+                logging_steps=2,
+                max_steps=4,
+                report_to=[],
+                use_cpu=True,
+            )
+            trainer = Trainer(
+                model=self.model, args=args, train_dataset=HalfPaddedDataset()
+            )
+            with mock.patch.dict(os.environ, {"FASTCHAT_PEAK_TFLOPS": "1"}):
+                trainer.add_callback(ThroughputCallback())
+            trainer.train()
+
+            with open(os.path.join(output_dir, "throughput.jsonl")) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual([r["step"] for r in records], [2, 4])
+        for record in records:
+            # Two steps of two micro-batches of two examples of 4 real tokens.
+            tokens = record["tokens_per_second"] * record["seconds_per_step"] * 2
+            self.assertAlmostEqual(tokens, 32)
+            self.assertAlmostEqual(record["padding_fraction"], 0.5)
+            self.assertGreater(record["mfu"], 0)
+            self.assertEqual(set(record["step_time"]), set(PHASES))
+            self.assertLessEqual(
+                sum(record["step_time"].values()), record["seconds_per_step"]
+            )
+        self.assertFalse(self.model._forward_hooks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+"""
+Usage:
+python3 -m unittest tests.test_train_preprocess
+"""
+
+import unittest
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors
+from tokenizers import trainers
+import torch
+from transformers import PreTrainedTokenizerFast
+
+from fastchat.train.train import IGNORE_TOKEN_ID, mask_targets_by_offsets, preprocess
+from fastchat.train.train_with_template import (
+    apply_prompt_template,
+    apply_prompt_template_with_spans,
+    mask_targets,
+    preprocess_chunk,
+    tokenize_conversations,
+)
+
+SOURCES = [
+    [
+        {"from": "human", "value": "Hello! How are you?"},
+        {"from": "gpt", "value": "I am fine, thanks."},
+        {"from": "human", "value": "Tell me a joke."},
+        {"from": "gpt", "value": "No jokes today, sorry!"},
+    ]
+]
+TEMPLATE_IDS = [
+    "lmsys/vicuna-7b-v1.5",
+    "meta-llama/Llama-2-7b-chat-hf",
+    "Qwen/Qwen-7B-Chat",
+    "mistralai/Mistral-7B-Instruct-v0.2",
+]
+
+
+def make_tokenizer(model_max_length):
+    words = "A chat . USER ASSISTANT : hello world how are you fine thanks".split()
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    vocab.update({w: i + 3 for i, w in enumerate(words)})
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", 1)]
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token="<unk>",
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="<unk>",
+        model_max_length=model_max_length,
+    )
+
+
+def train_tokenizer(kind):
+    """A small BPE tokenizer trained on the prompts of TEMPLATE_IDS.
+
+    "metaspace" is SentencePiece-like, as in Llama, and "byte_level" is
+    GPT-2-like. The separators of the templates are special tokens, as in the
+    tokenizers of the models that use them.
+    """
+    prompts = [apply_prompt_template(SOURCES, t)[0][0] for t in TEMPLATE_IDS]
+    separators = ["<s>", "</s>", "<|im_start|>", "<|im_end|>", "[INST]", "[/INST]"]
+    if kind == "metaspace":
+        tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+        tokenizer.pre_tokenizer = pre_tokenizers.Metaspace(prepend_scheme="first")
+        tokenizer.decoder = decoders.Metaspace(prepend_scheme="first")
+        special_tokens = ["<unk>"] + separators
+        alphabet = []
+    else:
+        tokenizer = Tokenizer(models.BPE())
+        tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+        tokenizer.decoder = decoders.ByteLevel()
+        special_tokens = ["<|endoftext|>"] + separators
+        alphabet = pre_tokenizers.ByteLevel.alphabet()
+    trainer = trainers.BpeTrainer(
+        vocab_size=500, special_tokens=special_tokens, initial_alphabet=alphabet
+    )
+    tokenizer.train_from_iterator(prompts, trainer)
+    if kind == "metaspace":
+        tokenizer.post_processor = processors.TemplateProcessing(
+            single="<s> $A", special_tokens=[("<s>", tokenizer.token_to_id("<s>"))]
+        )
+        special_tokens_map = {"unk_token": "<unk>", "pad_token": "<unk>"}
+    else:
+        special_tokens_map = {"pad_token": "<|endoftext|>"}
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        additional_special_tokens=separators[2:],
+        model_max_length=128,
+        **special_tokens_map,
+    )
+
+
+class TestPreprocess(unittest.TestCase):
+    def test_mask_targets_by_offsets(self):
+        tokenizer = make_tokenizer(64)
+        sources = [
+            [
+                {"from": "human", "value": "hello world"},
+                {"from": "gpt", "value": "fine thanks"},
+                {"from": "human", "value": "how are you"},
+                {"from": "gpt", "value": "fine"},
+            ]
+        ]
+        data = preprocess(sources, tokenizer)
+        labels = data["labels"][0]
+        # Only the assistant outputs and their end of turn are trained on.
+        self.assertEqual(
+            tokenizer.decode(labels[labels != IGNORE_TOKEN_ID]),
+            "fine thanks </s> fine </s>",
+        )
+        self.assertEqual(labels[0], IGNORE_TOKEN_ID)
+        self.assertEqual(len(labels), 64)
+
+    def test_truncated_conversation_is_kept(self):
+        tokenizer = make_tokenizer(48)
+        sources = [
+            [
+                {"from": "human", "value": "hello"},
+                {"from": "gpt", "value": "fine thanks " * 10},
+            ]
+        ]
+        labels = preprocess(sources, tokenizer)["labels"][0]
+        # The targets that fit are still trained on.
+        self.assertTrue(labels.ne(IGNORE_TOKEN_ID).any())
+        self.assertNotEqual(labels[-1], IGNORE_TOKEN_ID)
+
+    def test_offsets_match_mask_targets(self):
+        for kind in ["metaspace", "byte_level"]:
+            tokenizer = train_tokenizer(kind)
+            for template_id in TEMPLATE_IDS:
+                with self.subTest(tokenizer=kind, template=template_id):
+                    input_ids, labels = preprocess_chunk(
+                        SOURCES, tokenizer, template_id
+                    )
+                    conversations, conv = apply_prompt_template(SOURCES, template_id)
+                    old_input_ids, targets = tokenize_conversations(
+                        conversations, tokenizer
+                    )
+                    targets = mask_targets(conversations, targets, tokenizer, conv)
+                    self.assertTrue(torch.equal(input_ids, old_input_ids))
+
+                    # Every token trained on by the per-turn masking is also
+                    # trained on from the offsets. The offsets add the first
+                    # token of each reply, which the per-turn masking loses to
+                    # the trailing space of the assistant separator, and the
+                    # end of turn tokens.
+                    old, new = targets.ne(IGNORE_TOKEN_ID), labels.ne(IGNORE_TOKEN_ID)
+                    self.assertTrue(old.any())
+                    self.assertTrue(new[old].all())
+
+                    # They are exactly the tokens of the target text.
+                    _, target_spans = apply_prompt_template_with_spans(
+                        SOURCES, template_id
+                    )
+                    expected = "".join(
+                        conversations[0][start:end] for start, end in target_spans[0]
+                    )
+                    self.assertEqual(
+                        tokenizer.decode(labels[new]).replace(" ", ""),
+                        expected.replace(" ", ""),
+                    )
+
+    def test_tokenization_mismatch_is_ignored(self):
+        conversations = ["USER: hi ASSISTANT: ok</s>"] * 2
+        target_spans = [[(20, 26)]] * 2
+        targets = torch.arange(8).repeat(2, 1)
+        # The tokens of the first row stop before the end of its text.
+        offset_mapping = torch.tensor(
+            [
+                [(0, 0), (0, 4), (4, 5), (6, 8), (9, 18), (18, 19), (20, 22), (0, 0)],
+                [(0, 0), (0, 4), (4, 5), (6, 8), (9, 18), (18, 19), (20, 22), (22, 26)],
+            ]
+        )
+        attention_mask = torch.tensor([[1] * 7 + [0], [1] * 8])
+        labels = mask_targets_by_offsets(
+            targets, offset_mapping, attention_mask, conversations, target_spans
+        )
+        self.assertTrue(labels[0].eq(IGNORE_TOKEN_ID).all())
+        self.assertEqual(labels[1].tolist(), [IGNORE_TOKEN_ID] * 6 + [6, 7])
+
+
+if __name__ == "__main__":
+    unittest.main()